@@ -0,0 +1,76 @@
+"""Times call-heavy vizh programs, which spend most of their time setting up and tearing down tapes.
+
+Builds each program with the compiler and libv runtime in this tree and runs it from a C
+harness which calls its entry point over and over. Usage: python -m benchmarks.call_heavy [calls]
+"""
+import glob
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+from vizh.ir import *
+import vizh.compiler
+from tests.helpers import function
+
+CALL, INC, DOWN, UP, READ, WRITE = InstructionType.CALL, InstructionType.INC, InstructionType.DOWN, InstructionType.UP, InstructionType.READ, InstructionType.WRITE
+
+def scratch(name, n_tapes, callee=None):
+    """A function which uses n_tapes scratch tapes, calling callee on each of them"""
+    body = []
+    for _ in range(n_tapes):
+        body += [(CALL, 'newtape'), DOWN, INC]
+        if callee:
+            body += [(CALL, callee)]
+    body += [READ] + [UP] * n_tapes + [WRITE]
+    return function(name, 1, body)
+
+# (name, functions, entry point)
+PROGRAMS = [
+    ('no tapes', [function('leaf', 1, [INC])], 'leaf'),
+    ('one tape', [scratch('one', 1)], 'one'),
+    ('six tapes', [scratch('six', 6)], 'six'),
+    ('nested', [scratch('inner', 2), scratch('middle', 2, 'inner'), scratch('outer', 2, 'middle')], 'outer'),
+]
+
+HARNESS = '''
+#include <stdio.h>
+#include <time.h>
+#include "libv.h"
+void %(entry)s(uint8_t*);
+
+int main() {
+  uint8_t tape[16] = {0};
+  clock_t start = clock();
+  for (long call = 0; call < %(calls)d; ++call) {
+    %(entry)s(tape);
+  }
+  printf("%%f\\n", (double)(clock() - start) / CLOCKS_PER_SEC);
+  return 0;
+}
+'''
+
+def time_program(functions, entry, calls, build_dir):
+    # opt_level 1 so that calls aren't inlined away
+    code = vizh.compiler.Compiler(opt_level=1).compile_functions_to_c(functions)
+    source = os.path.join(build_dir, f'{entry}.c')
+    with open(source, 'w') as c_file:
+        c_file.write(code)
+    # The harness is compiled separately so that the C compiler can't inline the calls away
+    harness = os.path.join(build_dir, f'{entry}_harness.c')
+    with open(harness, 'w') as c_file:
+        c_file.write(HARNESS % {'entry': entry, 'calls': calls})
+    libv_path = os.path.join(os.path.dirname(__file__), '..', 'libv')
+    executable = os.path.join(build_dir, entry)
+    subprocess.run(['cc', '-O2', '-I', libv_path, source, harness, *glob.glob(os.path.join(libv_path, 'memory', '*.c')), '-o', executable], check=True)
+    return float(subprocess.run([executable], stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout)
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as build_dir:
+        for name, functions, entry in PROGRAMS:
+            seconds = time_program(functions, entry, calls, build_dir)
+            print(f'{name:<12} {seconds * 1e9 / calls:8.1f} ns/call')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Times how fast vizh programs can write out a large text file.
+
+Builds each program with the compiler and libv runtime in this tree, maps the file onto
+its tape with --vizh-tape and sends its output to /dev/null.
+Usage: python -m benchmarks.io_throughput [megabytes]
+"""
+import glob
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+from vizh.ir import *
+import vizh.compiler
+from tests.helpers import function
+
+LOOP_START, LOOP_END, RIGHT, CALL = InstructionType.LOOP_START, InstructionType.LOOP_END, InstructionType.RIGHT, InstructionType.CALL
+
+# (name, body of main)
+PROGRAMS = [
+    ('print loop', [LOOP_START, (CALL, 'print'), RIGHT, LOOP_END]),
+    ('putstr', [(CALL, 'putstr')]),
+]
+
+def build_program(name, body, build_dir):
+    main = function('main', 1, body)
+    externs = [FunctionSignature('print', 1), FunctionSignature('putstr', 1)]
+    source = os.path.join(build_dir, f'{name.replace(" ", "_")}.c')
+    with open(source, 'w') as c_file:
+        c_file.write(vizh.compiler.Compiler().compile_functions_to_c([main], externs))
+    libv_path = os.path.join(os.path.dirname(__file__), '..', 'libv')
+    runtime = glob.glob(os.path.join(libv_path, 'memory', '*.c')) + [os.path.join(libv_path, 'io', 'io.c'), os.path.join(libv_path, 'crtv.c')]
+    executable = source[:-2]
+    subprocess.run(['cc', '-O2', '-I', libv_path, source, *runtime, '-o', executable], check=True)
+    return executable
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    with tempfile.TemporaryDirectory() as build_dir:
+        text = os.path.join(build_dir, 'text')
+        with open(text, 'wb') as text_file:
+            line = b'The quick brown fox jumps over the lazy dog.\n'
+            text_file.write(line * (megabytes * 1024 * 1024 // len(line)))
+
+        for name, body in PROGRAMS:
+            executable = build_program(name, body, build_dir)
+            start = time.perf_counter()
+            subprocess.run([executable, f'--vizh-tape={text}', f'--vizh-tape-size={megabytes + 1}M'], stdout=subprocess.DEVNULL, check=True)
+            seconds = time.perf_counter() - start
+            print(f'{name:<12} {megabytes / seconds:8.1f} MB/s')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Compares handing crops to Tesseract through the old per-pixel matToPix8 loop
+against passing the NumPy buffer straight to TessBaseAPISetImage.
+
+Run with: python -m benchmarks.ocr_conversion
+"""
+import timeit
+import numpy as np
+import vizh.ocr
+
+CROP_SIZES = [(16, 16), (32, 96), (64, 256), (128, 512)]
+REPEATS = 5
+
+def make_crops(height, width):
+    rng = np.random.default_rng(0)
+    gray = rng.integers(0, 256, (height, width), dtype=np.uint8)
+    bgr = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    # Crops in the parser are views into a larger image
+    bgr_view = np.zeros((height + 8, width + 8, 3), dtype=np.uint8)[4:-4, 4:-4]
+    bgr_view[:] = bgr
+    return {'gray': gray, 'bgr': bgr, 'bgr view': bgr_view}
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=REPEATS))
+
+def destroy_pix(leptonica, pix):
+    pix_ptr = vizh.ocr.ffi.new('PIX*[1]')
+    pix_ptr[0] = pix
+    leptonica.pixDestroy(pix_ptr)
+
+def main():
+    with vizh.ocr.TesseractOCR() as ocr:
+        print(f'{"crop":>10} {"kind":>10} {"matToPix8":>12} {"SetImage":>12} {"ocr()":>12}')
+        for height, width in CROP_SIZES:
+            for kind, crop in make_crops(height, width).items():
+                old = best_of(lambda: destroy_pix(ocr.leptonica, vizh.ocr.matToPix8(ocr.leptonica, crop)))
+                new = best_of(lambda: ocr.tesseract.TessBaseAPISetImage(ocr.api, *vizh.ocr.matToImageData(crop)[:5]))
+                full = best_of(lambda: ocr.ocr(crop))
+                print(f'{f"{width}x{height}":>10} {kind:>10} {old*1000:>10.3f}ms {new*1000:>10.3f}ms {full*1000:>10.3f}ms')
+
+if __name__ == '__main__':
+    main()
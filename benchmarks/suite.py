@@ -0,0 +1,317 @@
+"""Benchmarks every stage of building a vizh program, and writes the results as JSON so commits can be compared.
+
+Programs of 10 to 10,000 random instructions, with up to 200 calls, are drawn with
+vizh.render and timed through:
+
+    parse      Parser.parse_image with the signature handed over, so no Tesseract is needed
+    parse_ocr  Parser.parse on the image file, reading the signature with Tesseract
+    codegen    Compiler.compile_functions_to_c
+    cc         compiling the generated C, without the object cache
+
+and the brainfuck and memcopy samples are built with vizh and timed running. Stages
+which can't run here, like parse_ocr without Tesseract, are recorded as skipped with
+the reason. Usage:
+
+    python -m benchmarks.suite -o results.json
+    python -m benchmarks.suite --compare old.json -o new.json
+
+Run it from the root of the repository, so the C compiler can find libv.h.
+"""
+import click
+import copy
+import datetime
+import json
+import os
+import os.path
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+from vizh.ir import *
+import vizh.build
+import vizh.compiler
+import vizh.ocr
+import vizh.parser
+import vizh.recogniser
+import vizh.render
+
+# Bump this whenever the JSON written by the suite changes
+SUITE_VERSION = 1
+
+SIZES = [10, 100, 1000, 10000]
+CALLS = [0, 10, 50, 200]
+# The functions generated programs call. Each takes one argument, so calls don't need tapes set up.
+CALLEES = ['step', 'twist', 'bump']
+
+T = InstructionType
+SIMPLE = [T.LEFT, T.RIGHT, T.UP, T.DOWN, T.READ, T.WRITE, T.INC, T.DEC]
+# How likely each instruction is to open or close a loop, if it can
+LOOP_CHANCE = 0.08
+MAX_LOOP_DEPTH = 6
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SAMPLES = os.path.join(ROOT, 'samples')
+# Nested loops which count to 8**4 and print the result
+BRAINFUCK_PROGRAM = '++++++++[>++++++++[>++++++++[>++++++++[>+<-]<-]<-]<-]>>>>.\n'
+
+class SkippedError(Exception):
+    pass
+
+def generate_program(size, n_calls, seed):
+    """A random main function of size instructions, n_calls of them calls, with balanced loops"""
+    rng = random.Random(seed)
+    call_indices = set(rng.sample(range(size), n_calls))
+    instructions = []
+    depth = 0
+    for index in range(size):
+        remaining = size - index
+        if index in call_indices:
+            instructions.append(Instruction(T.CALL, rng.choice(CALLEES)))
+        # Every open loop has to be closed by the end, so close them when there's only room left for that
+        elif depth > 0 and (remaining <= depth or rng.random() < LOOP_CHANCE):
+            instructions.append(Instruction(T.LOOP_END))
+            depth -= 1
+        elif depth < MAX_LOOP_DEPTH and remaining > depth + 1 and rng.random() < LOOP_CHANCE:
+            instructions.append(Instruction(T.LOOP_START))
+            depth += 1
+        else:
+            instructions.append(Instruction(rng.choice(SIMPLE)))
+    # Calls can land where a loop should have been closed
+    return Function(FunctionSignature('main', 1), close_loops(instructions))
+
+def close_loops(instructions):
+    """Replaces unmatched loop starts with increments"""
+    unmatched = []
+    for index, instruction in enumerate(instructions):
+        if instruction.type == T.LOOP_START:
+            unmatched.append(index)
+        elif instruction.type == T.LOOP_END:
+            unmatched.pop()
+    for index in unmatched:
+        instructions[index] = Instruction(T.INC)
+    return instructions
+
+def callees():
+    return [Function(FunctionSignature(name, 1), [Instruction(T.INC), Instruction(T.RIGHT)]) for name in CALLEES]
+
+def best_of(repeats, fn):
+    """The fastest of repeats runs of fn, in seconds, and what it returned"""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def skipped(err):
+    return {'skipped': str(err)}
+
+class KnownSignature(object):
+    """Stands in for Tesseract by handing back the signature the image was drawn with"""
+    def __init__(self, function):
+        self.texts = [function.signature.name, str(function.signature.n_args)]
+        self.next = 0
+
+    def ocr(self, image):
+        text = self.texts[self.next % len(self.texts)]
+        self.next += 1
+        return text
+
+def check_parsed(function, parsed):
+    if parsed is None or [str(inst) for inst in parsed.instructions] != [str(inst) for inst in function.instructions]:
+        raise RuntimeError(f'{function.signature.name} was parsed as something other than what was drawn')
+
+def parser_for(function):
+    parser = vizh.parser.Parser(interactive=False, recogniser=vizh.recogniser.TemplateRecogniser(CALLEES))
+    parser._ocr = KnownSignature(function)
+    return parser
+
+def time_parse(function, img, repeats):
+    seconds, parsed = best_of(repeats, lambda: parser_for(function).parse_image(img.copy(), 'benchmark.png'))
+    check_parsed(function, parsed)
+    return {'seconds': seconds, 'images_per_second': 1 / seconds,
+            'instructions_per_second': len(function.instructions) / seconds}
+
+def time_parse_with_ocr(function, path, repeats):
+    try:
+        ocr = vizh.ocr.TesseractOCR()
+    except (OSError, KeyError) as err:
+        raise SkippedError(f"Tesseract isn't available: {err}")
+    ocr.__exit__(None, None, None)
+
+    def parse():
+        with vizh.parser.Parser(interactive=False, recogniser=vizh.recogniser.TemplateRecogniser(CALLEES)) as parser:
+            return parser.parse(path)
+    seconds, parsed = best_of(repeats, parse)
+    check_parsed(function, parsed)
+    return {'seconds': seconds, 'images_per_second': 1 / seconds,
+            'instructions_per_second': len(function.instructions) / seconds}
+
+def time_codegen(functions, repeats):
+    # Code generation mangles names in place, so every run gets its own copy
+    compiler = vizh.compiler.Compiler()
+    seconds, code = best_of(repeats, lambda: compiler.compile_functions_to_c(copy.deepcopy(functions)))
+    return {'seconds': seconds, 'lines': code.count('\n') + 1}, code
+
+def time_cc(code, repeats):
+    compiler = vizh.compiler.Compiler()
+    with vizh.build.BuildDirectory() as build:
+        seconds, _ = best_of(repeats, lambda: compiler.compile_generated([('benchmark', code)], build))
+    return {'seconds': seconds}
+
+def measure(fn, *args):
+    try:
+        return fn(*args)
+    except SkippedError as err:
+        return skipped(err)
+    except vizh.compiler.CompilerError as err:
+        return skipped(f'Compiling failed: {err}')
+
+def benchmark_program(size, n_calls, seed, repeats, work_dir, stages):
+    function = generate_program(size, n_calls, seed)
+    result = {'name': f'{size}x{n_calls}', 'size': size, 'calls': n_calls, 'seed': seed}
+
+    if 'parse' in stages or 'parse_ocr' in stages:
+        img = vizh.render.render(function)
+        result['image'] = {'width': img.shape[1], 'height': img.shape[0]}
+        if 'parse' in stages:
+            result['parse'] = time_parse(function, img, repeats)
+        if 'parse_ocr' in stages:
+            path = os.path.join(work_dir, f'{result["name"]}.png')
+            vizh.render.write(function, path)
+            result['parse_ocr'] = measure(time_parse_with_ocr, function, path, repeats)
+
+    if 'codegen' in stages or 'cc' in stages:
+        result['codegen'], code = time_codegen([function] + callees(), repeats)
+        if 'cc' in stages:
+            result['cc'] = measure(time_cc, code, repeats)
+    return result
+
+def build_sample(inputs, output, work_dir):
+    """Builds a sample with this tree's vizh, which needs Tesseract and an installed libv"""
+    command = [sys.executable, '-m', 'vizh.driver', '-q', '--no-parse-cache', '--no-object-cache', *inputs, '-o', output]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+    try:
+        subprocess.run(command, cwd=work_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                       universal_newlines=True, check=True)
+    except subprocess.CalledProcessError as err:
+        lines = err.output.strip().splitlines()
+        raise SkippedError(f"Couldn't build it: {lines[-1] if lines else err}")
+
+def time_sample(executable, stdin, repeats):
+    def run():
+        return subprocess.run([executable], input=stdin, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    seconds, output = best_of(repeats, run)
+    return {'seconds': seconds, 'output': output}
+
+def benchmark_sample(name, inputs, stdin, repeats, work_dir):
+    executable = os.path.join(work_dir, name)
+    build_sample([os.path.abspath(path) for path in inputs], executable, work_dir)
+    return time_sample(executable, stdin, repeats)
+
+def benchmark_samples(repeats, work_dir):
+    brainfuck = sorted(os.path.join(SAMPLES, 'brainfuck', file) for file in os.listdir(os.path.join(SAMPLES, 'brainfuck')))
+    memcopy = [os.path.join(SAMPLES, 'memcopy', 'memcopy.png'), os.path.join(SAMPLES, 'memcopy', 'main_memcopy.c')]
+    return {
+        'brainfuck': measure(benchmark_sample, 'brainfuck', brainfuck, BRAINFUCK_PROGRAM, repeats, work_dir),
+        'memcopy': measure(benchmark_sample, 'memcopy', memcopy, '', repeats, work_dir),
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def metadata():
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    }
+
+def flatten(results):
+    """Maps names like '1000x50 codegen' to their times in seconds, for comparing runs"""
+    times = {}
+    for program in results['programs']:
+        for stage in ('parse', 'parse_ocr', 'codegen', 'cc'):
+            if 'seconds' in program.get(stage, {}):
+                times[f'{program["name"]} {stage}'] = program[stage]['seconds']
+    for name, sample in results['samples'].items():
+        if 'seconds' in sample:
+            times[f'{name} run'] = sample['seconds']
+    return times
+
+def format_comparison(old, new):
+    old_times, new_times = flatten(old), flatten(new)
+    lines = [f'Comparing {old["metadata"]["commit"] or "?"} with {new["metadata"]["commit"] or "?"}',
+             f'{"Benchmark":<24} {"Old (ms)":>10} {"New (ms)":>10} {"New/old":>8}']
+    for name in sorted(set(old_times) & set(new_times), key=lambda name: list(new_times).index(name)):
+        ratio = new_times[name] / old_times[name] if old_times[name] else float('inf')
+        lines.append(f'{name:<24} {1000 * old_times[name]:>10.2f} {1000 * new_times[name]:>10.2f} {ratio:>8.2f}')
+    missing = sorted(set(old_times) ^ set(new_times))
+    if missing:
+        lines += ['', 'Only in one run: ' + ', '.join(missing)]
+    return '\n'.join(lines)
+
+def format_results(results):
+    lines = [f'{"Program":<12} {"Parse img/s":>12} {"Parse inst/s":>13} {"OCR img/s":>10} {"Codegen (ms)":>13} {"CC (ms)":>10}']
+    def field(stage, key, scale=1, digits=1):
+        value = stage.get(key) if stage else None
+        return f'{scale * value:.{digits}f}' if value is not None else '-'
+    for program in results['programs']:
+        lines.append(f'{program["name"]:<12} {field(program.get("parse"), "images_per_second"):>12} '
+                     f'{field(program.get("parse"), "instructions_per_second", digits=0):>13} '
+                     f'{field(program.get("parse_ocr"), "images_per_second"):>10} '
+                     f'{field(program.get("codegen"), "seconds", 1000, 2):>13} {field(program.get("cc"), "seconds", 1000):>10}')
+    lines.append('')
+    for name, sample in results['samples'].items():
+        lines.append(f'{name:<12} ' + (f'{1000 * sample["seconds"]:.2f}ms' if 'seconds' in sample else f'skipped: {sample["skipped"]}'))
+    skips = sorted(set(program[stage]['skipped'] for program in results['programs']
+                       for stage in ('parse_ocr', 'cc') if 'skipped' in program.get(stage, {})))
+    lines += [f'Skipped: {reason}' for reason in skips]
+    return '\n'.join(lines)
+
+STAGES = ['parse', 'parse_ocr', 'codegen', 'cc', 'samples']
+
+@click.command()
+@click.option('-o', '--output', 'output', type=click.Path(dir_okay=False), default=None, help="File to write the results to as JSON.")
+@click.option('--compare', 'compare', type=click.Path(exists=True, dir_okay=False), default=None, help="Results from an earlier run to compare against.")
+@click.option('-s', '--size', 'sizes', type=click.IntRange(min=1), multiple=True, help="Number of instructions in each program (default 10, 100, 1000 and 10000).")
+@click.option('-c', '--calls', 'calls', type=click.IntRange(min=0), multiple=True, help="Number of calls in each program (default 0, 10, 50 and 200).")
+@click.option('--stage', 'stages', type=click.Choice(STAGES), multiple=True, help="Only run these stages.")
+@click.option('-r', '--repeats', 'repeats', type=click.IntRange(min=1), default=3, help="Times to repeat each measurement, keeping the fastest.")
+@click.option('--seed', 'seed', type=int, default=0, help="Seed for generating programs.")
+def main(output, compare, sizes, calls, stages, repeats, seed):
+    """Benchmarks parsing, code generation, C compilation and running vizh programs."""
+    stages = set(stages or STAGES)
+    results = {'version': SUITE_VERSION, 'metadata': metadata(), 'repeats': repeats, 'programs': [], 'samples': {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in sizes or SIZES:
+            # Small programs can't fit all the calls, and don't need to
+            for n_calls in sorted(set(min(n_calls, size) for n_calls in calls or CALLS)):
+                print(f'Benchmarking {size} instructions with {n_calls} calls', file=sys.stderr)
+                results['programs'].append(benchmark_program(size, n_calls, seed, repeats, work_dir, stages))
+        if 'samples' in stages:
+            print('Benchmarking the samples', file=sys.stderr)
+            results['samples'] = benchmark_samples(repeats, work_dir)
+
+    print(format_results(results))
+    if output:
+        with open(output, 'w') as json_file:
+            json.dump(results, json_file, indent=1)
+    if compare:
+        with open(compare) as json_file:
+            print()
+            print(format_comparison(json.load(json_file), results))
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,66 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
 #include <stdint.h>
-//If the user writes a function called main it'll get mangled to vizh_main
-void vizh_main(uint8_t*);
+#include "libv.h"
+//If the user writes a function called main it'll get mangled to vizh_main.
+//The compiler also generates vizh_main_entry, which calls it with the first
+//vizh_main_n_tapes tapes in an array, since we don't know how many it takes.
+extern const size_t vizh_main_n_tapes;
+void vizh_main_entry(uint8_t** tapes);
 
-//We then provide a C entry point which allocates some tape for the main function to work on
-int main() {
-    uint8_t primary_tape[4096] = {0};
-    vizh_main(primary_tape);
+#define TAPE_SIZE_FLAG "--vizh-tape-size="
+//Maps a file as the next tape, so that changes to it are private to the program
+#define TAPE_FLAG "--vizh-tape="
+//Maps a file as the next tape, so that changes to it are written to the file
+#define SHARED_TAPE_FLAG "--vizh-tape-rw="
+
+static int has_prefix(const char* arg, const char* prefix) {
+    return strncmp(arg, prefix, strlen(prefix)) == 0;
+}
+
+//We then provide a C entry point which sets up the tapes for the main function to work on
+int main(int argc, char** argv) {
+    //The tape size has to be known before any tapes are allocated
+    for (int i = 1; i < argc; ++i) {
+        if (has_prefix(argv[i], TAPE_SIZE_FLAG)) {
+            size_t size = vizh_parse_size(argv[i] + strlen(TAPE_SIZE_FLAG));
+            if (size == 0) {
+                fprintf(stderr, "vizh: %s isn't a size\n", argv[i]);
+                return 2;
+            }
+            vizh_set_tape_size(size);
+        }
+    }
+
+    uint8_t** tapes = (uint8_t**)malloc((vizh_main_n_tapes + 1) * sizeof(uint8_t*));
+    if (!tapes) {
+        fputs("vizh: out of memory allocating tapes\n", stderr);
+        return 2;
+    }
+    size_t n_tapes = 0;
+    for (int i = 1; i < argc; ++i) {
+        int shared = has_prefix(argv[i], SHARED_TAPE_FLAG);
+        if (!shared && !has_prefix(argv[i], TAPE_FLAG)) {
+            continue;
+        }
+        if (n_tapes == vizh_main_n_tapes) {
+            fprintf(stderr, "vizh: main only takes %zu tapes\n", vizh_main_n_tapes);
+            return 2;
+        }
+        const char* path = argv[i] + strlen(shared ? SHARED_TAPE_FLAG : TAPE_FLAG);
+        tapes[n_tapes] = vizh_map_file_tape(path, shared);
+        if (!tapes[n_tapes]) {
+            perror(path);
+            return 2;
+        }
+        ++n_tapes;
+    }
+    //Any other tapes start out empty
+    for (; n_tapes < vizh_main_n_tapes; ++n_tapes) {
+        tapes[n_tapes] = vizh_alloc_tape();
+    }
+
+    vizh_main_entry(tapes);
+    return 0;
 }
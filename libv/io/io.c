@@ -1,9 +1,35 @@
 #include <stdio.h>
 #include <stdint.h>
+#include <string.h>
+#include "libv.h"
+
+// Only one thread runs a vizh program, so stdio's locking is wasted on it.
+// stdio still does the buffering, and flushes stdout at exit.
+#if defined(_WIN32)
+    #define getchar_unlocked _getchar_nolock
+    #define putchar_unlocked _putchar_nolock
+#endif
+
 void readin(uint8_t* c) {
-    *c = getchar();
+    *c = getchar_unlocked();
 }
 
 void print(uint8_t* c) {
-    putchar(*c);
-}
\ No newline at end of file
+    putchar_unlocked(*c);
+}
+
+void putstr(uint8_t* c) {
+    fwrite(c, 1, strlen((const char*)c), stdout);
+}
+
+void readline(uint8_t* c) {
+    int next;
+    while ((next = getchar_unlocked()) != EOF && next != '\n') {
+        *c++ = (uint8_t)next;
+    }
+    *c = 0;
+}
+
+void readn(uint8_t* c) {
+    *c = (uint8_t)fread(c + 1, 1, *c, stdin);
+}
@@ -1,24 +1,85 @@
+#pragma once
 #if __has_include("libv_vizh.h")
     #include "libv_vizh.h"
 #endif
 #include <stdint.h>
+#include <stddef.h>
 
-#define TAPE_SIZE 4096
+// The default size of a tape in bytes. Tapes are reserved up front, but memory
+// is only used for the pages of a tape which are touched, so it can be large.
+// Programs can choose another size with vizh --tape-size, the VIZH_TAPE_SIZE
+// environment variable or the --vizh-tape-size= flag.
+#ifndef TAPE_SIZE
+    #define TAPE_SIZE ((size_t)16 * 1024 * 1024)
+#endif
+
+// Functions which allocate tapes keep room for this many in arrays on
+// their stack, so their first few calls to newtape don't need to grow the table
+#define VIZH_INLINE_TAPES 4
 
 typedef struct {
     size_t n_tapes; 
     size_t capacity; 
     uint8_t** tapes;
+    // Where each allocated tape starts, since the pointers in tapes move with the heads
     uint8_t** to_free;
+    // Whether tapes and to_free have outgrown the function's arrays and moved to the heap
+    int on_heap;
 } vizh_tapes_t;
 
 void readin(uint8_t* c);
 void print(uint8_t* c);
+// Writes the cells from c up to the first zero to stdout
+void putstr(uint8_t* c);
+// Reads a line from stdin into the cells from c, without the newline and followed by a zero
+void readline(uint8_t* c);
+// Reads up to *c bytes from stdin into the cells after c, and sets *c to how many were read
+void readn(uint8_t* c);
 
 // Calls to newtape and freetape are automatically fixed up by the compiler to pass tapes
 void newtape(vizh_tapes_t* tapes);
 void freetape(vizh_tapes_t* tapes);
+// Allocates a zeroed tape of vizh_tape_size() bytes with guard pages at both ends, and gives one back
+uint8_t* vizh_alloc_tape(void);
+void vizh_free_tape(uint8_t* tape);
+// Maps a file onto a new tape, followed by zeroes, returning NULL if it can't be opened. If shared is
+// set, changes to the tape are written to the file, otherwise they're private. Tapes from files are never freed.
+uint8_t* vizh_map_file_tape(const char* path, int shared);
+// The size of tapes, which must only be changed before the first tape is allocated
+size_t vizh_tape_size(void);
+void vizh_set_tape_size(size_t size);
+// Parses a size like 4096, 64K, 16M or 1G, returning 0 if it isn't one
+size_t vizh_parse_size(const char* text);
 
+// Frees the tables of tapes which have moved to the heap. Called at the end of functions which allocate tapes.
+void vizh_release_tapes(vizh_tapes_t* tapes);
 
+// Programs built with vizh --profile count how many times every instruction runs, and time calls.
+// Each function has one of these, which registers itself the first time the function is called.
+typedef struct {
+    // The instruction as vizh prints it, like ADD(3) or CALL(print)
+    const char* instruction;
+    // Where the instruction was drawn in the source image: x, y, width and height, or all -1 if we don't know
+    int32_t location[4];
+} vizh_profile_site_t;
 
+typedef struct vizh_profile_t {
+    const char* function;
+    // The path of the source image, or NULL
+    const char* source;
+    size_t n_sites;
+    const vizh_profile_site_t* sites;
+    // How many times each instruction ran, and the clock ticks spent in calls made by it
+    uint64_t* counts;
+    uint64_t* cycles;
+    uint64_t calls;
+    uint64_t total_cycles;
+    int registered;
+    struct vizh_profile_t* next;
+} vizh_profile_t;
 
+// The profile is written to the file named by the VIZH_PROFILE environment variable, or vizh-profile.json, at exit
+uint64_t vizh_profile_clock(void);
+// Called at the start and end of every profiled function
+uint64_t vizh_profile_enter(vizh_profile_t* profile);
+void vizh_profile_leave(vizh_profile_t* profile, uint64_t start);
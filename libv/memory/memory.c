@@ -1,47 +1,67 @@
 #include <string.h>
 #include <stdlib.h>
 #include <stdint.h>
+#include <stdio.h>
 #include "libv.h"
 
-void newtape(vizh_tapes_t* tapes) {    
-    // This is the first time we've allocated a new tape in this function
-    if (tapes->capacity == 0) {
-        // Initially allocate enough space for one additional pointer
-        tapes->capacity = tapes->n_tapes + 1;
-        uint8_t** new_tapes = (uint8_t**)malloc(sizeof(uint8_t*) * tapes->capacity);
-        memcpy(new_tapes, tapes->tapes, tapes->n_tapes * sizeof(uint8_t**));
-
-        tapes->tapes = new_tapes; 
-        tapes->tapes[tapes->n_tapes] = (uint8_t*)malloc(TAPE_SIZE);
-        memset(tapes->tapes[tapes->n_tapes], 0, TAPE_SIZE);
-
-        tapes->to_free = (uint8_t**)malloc(sizeof(uint8_t*) * tapes->capacity);
-        memset(tapes->to_free, NULL, tapes->n_tapes);
-        tapes->to_free[tapes->n_tapes] = tapes->tapes[tapes->n_tapes];
+static void out_of_memory(void) {
+    fputs("vizh: out of memory allocating tapes\n", stderr);
+    abort();
+}
 
-        ++tapes->n_tapes;
+static void grow_table(vizh_tapes_t* tapes) {
+    size_t capacity = tapes->capacity ? tapes->capacity * 2 : VIZH_INLINE_TAPES;
+    uint8_t** new_tapes;
+    uint8_t** new_to_free;
+    if (tapes->on_heap) {
+        new_tapes = (uint8_t**)realloc(tapes->tapes, capacity * sizeof(uint8_t*));
+        new_to_free = (uint8_t**)realloc(tapes->to_free, capacity * sizeof(uint8_t*));
     }
-
-    // Otherwise, if there's enough capacity, create a new tape
-    else if (tapes->n_tapes < tapes->capacity) {
-        tapes->tapes[tapes->n_tapes] = (uint8_t*)malloc(TAPE_SIZE);
-        memset(tapes->tapes[tapes->n_tapes], 0, TAPE_SIZE);
-        tapes->to_free[tapes->n_tapes] = tapes->tapes[tapes->n_tapes];
-        ++tapes->n_tapes;
+    else {
+        // The tables are still the arrays on the function's stack
+        new_tapes = (uint8_t**)malloc(capacity * sizeof(uint8_t*));
+        new_to_free = (uint8_t**)malloc(capacity * sizeof(uint8_t*));
+        if (new_tapes && new_to_free) {
+            memcpy(new_tapes, tapes->tapes, tapes->n_tapes * sizeof(uint8_t*));
+            if (tapes->to_free) {
+                memcpy(new_to_free, tapes->to_free, tapes->n_tapes * sizeof(uint8_t*));
+            }
+            else {
+                memset(new_to_free, 0, tapes->n_tapes * sizeof(uint8_t*));
+            }
+        }
+    }
+    if (!new_tapes || !new_to_free) {
+        out_of_memory();
     }
+    tapes->tapes = new_tapes;
+    tapes->to_free = new_to_free;
+    tapes->capacity = capacity;
+    tapes->on_heap = 1;
+}
 
-    // Otherwise double the capacity 
-    else {
-        tapes->capacity *= 2;
-        tapes->tapes = (uint8_t**)realloc(tapes->tapes, tapes->capacity * sizeof(uint8_t*));
-        tapes->tapes[tapes->n_tapes] = (uint8_t*)malloc(TAPE_SIZE);
-        memset(tapes->tapes[tapes->n_tapes], 0, TAPE_SIZE);
-        tapes->to_free[tapes->n_tapes] = tapes->tapes[tapes->n_tapes];
-        ++tapes->n_tapes;
+void newtape(vizh_tapes_t* tapes) {
+    if (tapes->n_tapes == tapes->capacity) {
+        grow_table(tapes);
     }
+    uint8_t* tape = vizh_alloc_tape();
+    tapes->tapes[tapes->n_tapes] = tape;
+    tapes->to_free[tapes->n_tapes] = tape;
+    ++tapes->n_tapes;
 }
 
 void freetape(vizh_tapes_t* tapes) {
     --tapes->n_tapes;
-    free(tapes->to_free[tapes->n_tapes]);
-}
\ No newline at end of file
+    // The function's arguments have nothing to free
+    if (tapes->to_free && tapes->to_free[tapes->n_tapes]) {
+        vizh_free_tape(tapes->to_free[tapes->n_tapes]);
+        tapes->to_free[tapes->n_tapes] = NULL;
+    }
+}
+
+void vizh_release_tapes(vizh_tapes_t* tapes) {
+    if (tapes->on_heap) {
+        free(tapes->tapes);
+        free(tapes->to_free);
+    }
+}
@@ -0,0 +1,5 @@
+#include <stddef.h>
+
+// Programs built with vizh --tape-size define this themselves, and
+// since it's alone in this file, the linker leaves this one out of them
+size_t vizh_compiled_tape_size = 0;
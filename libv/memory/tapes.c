@@ -0,0 +1,271 @@
+// Allocation of the tapes themselves.
+//
+// Every tape reserves vizh_tape_size() bytes of address space, with a guard
+// page either side so that running off either end faults rather than
+// scribbling over something else. The kernel only commits the pages of a
+// tape which are touched, and they start out zeroed.
+//
+// Freed tapes are kept on a free list for reuse, since functions which
+// allocate tapes tend to be called over and over. A reused tape has to be
+// zeroed again, which is done by giving its pages back to the kernel, so it
+// only costs as much as the pages the tape's last user touched.
+#if !defined(_WIN32)
+    // For MAP_ANONYMOUS, MAP_NORESERVE and MADV_DONTNEED
+    #define _DEFAULT_SOURCE
+    #define _DARWIN_C_SOURCE
+#endif
+#include <string.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <stdio.h>
+#include "libv.h"
+
+#if defined(_WIN32)
+    #include <windows.h>
+    #define VIZH_THREAD_LOCAL __declspec(thread)
+#else
+    #include <fcntl.h>
+    #include <sys/mman.h>
+    #include <sys/stat.h>
+    #include <unistd.h>
+    #ifndef MAP_ANONYMOUS
+        #define MAP_ANONYMOUS MAP_ANON
+    #endif
+    #ifndef MAP_NORESERVE
+        #define MAP_NORESERVE 0
+    #endif
+    #define VIZH_THREAD_LOCAL _Thread_local
+#endif
+
+// Defined in tape_size.c, unless the program was built with vizh --tape-size
+extern size_t vizh_compiled_tape_size;
+
+// Zero until the size is decided, which happens when it's first asked for
+static size_t tape_size = 0;
+
+static VIZH_THREAD_LOCAL uint8_t** free_tapes = NULL;
+static VIZH_THREAD_LOCAL size_t n_free_tapes = 0;
+static VIZH_THREAD_LOCAL size_t free_tapes_capacity = 0;
+
+static void out_of_memory(void) {
+    fputs("vizh: out of memory allocating tapes\n", stderr);
+    abort();
+}
+
+size_t vizh_parse_size(const char* text) {
+    char* end;
+    unsigned long long size = strtoull(text, &end, 10);
+    int shift = 0;
+    switch (*end) {
+        case 'k': case 'K': shift = 10; ++end; break;
+        case 'm': case 'M': shift = 20; ++end; break;
+        case 'g': case 'G': shift = 30; ++end; break;
+    }
+    if (end == text || *end != '\0' || size == 0 || size > (SIZE_MAX >> shift)) {
+        return 0;
+    }
+    return (size_t)size << shift;
+}
+
+size_t vizh_tape_size(void) {
+    if (tape_size == 0) {
+        const char* variable = getenv("VIZH_TAPE_SIZE");
+        size_t size = variable ? vizh_parse_size(variable) : 0;
+        if (variable && size == 0) {
+            fprintf(stderr, "vizh: ignoring VIZH_TAPE_SIZE=%s, which isn't a size\n", variable);
+        }
+        tape_size = size ? size : vizh_compiled_tape_size ? vizh_compiled_tape_size : TAPE_SIZE;
+    }
+    return tape_size;
+}
+
+void vizh_set_tape_size(size_t size) {
+    tape_size = size;
+}
+
+// Cached, since it's needed for every tape
+static size_t page = 0;
+
+static size_t page_size(void) {
+    if (page == 0) {
+#if defined(_WIN32)
+        SYSTEM_INFO info;
+        GetSystemInfo(&info);
+        page = info.dwPageSize;
+#else
+        page = (size_t)sysconf(_SC_PAGESIZE);
+#endif
+    }
+    return page;
+}
+
+// The size of the usable part of a tape, which is a whole number of pages
+static size_t usable_size(void) {
+    return (vizh_tape_size() + page_size() - 1) / page_size() * page_size();
+}
+
+#if defined(_WIN32)
+
+// Windows commits pages lazily too, and reusing a tape decommits it
+static uint8_t* map_tape(void) {
+    size_t size = usable_size();
+    uint8_t* region = (uint8_t*)VirtualAlloc(NULL, size + 2 * page_size(), MEM_RESERVE, PAGE_NOACCESS);
+    if (!region || !VirtualAlloc(region + page_size(), size, MEM_COMMIT, PAGE_READWRITE)) {
+        out_of_memory();
+    }
+    return region + page_size();
+}
+
+static void clear_tape(uint8_t* tape) {
+    size_t size = usable_size();
+    if (!VirtualFree(tape, size, MEM_DECOMMIT) || !VirtualAlloc(tape, size, MEM_COMMIT, PAGE_READWRITE)) {
+        out_of_memory();
+    }
+}
+
+#else
+
+static uint8_t* map_tape(void) {
+    size_t size = usable_size();
+    // MAP_NORESERVE so that the whole tape doesn't count against the memory the system will commit to
+    uint8_t* region = (uint8_t*)mmap(NULL, size + 2 * page_size(), PROT_READ | PROT_WRITE,
+                                     MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    if (region == (uint8_t*)MAP_FAILED ||
+        mprotect(region, page_size(), PROT_NONE) != 0 ||
+        mprotect(region + page_size() + size, page_size(), PROT_NONE) != 0) {
+        out_of_memory();
+    }
+    return region + page_size();
+}
+
+static void clear_tape(uint8_t* tape) {
+    size_t size = usable_size();
+#if defined(__linux__)
+    // Private anonymous pages read as zero after MADV_DONTNEED on Linux
+    if (madvise(tape, size, MADV_DONTNEED) != 0) {
+        out_of_memory();
+    }
+#else
+    if (mmap(tape, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE | MAP_FIXED, -1, 0) == MAP_FAILED) {
+        out_of_memory();
+    }
+#endif
+}
+
+#endif
+
+uint8_t* vizh_alloc_tape(void) {
+    if (n_free_tapes > 0) {
+        return free_tapes[--n_free_tapes];
+    }
+    return map_tape();
+}
+
+void vizh_free_tape(uint8_t* tape) {
+    clear_tape(tape);
+    if (n_free_tapes == free_tapes_capacity) {
+        free_tapes_capacity = free_tapes_capacity ? free_tapes_capacity * 2 : 16;
+        free_tapes = (uint8_t**)realloc(free_tapes, free_tapes_capacity * sizeof(uint8_t*));
+        if (!free_tapes) {
+            out_of_memory();
+        }
+    }
+    free_tapes[n_free_tapes++] = tape;
+}
+
+#if defined(_WIN32)
+
+// Windows can't map a file into part of a reservation, so the file is copied onto a tape instead
+typedef struct {
+    uint8_t* tape;
+    size_t size;
+    char* path;
+} written_back_t;
+
+static written_back_t* written_back = NULL;
+static size_t n_written_back = 0;
+
+static void write_back_files(void) {
+    for (size_t i = 0; i < n_written_back; ++i) {
+        FILE* file = fopen(written_back[i].path, "r+b");
+        if (!file || fwrite(written_back[i].tape, 1, written_back[i].size, file) != written_back[i].size) {
+            fprintf(stderr, "vizh: couldn't write the tape back to %s\n", written_back[i].path);
+        }
+        if (file) {
+            fclose(file);
+        }
+    }
+}
+
+uint8_t* vizh_map_file_tape(const char* path, int shared) {
+    FILE* file = fopen(path, "rb");
+    if (!file) {
+        return NULL;
+    }
+    fseek(file, 0, SEEK_END);
+    size_t size = (size_t)ftell(file);
+    fseek(file, 0, SEEK_SET);
+    if (size > vizh_tape_size()) {
+        vizh_set_tape_size(size);
+    }
+    uint8_t* tape = map_tape();
+    size_t read = fread(tape, 1, size, file);
+    fclose(file);
+    if (read != size) {
+        return NULL;
+    }
+
+    if (shared) {
+        if (n_written_back == 0) {
+            atexit(write_back_files);
+        }
+        written_back = (written_back_t*)realloc(written_back, (n_written_back + 1) * sizeof(written_back_t));
+        char* path_copy = _strdup(path);
+        if (!written_back || !path_copy) {
+            out_of_memory();
+        }
+        written_back[n_written_back++] = (written_back_t){ tape, size, path_copy };
+    }
+    return tape;
+}
+
+#else
+
+uint8_t* vizh_map_file_tape(const char* path, int shared) {
+    int fd = open(path, shared ? O_RDWR : O_RDONLY);
+    if (fd < 0) {
+        return NULL;
+    }
+    struct stat info;
+    if (fstat(fd, &info) != 0) {
+        close(fd);
+        return NULL;
+    }
+
+    // The tape is the file followed by zeroes, and is at least as long as any other tape
+    size_t file_size = (size_t)info.st_size;
+    size_t mapped_file_size = (file_size + page_size() - 1) / page_size() * page_size();
+    size_t size = mapped_file_size > usable_size() ? mapped_file_size : usable_size();
+    uint8_t* region = (uint8_t*)mmap(NULL, size + 2 * page_size(), PROT_NONE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+    if (region == (uint8_t*)MAP_FAILED) {
+        out_of_memory();
+    }
+    uint8_t* tape = region + page_size();
+
+    // Shared mappings write straight through to the file, private ones are copied on write.
+    // The rest of the file's last page reads as zero, and writes to it are never saved.
+    if (file_size > 0 && mmap(tape, file_size, PROT_READ | PROT_WRITE, (shared ? MAP_SHARED : MAP_PRIVATE) | MAP_FIXED, fd, 0) == MAP_FAILED) {
+        close(fd);
+        munmap(region, size + 2 * page_size());
+        return NULL;
+    }
+    close(fd);
+    if (size > mapped_file_size &&
+        mmap(tape + mapped_file_size, size - mapped_file_size, PROT_READ | PROT_WRITE,
+             MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE | MAP_FIXED, -1, 0) == MAP_FAILED) {
+        out_of_memory();
+    }
+    return tape;
+}
+
+#endif
@@ -0,0 +1,117 @@
+// Collection of the counts and timings of programs built with vizh --profile.
+//
+// The generated code counts every instruction as it runs, and times the calls
+// it makes, in arrays belonging to the function. Functions register themselves
+// the first time they're called, and the arrays of every registered function
+// are written out as JSON when the program exits, for vizh profile-report.
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <time.h>
+#include "libv.h"
+
+#if defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+    #include <intrin.h>
+    #define VIZH_HAVE_TSC 1
+#elif defined(__x86_64__) || defined(__i386__)
+    #include <x86intrin.h>
+    #define VIZH_HAVE_TSC 1
+#endif
+
+#define DEFAULT_PROFILE_FILE "vizh-profile.json"
+
+static vizh_profile_t* profiles = NULL;
+
+uint64_t vizh_profile_clock(void) {
+#if defined(VIZH_HAVE_TSC)
+    return __rdtsc();
+#else
+    struct timespec now;
+    timespec_get(&now, TIME_UTC);
+    return (uint64_t)now.tv_sec * 1000000000u + (uint64_t)now.tv_nsec;
+#endif
+}
+
+static void write_string(FILE* out, const char* text) {
+    if (text == NULL) {
+        fputs("null", out);
+        return;
+    }
+    fputc('"', out);
+    for (; *text; ++text) {
+        unsigned char c = (unsigned char)*text;
+        if (c == '"' || c == '\\') {
+            fprintf(out, "\\%c", c);
+        } else if (c < 0x20) {
+            fprintf(out, "\\u%04x", c);
+        } else {
+            fputc(c, out);
+        }
+    }
+    fputc('"', out);
+}
+
+static void write_profile(FILE* out, const vizh_profile_t* profile) {
+    fputs("{\"name\":", out);
+    write_string(out, profile->function);
+    fputs(",\"source\":", out);
+    write_string(out, profile->source);
+    fprintf(out, ",\"calls\":%llu,\"cycles\":%llu,\"sites\":[",
+            (unsigned long long)profile->calls, (unsigned long long)profile->total_cycles);
+    for (size_t i = 0; i < profile->n_sites; ++i) {
+        const vizh_profile_site_t* site = &profile->sites[i];
+        fputs(i == 0 ? "\n  {\"instruction\":" : ",\n  {\"instruction\":", out);
+        write_string(out, site->instruction);
+        if (site->location[2] < 0) {
+            fputs(",\"location\":null", out);
+        } else {
+            fprintf(out, ",\"location\":[%ld,%ld,%ld,%ld]", (long)site->location[0], (long)site->location[1],
+                    (long)site->location[2], (long)site->location[3]);
+        }
+        fprintf(out, ",\"count\":%llu,\"cycles\":%llu}",
+                (unsigned long long)profile->counts[i], (unsigned long long)profile->cycles[i]);
+    }
+    fputs("]}", out);
+}
+
+static void dump_profiles(void) {
+    const char* path = getenv("VIZH_PROFILE");
+    if (path == NULL || *path == '\0') {
+        path = DEFAULT_PROFILE_FILE;
+    }
+    FILE* out = fopen(path, "w");
+    if (out == NULL) {
+        fprintf(stderr, "vizh: couldn't write the profile to %s\n", path);
+        return;
+    }
+
+#if defined(VIZH_HAVE_TSC)
+    fputs("{\"version\":1,\"clock\":\"cycles\",\"functions\":[", out);
+#else
+    fputs("{\"version\":1,\"clock\":\"ns\",\"functions\":[", out);
+#endif
+    for (const vizh_profile_t* profile = profiles; profile != NULL; profile = profile->next) {
+        fputs(profile == profiles ? "\n" : ",\n", out);
+        write_profile(out, profile);
+    }
+    fputs("\n]}\n", out);
+    fclose(out);
+}
+
+uint64_t vizh_profile_enter(vizh_profile_t* profile) {
+    if (!profile->registered) {
+        // The first function to run sets up the dump. vizh programs only run on one thread.
+        if (profiles == NULL) {
+            atexit(dump_profiles);
+        }
+        profile->registered = 1;
+        profile->next = profiles;
+        profiles = profile;
+    }
+    ++profile->calls;
+    return vizh_profile_clock();
+}
+
+void vizh_profile_leave(vizh_profile_t* profile, uint64_t start) {
+    profile->total_cycles += vizh_profile_clock() - start;
+}
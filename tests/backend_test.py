@@ -1,6 +1,7 @@
 from vizh.ir import *
 from vizh.compiler import *
 from vizh.linker import *
+import vizh.build
 
 class BackendTest(object):
     def __init__(self, name):
@@ -11,6 +12,7 @@ class BackendTest(object):
 
     def compile_and_link(self):
         c = Compiler()
-        out = c.compile_functions([self.get_function()])[0]
-        l = Linker()
-        l.link([out], self.name, True)
\ No newline at end of file
+        with vizh.build.BuildDirectory() as build:
+            out = c.compile_functions([self.get_function()], build)
+            l = Linker()
+            l.link([out], self.name, True, build)
\ No newline at end of file
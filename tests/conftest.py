@@ -0,0 +1,54 @@
+import glob
+import os
+import shutil
+import subprocess
+import pytest
+
+LIBV_PATH = os.path.join(os.path.dirname(__file__), '..', 'libv')
+
+def build_runtime(directory, pic=False):
+    """Builds the parts of libv written in C into a static library in directory, along with crtv.
+
+    Returns (library, crtv object). The library is only built once per directory.
+    """
+    library = os.path.join(directory, 'libruntime.a')
+    crtv = os.path.join(directory, 'crtv.c.o')
+    if not os.path.exists(library):
+        os.makedirs(directory, exist_ok=True)
+        sources = glob.glob(os.path.join(LIBV_PATH, 'memory', '*.c')) + glob.glob(os.path.join(LIBV_PATH, 'profile', '*.c'))
+        objects = []
+        for source in sources + [os.path.join(LIBV_PATH, 'io', 'io.c'), os.path.join(LIBV_PATH, 'crtv.c')]:
+            objects.append(os.path.join(directory, os.path.basename(source) + '.o'))
+            subprocess.run(['cc', '-O1', *(['-fPIC'] if pic else []), '-I', LIBV_PATH, '-c', source, '-o', objects[-1]], check=True)
+        subprocess.run(['ar', 'rcs', library] + objects[:-1], check=True)
+    return library, crtv
+
+@pytest.fixture
+def needs_cc():
+    if shutil.which('cc') is None:
+        pytest.skip('No C compiler available')
+
+@pytest.fixture
+def needs_posix_cc(needs_cc):
+    if os.name == 'nt':
+        pytest.skip('Needs POSIX signals, pipes and shared objects')
+
+@pytest.fixture
+def build_program(tmp_path, needs_cc):
+    """Builds C into an executable linked with libv, returning its path.
+
+    Code generated for a vizh main needs crtv to start it. Code with a main of its own doesn't.
+    """
+    def build(name, code, crtv=True):
+        source = tmp_path / f'{name}.c'
+        source.write_text(code)
+        library, crtv_object = build_runtime(str(tmp_path / 'runtime'))
+        executable = str(tmp_path / name)
+        subprocess.run(['cc', '-O1', '-I', LIBV_PATH, str(source), *([crtv_object] if crtv else []), library, '-o', executable], check=True)
+        return executable
+    return build
+
+@pytest.fixture
+def pic_libv(tmp_path, needs_posix_cc):
+    """libv built position independent, since there's no installed libv to link shared libraries against"""
+    return build_runtime(str(tmp_path / 'runtime_pic'), pic=True)[0]
@@ -0,0 +1,118 @@
+"""IR factories, fakes and programs shared between the tests and benchmarks"""
+import os
+from vizh.ir import *
+
+def to_instructions(description):
+    """Makes instructions from a list of instruction types, or (type, value) tuples"""
+    return [Instruction(*inst) if type(inst) == tuple else Instruction(inst) for inst in description]
+
+def function(name, n_args, description):
+    return Function(FunctionSignature(name, n_args), to_instructions(description))
+
+def caller(name, n_args, *called):
+    """A function which increments its cell, then calls each of the functions named in called"""
+    return function(name, n_args, [InstructionType.INC] + [(InstructionType.CALL, f) for f in called])
+
+class FakeCompiler(object):
+    """Records which files it was asked to compile"""
+    compiler_type = 'fake'
+
+    def __init__(self):
+        self.compiled = []
+
+    def object_filenames(self, file_names, output_dir):
+        return [os.path.join(output_dir, os.path.basename(name) + '.o') for name in file_names]
+
+    def compile(self, file_names, output_dir, extra_postargs, include_dirs):
+        self.compiled += [os.path.basename(name) for name in file_names]
+        os.makedirs(output_dir, exist_ok=True)
+        objects = self.object_filenames(file_names, output_dir)
+        for name, object_name in zip(file_names, objects):
+            with open(name) as source, open(object_name, 'w') as object_file:
+                object_file.write('compiled ' + source.read())
+        return objects
+
+class FakeLinker(object):
+    """Links by listing the object files in the output"""
+    def __init__(self):
+        self.links = 0
+
+    def link(self, object_files, output_name, link_crtv=True, build=None):
+        self.links += 1
+        with open(output_name, 'w') as output:
+            output.write('\n'.join(object_files))
+
+class FakeOCR(object):
+    """Reads the given texts in order, one per image"""
+    def __init__(self, texts):
+        self.texts = list(texts)
+
+    def ocr(self, image):
+        return self.texts.pop(0)
+
+class FakeParser(object):
+    """Parses files containing JSON IR"""
+    def parse(self, file):
+        with open(file) as source:
+            return function_from_json(source.read())
+
+# Programs which both the optimizer and the interpreter are checked against
+LOOP_START, LOOP_END = InstructionType.LOOP_START, InstructionType.LOOP_END
+INC, DEC, LEFT, RIGHT = InstructionType.INC, InstructionType.DEC, InstructionType.LEFT, InstructionType.RIGHT
+UP, DOWN, READ, WRITE = InstructionType.UP, InstructionType.DOWN, InstructionType.READ, InstructionType.WRITE
+CALL = InstructionType.CALL
+
+# (description, number of tapes, idiom we expect to be recognised)
+# Instructions after the loops make head positions and the head storage observable.
+IDIOM_PROGRAMS = [
+    ([LOOP_START, DEC, LOOP_END, RIGHT, INC], 1, InstructionType.CLEAR),
+    ([LOOP_START, INC, INC, INC, LOOP_END, LEFT, DEC], 1, InstructionType.CLEAR),
+    ([LOOP_START, DEC, RIGHT, INC, INC, INC, LEFT, DOWN, LEFT, DEC, RIGHT, UP, LOOP_END, DOWN, INC], 2, InstructionType.MUL_ADD),
+    ([LOOP_START, INC, DOWN, DOWN, INC, INC, UP, RIGHT, DEC, LEFT, UP, LOOP_END], 3, InstructionType.MUL_ADD),
+    ([LOOP_START, DOWN, READ, DOWN, WRITE, RIGHT, UP, RIGHT, UP, DEC, LOOP_END, WRITE, DOWN, INC, DOWN, INC], 3, InstructionType.COPY),
+    ([LOOP_START, DEC, DOWN, DOWN, LEFT, READ, RIGHT, RIGHT, UP, RIGHT, WRITE, DOWN, UP, UP, LOOP_END, WRITE, DOWN, INC, DOWN, INC], 3, InstructionType.COPY),
+    ([RIGHT, LOOP_START, RIGHT, LOOP_END, INC], 1, InstructionType.SCAN),
+    ([LOOP_START, LEFT, LOOP_END, INC], 1, InstructionType.SCAN),
+    ([LOOP_START, RIGHT, RIGHT, DOWN, UP, LEFT, LOOP_END, DOWN, INC], 2, InstructionType.SCAN),
+]
+
+# (description, number of tapes) for programs which aren't idioms, to check tape tracking
+TAPE_TRACKING_PROGRAMS = [
+    # Straight line code over several tapes
+    ([INC, RIGHT, DOWN, READ, DOWN, WRITE, LEFT, LEFT, DEC, UP, UP, RIGHT, INC], 3),
+    # Moving above the first tape and back
+    ([UP, DOWN, INC, DOWN, UP, UP, DOWN, RIGHT, DEC], 2),
+    # Balanced loop which isn't an idiom, followed by code which uses heads moved in the loop
+    ([LOOP_START, DEC, READ, RIGHT, DOWN, WRITE, RIGHT, UP, LEFT, LOOP_END, DOWN, INC, UP, RIGHT, INC], 2),
+    # Nested balanced loops
+    ([RIGHT, LOOP_START, LEFT, LOOP_START, DEC, DOWN, INC, READ, UP, LOOP_END, RIGHT, RIGHT, LOOP_END, DOWN, WRITE, INC], 2),
+    # Loop which ends on a different tape than it started on, so the tape isn't known afterwards
+    ([LOOP_START, DEC, RIGHT, DOWN, LOOP_START, DEC, LOOP_END, LOOP_END, LEFT, INC, UP, RIGHT, INC], 2),
+    # Loop which allocates a tape every time round, followed by code which reads the first of them
+    ([LOOP_START, DEC, (CALL, 'newtape'), DOWN, INC, UP, LOOP_END, RIGHT, DOWN, READ, UP, WRITE], 1),
+    # Allocating loop on an allocated tape whose head moved before the loop
+    ([(CALL, 'newtape'), DOWN, INC, (CALL, 'newtape'), RIGHT, (CALL, 'newtape'), DOWN, DEC, RIGHT,
+      LOOP_START, LEFT, (CALL, 'newtape'), DEC, LOOP_END, LEFT, READ, UP, UP, RIGHT, WRITE], 1),
+    # Allocating and freeing in a loop which moves between tapes
+    ([LOOP_START, DEC, (CALL, 'newtape'), DOWN, DOWN, INC, READ, (CALL, 'freetape'), UP, WRITE, RIGHT, UP, LOOP_END, DOWN, INC], 2),
+]
+
+# Functions called by INLINING_PROGRAMS, which the optimizer may inline
+CALLEES = [
+    # Moves its heads and tapes, and uses the head storage
+    function('shuffle', 2, [INC, RIGHT, READ, DOWN, RIGHT, WRITE, INC, UP, UP, DOWN]),
+    # Contains a loop which doesn't end on the tape it started on
+    function('wander', 2, [LOOP_START, DEC, RIGHT, DOWN, LOOP_START, DEC, LOOP_END, LOOP_END, INC]),
+    # Calls another function
+    function('twice', 2, [(CALL, 'shuffle'), DOWN, RIGHT, UP, (CALL, 'shuffle')]),
+    function('recursive', 1, [LOOP_START, DEC, (CALL, 'recursive'), LOOP_END]),
+]
+
+# Instructions after the calls check the caller's heads and head storage are preserved
+INLINING_PROGRAMS = [
+    [READ, (CALL, 'shuffle'), WRITE, RIGHT, INC, DOWN, INC],
+    [DOWN, RIGHT, (CALL, 'wander'), INC, UP, INC, DOWN, READ, DOWN, WRITE],
+    [RIGHT, LOOP_START, LEFT, DOWN, (CALL, 'twice'), UP, RIGHT, RIGHT, LOOP_END, DOWN, INC],
+    [LOOP_START, DEC, DOWN, (CALL, 'wander'), UP, LOOP_END, DOWN, INC],
+    [(CALL, 'recursive'), RIGHT, INC],
+]
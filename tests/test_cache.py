@@ -0,0 +1,55 @@
+import os
+from vizh.ir import *
+import vizh.cache
+from tests.helpers import FakeCompiler
+
+def test_function_json_round_trip():
+    function = Function(FunctionSignature("memcopy", 3), [
+        Instruction(InstructionType.LOOP_START),
+        Instruction(InstructionType.CALL, "print"),
+        Instruction(InstructionType.LOOP_END)])
+    parsed = function_from_json(function_to_json(function))
+    assert str(parsed) == str(function)
+    assert repr(parsed.signature) == repr(function.signature)
+
+def test_parse_cache_keyed_by_image_and_config(tmp_path):
+    cache = vizh.cache.ParseCache(str(tmp_path))
+    function = Function(FunctionSignature("zero", 1), [Instruction(InstructionType.DEC)])
+    cache.put(b'image', 'config', function)
+    assert str(cache.get(b'image', 'config')) == str(function)
+    assert cache.get(b'image', 'other config') is None
+    assert cache.get(b'other image', 'config') is None
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = vizh.cache.DiskCache(str(tmp_path), max_size=250)
+    cache.put('a' * 64, b'x' * 100)
+    cache.put('b' * 64, b'x' * 100)
+    # Make 'a' the most recently used entry
+    os.utime(cache.path('b' * 64), (0, 0))
+    assert cache.get('a' * 64) is not None
+    cache.put('c' * 64, b'x' * 100)
+    assert cache.get('b' * 64) is None
+    assert cache.get('a' * 64) is not None
+    assert cache.get('c' * 64) is not None
+
+def test_object_cache_skips_the_compiler_on_a_hit(tmp_path):
+    import vizh.compiler
+    (tmp_path / 'header.h').write_text('#define X 1\n')
+    (tmp_path / 'a.c').write_text('#include "header.h"\nint a;\n')
+    (tmp_path / 'b.c').write_text('int b;\n')
+    sources = [str(tmp_path / 'a.c'), str(tmp_path / 'b.c')]
+    cache = vizh.cache.ObjectCache(str(tmp_path / 'cache'))
+    fake = FakeCompiler()
+    compiler = vizh.compiler.Compiler(fake, object_cache=cache)
+
+    objects = compiler.compile_c_programs(sources, str(tmp_path / 'first'))
+    assert fake.compiled == ['a.c', 'b.c']
+    assert compiler.compile_c_programs(sources, str(tmp_path / 'second'))[0].startswith(str(tmp_path / 'second'))
+    assert fake.compiled == ['a.c', 'b.c']
+    assert (tmp_path / 'second' / 'a.c.o').read_text() == (tmp_path / 'first' / 'a.c.o').read_text()
+    assert cache.stats() == '2 hits, 2 misses'
+
+    # Changing an included header invalidates the files which include it
+    (tmp_path / 'header.h').write_text('#define X 2\n')
+    compiler.compile_c_programs(sources, str(tmp_path / 'third'))
+    assert fake.compiled == ['a.c', 'b.c', 'a.c']
@@ -0,0 +1,283 @@
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import pytest
+from vizh.ir import *
+import vizh.build
+import vizh.cache
+import vizh.compiler
+import vizh.util
+from tests.helpers import function
+
+def functions(first_body):
+    return [
+        Function(FunctionSignature('first', 1), [Instruction(t) for t in first_body]),
+        Function(FunctionSignature('second', 2), [Instruction(InstructionType.DOWN), Instruction(InstructionType.CALL, 'first')]),
+    ]
+
+@pytest.mark.usefixtures('needs_cc')
+def test_split_units_only_recompile_changed_functions(tmp_path):
+    c_file = tmp_path / 'user.c'
+    c_file.write_text('int user_function(void) { return 1; }\n')
+    cache = vizh.cache.ObjectCache(str(tmp_path / 'cache'))
+    compiler = vizh.compiler.Compiler(object_cache=cache, jobs=4)
+    build = vizh.build.BuildDirectory(str(tmp_path / 'build'))
+
+    vizh_objects, c_objects = compiler.compile_function_units(functions([InstructionType.INC]), build, c_files=[str(c_file)])
+    assert [os.path.basename(name) for name in vizh_objects] == ['first.o', 'second.o']
+    assert [os.path.basename(name) for name in c_objects] == ['user.o']
+    assert all(os.path.exists(name) for name in vizh_objects + c_objects)
+    assert cache.stats() == '0 hits, 3 misses'
+
+    compiler.compile_function_units(functions([InstructionType.DEC]), build, c_files=[str(c_file)])
+    assert cache.stats() == '2 hits, 4 misses'
+
+def test_split_units_report_errors(tmp_path):
+    compiler = vizh.compiler.Compiler(jobs=4)
+    broken = [Function(FunctionSignature('broken', 1), [Instruction(InstructionType.CALL, 'missing')])]
+    with pytest.raises(vizh.compiler.CompilerError):
+        compiler.compile_function_units(broken, vizh.build.BuildDirectory(str(tmp_path / 'build')))
+
+@pytest.mark.usefixtures('needs_cc')
+def test_concurrent_compiles_keep_their_errors_apart(tmp_path):
+    compiler = vizh.compiler.Compiler()
+
+    def compile_one(n):
+        source = tmp_path / f'source{n}.c'
+        # Every third file has an error which names it
+        source.write_text(f'int value{n} = {n};\n' if n % 3 else f'int broken{n} = undeclared{n};\n')
+        try:
+            return compiler.compile_c_programs([str(source)], str(tmp_path / f'out{n}'))[0]
+        except vizh.compiler.CompilerError as err:
+            return err
+
+    with concurrent.futures.ThreadPoolExecutor(16) as pool:
+        results = list(pool.map(compile_one, range(48)))
+
+    for n, result in enumerate(results):
+        if n % 3:
+            assert os.path.exists(result)
+        else:
+            assert isinstance(result, vizh.compiler.CompilerError)
+            assert f'undeclared{n}' in str(result)
+            assert not any(f'source{other}.c' in str(result) for other in range(48) if other != n)
+
+def test_missing_c_compilers_are_reported(tmp_path):
+    compiler = vizh.compiler.Compiler()
+    compiler.c_compiler.compiler_so = ['no-such-cc']
+    source = tmp_path / 'source.c'
+    source.write_text('int value = 1;\n')
+    with pytest.raises(vizh.compiler.CompilerError, match='no-such-cc'):
+        compiler.compile_c_programs([str(source)], str(tmp_path / 'out'))
+
+def test_build_directory_is_removed_unless_kept(tmp_path):
+    with vizh.build.BuildDirectory() as build:
+        path = build.path
+        assert os.path.isdir(path)
+    assert not os.path.exists(path)
+
+    with vizh.build.BuildDirectory(keep=True) as build:
+        pass
+    assert os.path.isdir(build.path)
+    shutil.rmtree(build.path)
+
+    existing = str(tmp_path / 'existing')
+    with vizh.build.BuildDirectory(existing):
+        pass
+    assert os.path.isdir(existing)
+
+@pytest.mark.usefixtures('needs_cc')
+def test_piped_source_never_touches_disk(tmp_path):
+    cache = vizh.cache.ObjectCache(str(tmp_path / 'cache'))
+    compiler = vizh.compiler.Compiler(object_cache=cache, jobs=4, pipe_source=True)
+
+    with vizh.build.BuildDirectory() as build:
+        vizh_objects, _ = compiler.compile_function_units(functions([InstructionType.INC]), build)
+        assert vizh_objects == [build.object('first'), build.object('second')]
+        assert all(os.path.exists(name) for name in vizh_objects)
+        assert not any(name.endswith('.c') or name.endswith('.h') for _, _, names in os.walk(build.path) for name in names)
+
+        compiler.compile_function_units(functions([InstructionType.DEC]), build)
+        assert cache.stats() == '1 hits, 3 misses'
+
+        broken = [Function(FunctionSignature('broken', 1), [Instruction(InstructionType.CALL, 'missing')])]
+        with pytest.raises(vizh.compiler.CompilerError):
+            compiler.compile_functions(broken, build)
+
+TAPE_HARNESS = '''
+#include <stdio.h>
+#include "libv.h"
+void scratch(uint8_t*);
+
+int main() {
+  uint8_t tape[16] = {0};
+  for (int call = 0; call < 10000; ++call) {
+    scratch(tape);
+    if (tape[0] != 1) {
+      printf("dirty tape on call %d\\n", call);
+      return 1;
+    }
+  }
+  printf("ok\\n");
+  return 0;
+}
+'''
+
+def test_allocated_tapes_are_zeroed_and_reused(build_program):
+    # More tapes than fit in the function's own table, half of which are left for the epilogue to free
+    n_tapes = 3 * 4
+    # Writing far along the tapes touches pages past the first, which have to be zeroed again when they're reused
+    for opt_level, distance in [(0, 0), (1, 0), (1, 100000)]:
+        body = [Instruction(InstructionType.CALL, 'newtape')] * n_tapes + [Instruction(InstructionType.DOWN)] * n_tapes + \
+            [Instruction(InstructionType.MOVE_HEAD, distance), Instruction(InstructionType.INC), Instruction(InstructionType.READ)] + \
+            [Instruction(InstructionType.UP)] * n_tapes + [Instruction(InstructionType.WRITE)] + \
+            [Instruction(InstructionType.CALL, 'freetape')] * (n_tapes // 2)
+        code = vizh.compiler.Compiler(opt_level=opt_level).compile_functions_to_c([Function(FunctionSignature('scratch', 1), body)])
+        executable = build_program(f'scratch{opt_level}_{distance}', code + TAPE_HARNESS, crtv=False)
+        result = subprocess.run([executable], stdout=subprocess.PIPE, universal_newlines=True)
+        assert result.stdout == 'ok\n'
+
+def build_far_writer(build_program, distance, tape_size=None):
+    """Builds a program which prints an A it wrote distance cells along the primary tape"""
+    description = [(InstructionType.MOVE_HEAD, distance)] + [InstructionType.INC] * 65 + \
+        [InstructionType.READ, (InstructionType.MOVE_HEAD, -distance), InstructionType.WRITE, (InstructionType.CALL, 'print')]
+    main = function('main', 1, description)
+    code = vizh.compiler.Compiler(tape_size=tape_size).compile_functions_to_c([main], externs=[FunctionSignature('print', 1)])
+    return build_program(f'far{distance}_{tape_size}', code)
+
+def run_far_writer(executable, *args, env={}):
+    return subprocess.run([executable, *args], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, **env))
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_tapes_grow_and_are_guarded(build_program):
+    # Far past the first page of the default tape
+    result = run_far_writer(build_far_writer(build_program, 1000000))
+    assert result.returncode == 0 and result.stdout == b'A'
+
+    edge, past_edge = build_far_writer(build_program, 65535), build_far_writer(build_program, 65536)
+    assert run_far_writer(edge, '--vizh-tape-size=64K').stdout == b'A'
+    assert run_far_writer(past_edge, '--vizh-tape-size=64K').returncode < 0
+    assert run_far_writer(past_edge, env={'VIZH_TAPE_SIZE': '64K'}).returncode < 0
+    assert run_far_writer(past_edge, '--vizh-tape-size=nonsense').returncode == 2
+    assert run_far_writer(build_far_writer(build_program, 65536, tape_size=65536)).returncode < 0
+    # The flag beats the environment, which beats the size the program was built with
+    assert run_far_writer(past_edge, '--vizh-tape-size=1M', env={'VIZH_TAPE_SIZE': '64K'}).stdout == b'A'
+    assert run_far_writer(build_far_writer(build_program, 65536, tape_size=65536), env={'VIZH_TAPE_SIZE': '1M'}).stdout == b'A'
+    assert run_far_writer(build_far_writer(build_program, -1)).returncode < 0
+
+def test_parse_size():
+    assert [vizh.util.parse_size(text) for text in ['4096', '64K', '16m', '1G']] == [4096, 65536, 16 << 20, 1 << 30]
+    assert [vizh.util.parse_size(text) for text in ['', '0', '12Q', 'K', '-1']] == [None] * 5
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_files_can_be_mapped_as_tapes(tmp_path, build_program):
+    # Adds one to and prints every byte up to the first zero, on each of main's two tapes
+    shift = [InstructionType.LOOP_START, InstructionType.INC, (InstructionType.CALL, 'print'), InstructionType.RIGHT, InstructionType.LOOP_END]
+    description = shift + [InstructionType.DOWN] + shift
+    main = function('main', 2, description)
+    executable = build_program('shift', vizh.compiler.Compiler().compile_functions_to_c([main], externs=[FunctionSignature('print', 1)]))
+
+    first, second = tmp_path / 'first', tmp_path / 'second'
+    first.write_bytes(b'HAL')
+    # A whole page, so the zero after it comes from the rest of the tape rather than the file's last page
+    second.write_bytes(b'a' * 4096)
+
+    result = run_far_writer(executable, f'--vizh-tape={first}', f'--vizh-tape-rw={second}')
+    assert result.returncode == 0 and result.stdout == b'IBM' + b'b' * 4096
+    # Only the shared tape is written back
+    assert first.read_bytes() == b'HAL' and second.read_bytes() == b'b' * 4096
+
+    # Tapes without a file start out empty
+    assert run_far_writer(executable, f'--vizh-tape-rw={first}').stdout == b'IBM'
+    assert first.read_bytes() == b'IBM'
+    assert run_far_writer(executable, f'--vizh-tape={first}', f'--vizh-tape={first}', f'--vizh-tape={first}').returncode == 2
+    assert run_far_writer(executable, f'--vizh-tape={tmp_path / "missing"}').returncode == 2
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_bulk_io(build_program):
+    # Echoes a line, then reads four bytes after it and prints how many it got
+    description = [(InstructionType.CALL, 'readline'), (InstructionType.CALL, 'putstr')] + [InstructionType.RIGHT] * 8 + \
+        [InstructionType.INC] * 4 + [(InstructionType.CALL, 'readn')] + [InstructionType.INC] * 48 + [(InstructionType.CALL, 'print')]
+    main = function('main', 1, description)
+    externs = [FunctionSignature(name, 1) for name in ['readline', 'putstr', 'readn', 'print']]
+    executable = build_program('echo', vizh.compiler.Compiler().compile_functions_to_c([main], externs=externs))
+
+    assert subprocess.run([executable], input=b'hello\nworld', stdout=subprocess.PIPE).stdout == b'hello4'
+    assert subprocess.run([executable], input=b'hi\nyo', stdout=subprocess.PIPE).stdout == b'hi2'
+
+KERNEL_WRITE_HARNESS = r"""
+#include <stdio.h>
+#include <unistd.h>
+#include "libv.h"
+
+int main() {
+  int fds[2];
+  uint8_t* tape = vizh_alloc_tape();
+  if (pipe(fds) != 0 || write(fds[1], "abcd", 4) != 4) {
+    return 2;
+  }
+  /* Nothing in user space has touched this page of the tape */
+  ssize_t got = read(fds[0], tape + 100000, 4);
+  printf("%d %.4s\n", (int)got, (const char*)(tape + 100000));
+  return 0;
+}
+"""
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_the_kernel_can_write_anywhere_on_a_tape(build_program):
+    executable = build_program('kernel_write', KERNEL_WRITE_HARNESS, crtv=False)
+    assert subprocess.run([executable], stdout=subprocess.PIPE, universal_newlines=True).stdout == '4 abcd\n'
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_profiled_programs_count_instructions(tmp_path, build_program):
+    # main runs the loop 3 times, calling twice, which prints its cell twice. Small functions would
+    # be inlined at -O2, but profiling keeps them as calls.
+    main = Function(FunctionSignature('main', 1), [
+        Instruction(InstructionType.INC, location=(0, 50, 10, 10)),
+        Instruction(InstructionType.INC, location=(20, 50, 10, 10)),
+        Instruction(InstructionType.INC, location=(40, 50, 10, 10)),
+        Instruction(InstructionType.LOOP_START, location=(0, 80, 10, 30)),
+        Instruction(InstructionType.DEC, location=(20, 80, 10, 10)),
+        Instruction(InstructionType.CALL, 'twice', location=(40, 80, 20, 20)),
+        Instruction(InstructionType.LOOP_END, location=(70, 80, 10, 30)),
+    ], source=str(tmp_path / 'main "quoted".png'))
+    twice = Function(FunctionSignature('twice', 1), [Instruction(InstructionType.CALL, 'print'), Instruction(InstructionType.CALL, 'print')])
+    code = vizh.compiler.Compiler(opt_level=2, profile=True).compile_functions_to_c([main, twice], externs=[FunctionSignature('print', 1)])
+    executable = build_program('profiled', code)
+
+    profile_path = tmp_path / 'profile.json'
+    result = subprocess.run([executable], stdout=subprocess.PIPE, env=dict(os.environ, VIZH_PROFILE=str(profile_path)))
+    assert result.stdout == b'\x02\x02\x01\x01\x00\x00'
+    profile = json.loads(profile_path.read_text())
+    functions = {function['name']: function for function in profile['functions']}
+    assert set(functions) == {'main', 'twice'}
+
+    main_profile = functions['main']
+    assert main_profile['source'] == main.source
+    assert main_profile['calls'] == 1
+    assert [site['instruction'] for site in main_profile['sites']] == ['ADD(3)', 'LOOP_START', 'DEC', 'CALL(twice)', 'LOOP_END']
+    # The folded run covers all three INCs
+    assert main_profile['sites'][0]['location'] == [0, 50, 50, 10]
+    assert [site['count'] for site in main_profile['sites']] == [1, 1, 3, 3, 3]
+    assert main_profile['sites'][3]['cycles'] > 0
+    assert main_profile['sites'][2]['cycles'] == 0
+
+    assert functions['twice']['calls'] == 3
+    assert [site['count'] for site in functions['twice']['sites']] == [3, 3]
+    assert functions['twice']['sites'][0]['location'] is None
+
+@pytest.mark.usefixtures('needs_posix_cc')
+def test_allocating_loops_keep_heads_moved_before_them(build_program):
+    # The loop allocates, so the head of the loop tape is written back before it, after being moved
+    CALL, DOWN, RIGHT, LEFT, INC, DEC = (InstructionType.CALL, InstructionType.DOWN, InstructionType.RIGHT,
+                                         InstructionType.LEFT, InstructionType.INC, InstructionType.DEC)
+    description = [(CALL, 'newtape'), DOWN, INC, (CALL, 'newtape'), RIGHT, (CALL, 'newtape'), DOWN, DEC, RIGHT,
+                   InstructionType.LOOP_START, LEFT, (CALL, 'newtape'), DEC, InstructionType.LOOP_END,
+                   (CALL, 'print'), RIGHT, (CALL, 'print'), DOWN, (CALL, 'print')]
+    main = function('main', 1, description)
+    for opt_level in range(3):
+        code = vizh.compiler.Compiler(opt_level=opt_level).compile_functions_to_c([main], externs=[FunctionSignature('print', 1)])
+        executable = build_program(f'allocating{opt_level}', code)
+        assert subprocess.run([executable], stdout=subprocess.PIPE).stdout == b'\0\0\0'
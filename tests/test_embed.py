@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from vizh.ir import *
+import vizh.cache
+import vizh.embed
+import vizh.linker
+from tests.helpers import function
+
+pytestmark = pytest.mark.usefixtures('needs_posix_cc')
+
+T = InstructionType
+# Copies as many cells as the first tape says from the second tape to the third, like samples/memcopy
+MEMCOPY = function('memcopy', 3, [T.LOOP_START, T.DOWN, T.READ, T.RIGHT, T.DOWN, T.WRITE, T.RIGHT, T.UP, T.UP, T.DEC, T.LOOP_END])
+# Writes a cell it incremented on a tape from libv to its own tape
+SCRATCH = function('main', 1, [(T.CALL, 'newtape'), T.DOWN, T.INC, T.READ, T.UP, T.WRITE])
+
+class CountingLinker(vizh.linker.Linker):
+    def __init__(self, libv):
+        super().__init__(libv=libv)
+        self.links = 0
+
+    def link_shared(self, *args, **kwargs):
+        self.links += 1
+        return super().link_shared(*args, **kwargs)
+
+def load(tmp_path, functions, linker):
+    return vizh.embed.load(functions, object_cache=vizh.cache.ObjectCache(str(tmp_path / 'cache')), linker=linker)
+
+def test_functions_work_on_arrays_in_place(tmp_path, pic_libv):
+    with load(tmp_path, [MEMCOPY, SCRATCH], CountingLinker(pic_libv)) as library:
+        source = np.random.default_rng(0).integers(0, 256, 1 << 20, dtype=np.uint8)
+        destination = np.zeros(1 << 20, dtype=np.uint8)
+        size = np.array([200], dtype=np.uint8)
+        library.memcopy(size, source, destination)
+        assert size[0] == 0
+        assert np.array_equal(destination[:200], source[:200])
+        assert not destination[200:].any()
+
+        tape = bytearray(4)
+        library['main'](tape)
+        assert tape == bytearray([1, 0, 0, 0])
+
+def test_tapes_are_checked(tmp_path, pic_libv):
+    with load(tmp_path, [MEMCOPY], CountingLinker(pic_libv)) as library:
+        tape = np.zeros(8, dtype=np.uint8)
+        with pytest.raises(TypeError):
+            library.memcopy(tape, tape)
+        with pytest.raises(TypeError):
+            library.memcopy(tape, tape, bytes(8))
+        with pytest.raises(TypeError):
+            library.memcopy(tape, tape, np.zeros(8, dtype=np.int32))
+        with pytest.raises(AttributeError):
+            library.memmove
+
+def test_libraries_are_cached(tmp_path, pic_libv):
+    linker = CountingLinker(pic_libv)
+    load(tmp_path, [MEMCOPY], linker).close()
+    with load(tmp_path, [MEMCOPY], linker) as library:
+        assert linker.links == 1
+        # Views of buffers are passed without copying too
+        tape = bytearray([2, 0, 7, 8, 0, 0])
+        view = memoryview(tape)
+        library.memcopy(view, view[2:], view[4:])
+        assert tape == bytearray([0, 0, 7, 8, 7, 8])
+    load(tmp_path, [MEMCOPY, SCRATCH], linker).close()
+    assert linker.links == 2
+
+def test_missing_libv_is_reported(tmp_path):
+    with pytest.raises(vizh.embed.EmbedError):
+        load(tmp_path, [MEMCOPY], vizh.linker.Linker(libv=str(tmp_path / 'nowhere.a')))
@@ -0,0 +1,139 @@
+import io
+import random
+import numpy as np
+import pytest
+from vizh.ir import *
+import vizh.interp
+import vizh.optimizer
+from tests.helpers import to_instructions, function, IDIOM_PROGRAMS, TAPE_TRACKING_PROGRAMS, INLINING_PROGRAMS, CALLEES
+
+LOOP_START, LOOP_END = InstructionType.LOOP_START, InstructionType.LOOP_END
+INC, DEC, LEFT, RIGHT = InstructionType.INC, InstructionType.DEC, InstructionType.LEFT, InstructionType.RIGHT
+UP, DOWN, READ, WRITE = InstructionType.UP, InstructionType.DOWN, InstructionType.READ, InstructionType.WRITE
+CALL = InstructionType.CALL
+
+def run_main(description, stdin=b'', library=[], **kwargs):
+    stdout = io.BytesIO()
+    tape = vizh.interp.run([function('main', 1, description)], library, io.BytesIO(stdin), stdout, **kwargs)
+    return tape, stdout.getvalue()
+
+def test_print_and_readin():
+    _, output = run_main([INC] * 72 + [(CALL, 'print'), (CALL, 'readin'), (CALL, 'print'), (CALL, 'readin'), (CALL, 'print')], b'i')
+    # EOF reads as 255, like getchar
+    assert output == b'Hi\xff'
+
+def test_loops_and_calls():
+    # Copies the cell under the head to the next cell, through a function
+    double = function('double', 2, [LOOP_START, DEC, DOWN, INC, INC, UP, LOOP_END])
+    tape, _ = run_main([INC, INC, INC, (CALL, 'newtape'), (CALL, 'double'), DOWN, READ, UP, RIGHT, WRITE, DOWN, (CALL, 'freetape')],
+                       library=[double])
+    assert list(tape[:2]) == [0, 6]
+
+def test_main_gets_a_tape_for_each_argument():
+    stdout = io.BytesIO()
+    # Copies a cell from the first tape to the third, past a second tape which is left alone
+    main = function('main', 3, [INC, INC, READ, DOWN, DOWN, WRITE, (CALL, 'print'), UP, (CALL, 'print')])
+    tape = vizh.interp.run([main], [], io.BytesIO(), stdout)
+    assert tape[0] == 2
+    assert stdout.getvalue() == b'\x02\x00'
+
+def test_callee_heads_are_passed_by_value():
+    wander = function('wander', 1, [RIGHT, RIGHT, INC])
+    tape, _ = run_main([(CALL, 'wander'), INC], library=[wander])
+    assert list(tape[:3]) == [1, 0, 1]
+
+def test_step_limit():
+    with pytest.raises(vizh.interp.StepLimitExceeded):
+        run_main([INC, LOOP_START, LOOP_END], max_steps=1000)
+
+def test_errors():
+    with pytest.raises(vizh.interp.InterpreterError):
+        run_main([LEFT, INC])
+    with pytest.raises(vizh.interp.InterpreterError):
+        run_main([DOWN, INC])
+    with pytest.raises(vizh.interp.InterpreterError):
+        run_main([LOOP_START])
+    with pytest.raises(vizh.interp.InterpreterError):
+        run_main([(CALL, 'missing')])
+
+TAPE_LENGTH = 320
+HEAD_START = 32
+TRIALS = 5
+
+def random_tapes(rng, n_tapes):
+    tapes = [np.array([rng.randrange(256) for _ in range(TAPE_LENGTH)], dtype=np.uint8) for _ in range(n_tapes)]
+    for tape in tapes:
+        # Keep scans on the tape
+        tape[0] = tape[-1] = 0
+    return tapes
+
+def run_both(instructions, n_tapes, callees, opt_level, tapes, max_steps=None):
+    """Runs instructions unoptimized and at opt_level on copies of tapes.
+
+    Returns the results, which are the final tapes or the type of error raised.
+    """
+    results = []
+    for level in [0, opt_level]:
+        functions = vizh.optimizer.optimize([Function(FunctionSignature('f', n_tapes), instructions)], level, callees)
+        interpreter = vizh.interp.Interpreter(functions, callees, max_steps=max_steps)
+        copies = [tape.copy() for tape in tapes]
+        try:
+            interpreter.call('f', copies, [HEAD_START] * n_tapes)
+            results.append([list(tape) for tape in copies])
+        except vizh.interp.InterpreterError as err:
+            results.append(type(err))
+    return results
+
+@pytest.mark.parametrize('description,n_tapes', [(description, n_tapes) for description, n_tapes, _ in IDIOM_PROGRAMS] + TAPE_TRACKING_PROGRAMS)
+def test_optimized_programs_match(description, n_tapes):
+    rng = random.Random(1)
+    for _ in range(TRIALS):
+        reference, optimized = run_both(to_instructions(description), n_tapes, [], 1, random_tapes(rng, n_tapes))
+        assert reference == optimized
+
+@pytest.mark.parametrize('description', INLINING_PROGRAMS)
+def test_inlined_programs_match(description):
+    rng = random.Random(1)
+    for _ in range(TRIALS):
+        reference, optimized = run_both(to_instructions(description), 3, CALLEES, 2, random_tapes(rng, 3))
+        assert reference == optimized
+
+def random_program(rng, length):
+    """A random program with matched loops, which calls the test callees"""
+    choices = [INC, DEC, LEFT, RIGHT, UP, DOWN, READ, WRITE, INC, DEC, LEFT, RIGHT]
+    instructions = []
+    depth = 0
+    for _ in range(length):
+        roll = rng.random()
+        if roll < 0.1:
+            instructions.append(LOOP_START)
+            depth += 1
+        elif roll < 0.2 and depth > 0:
+            instructions.append(LOOP_END)
+            depth -= 1
+        elif roll < 0.25:
+            instructions.append((CALL, rng.choice(['shuffle', 'twice'])))
+        else:
+            instructions.append(rng.choice(choices))
+    return to_instructions(instructions + [LOOP_END] * depth)
+
+def test_random_programs_match():
+    rng = random.Random(2)
+    for _ in range(200):
+        instructions = random_program(rng, 30)
+        reference, optimized = run_both(instructions, 3, CALLEES, 2, random_tapes(rng, 3), max_steps=20000)
+        # Programs which don't finish in the reference may finish once optimized
+        if reference is not vizh.interp.StepLimitExceeded:
+            assert reference == optimized, '\n'.join(str(instruction) for instruction in instructions)
+
+def test_bulk_io():
+    # Reads a line and writes it back out, then reads four bytes after it
+    description = [(CALL, 'readline'), (CALL, 'putstr')] + [RIGHT] * 8 + [INC] * 4 + [(CALL, 'readn')]
+    tape, output = run_main(description, b'hello\nworld')
+    assert output == b'hello'
+    assert tape[:13].tobytes() == b'hello\0\0\0\x04worl'
+
+    _, output = run_main([(CALL, 'putstr')])
+    assert output == b''
+    with pytest.raises(vizh.interp.InterpreterError):
+        run_main([(CALL, 'readline')], b'x' * 64, tape_size=32)
@@ -0,0 +1,58 @@
+import os
+from vizh.ir import *
+import vizh.compiler
+import vizh.driver
+import vizh.manifest
+from tests.helpers import FakeCompiler, FakeLinker, caller
+
+def entries(functions):
+    manifest = vizh.manifest.BuildManifest('unused', 'config')
+    for f in functions:
+        manifest.record(f.signature.name, 'hash', None, f)
+    return manifest.functions()
+
+def test_functions_to_rebuild():
+    old = entries([caller('main', 1, 'middle'), caller('middle', 1, 'leaf'), caller('leaf', 1), caller('other', 1)])
+    # Changing a function's body only rebuilds that function
+    new = {f.signature.name: f for f in [caller('main', 1, 'middle'), caller('middle', 1, 'leaf'),
+                                         caller('leaf', 1, 'print'), caller('other', 1)]}
+    assert vizh.manifest.functions_to_rebuild(old, new, inline=False) == {'leaf'}
+    # Unless it might have been inlined
+    assert vizh.manifest.functions_to_rebuild(old, new, inline=True) == {'leaf', 'middle', 'main'}
+    # Changing its signature rebuilds its callers
+    new['leaf'] = caller('leaf', 2)
+    assert vizh.manifest.functions_to_rebuild(old, new, inline=False) == {'leaf', 'middle'}
+
+def test_incremental_builds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    images = {'main.png': caller('main', 1, 'helper'), 'helper.png': caller('helper', 1), 'other.png': caller('other', 1)}
+    for name in images:
+        (tmp_path / name).write_bytes(name.encode('utf-8'))
+    parsed = []
+    def parse(files):
+        parsed.extend(os.path.basename(file) for file in files)
+        return [images[os.path.basename(file)] for file in files]
+
+    fake = FakeCompiler()
+    compiler = vizh.compiler.Compiler(fake)
+    linker = FakeLinker()
+    build = lambda: vizh.driver.build_incrementally(compiler, linker, parse, list(images), [], [], 'a.out', quiet=True)
+
+    assert build() == 0
+    assert sorted(parsed) == ['helper.png', 'main.png', 'other.png']
+    assert sorted(fake.compiled) == ['helper.c', 'other.c', 'vizh_main.c']
+    assert linker.links == 1
+
+    # Nothing changed, so nothing is parsed, compiled or linked
+    parsed.clear()
+    fake.compiled.clear()
+    assert build() == 0
+    assert (parsed, fake.compiled, linker.links) == ([], [], 1)
+
+    # Changing the signature of helper rebuilds its caller
+    images['helper.png'] = caller('helper', 2)
+    (tmp_path / 'helper.png').write_bytes(b'changed')
+    assert build() == 0
+    assert parsed == ['helper.png']
+    assert sorted(fake.compiled) == ['helper.c', 'vizh_main.c']
+    assert linker.links == 2
@@ -0,0 +1,172 @@
+import subprocess
+import pytest
+from vizh.ir import *
+import vizh.compiler
+import vizh.optimizer
+from tests.helpers import *
+
+def to_strings(instructions):
+    return [str(instruction) for instruction in instructions]
+
+def test_fold_runs():
+    instructions = to_instructions(
+        [InstructionType.INC]*72 +
+        [InstructionType.DEC]*3 +
+        [InstructionType.RIGHT, InstructionType.RIGHT, InstructionType.LEFT] +
+        [InstructionType.DOWN]*2 +
+        [InstructionType.READ, InstructionType.UP, InstructionType.INC])
+    assert to_strings(vizh.optimizer.fold_runs(instructions)) == [
+        'ADD(69);', 'MOVE_HEAD(1);', 'MOVE_TAPE(2);', 'READ;', 'UP;', 'INC;']
+
+def test_fold_runs_wraps_and_drops_no_ops():
+    instructions = to_instructions(
+        [InstructionType.DEC]*2 +
+        [InstructionType.LOOP_START] +
+        [InstructionType.INC]*256 +
+        [InstructionType.LEFT, InstructionType.RIGHT] +
+        [InstructionType.LOOP_END])
+    assert to_strings(vizh.optimizer.fold_runs(instructions)) == ['ADD(254);', 'LOOP_START;', 'LOOP_END;']
+
+def test_optimization_levels():
+    function = Function(FunctionSignature("f", 1), to_instructions([InstructionType.INC]*3))
+    assert to_strings(vizh.optimizer.optimize([function], 0)[0].instructions) == ['INC;']*3
+    assert to_strings(vizh.optimizer.optimize([function], 1)[0].instructions) == ['ADD(3);']
+
+# Differential tests: the same program is compiled with and without optimizations,
+# run on the same random tapes, and the tapes compared afterwards
+
+TAPE_LENGTH = 320
+HEAD_START = 32
+TRIALS = 20
+
+HARNESS = '''
+#include <stdio.h>
+#include <string.h>
+#include "libv.h"
+
+void reference(%(parameters)s);
+void optimized(%(parameters)s);
+
+static uint8_t reference_tapes[%(n_tapes)d][TAPE_LENGTH];
+static uint8_t optimized_tapes[%(n_tapes)d][TAPE_LENGTH];
+
+int main() {
+  uint32_t seed = 1;
+  for (int trial = 0; trial < TRIALS; ++trial) {
+    for (int tape = 0; tape < %(n_tapes)d; ++tape) {
+      for (int i = 0; i < TAPE_LENGTH; ++i) {
+        seed = seed * 1103515245 + 12345;
+        reference_tapes[tape][i] = (seed >> 16) & 0xff;
+      }
+      /* Keep scans on the tape */
+      reference_tapes[tape][0] = reference_tapes[tape][TAPE_LENGTH - 1] = 0;
+    }
+    memcpy(optimized_tapes, reference_tapes, sizeof(reference_tapes));
+    reference(%(reference_arguments)s);
+    optimized(%(optimized_arguments)s);
+    if (memcmp(optimized_tapes, reference_tapes, sizeof(reference_tapes)) != 0) {
+      printf("mismatch in trial %%d\\n", trial);
+      return 1;
+    }
+  }
+  printf("ok\\n");
+  return 0;
+}
+'''
+
+def run_differential_test(build_program, instructions, n_tapes, callees=[], opt_level=1):
+    """Checks that instructions do the same thing at opt_level as they do unoptimized.
+
+    The unoptimized callees are linked in, and the optimizer may inline them.
+    """
+    reference = vizh.compiler.Compiler(opt_level=0).compile_functions_to_c(
+        [Function(FunctionSignature('reference', n_tapes), instructions)] + callees)
+    optimizing_compiler = vizh.compiler.Compiler(opt_level=opt_level)
+    optimizing_compiler.library = callees
+    optimized = optimizing_compiler.compile_functions_to_c(
+        [Function(FunctionSignature('optimized', n_tapes), instructions)],
+        externs=[callee.signature for callee in callees])
+    harness = HARNESS % {
+        'n_tapes': n_tapes,
+        'parameters': ', '.join(['uint8_t*'] * n_tapes),
+        'reference_arguments': ', '.join(f'reference_tapes[{n}] + HEAD_START' for n in range(n_tapes)),
+        'optimized_arguments': ', '.join(f'optimized_tapes[{n}] + HEAD_START' for n in range(n_tapes)),
+    }
+
+    # Linked with the real tapes from libv, so that allocating code is checked too
+    executable = build_program('differential', '\n'.join([
+        f'#define TAPE_LENGTH {TAPE_LENGTH}', f'#define HEAD_START {HEAD_START}', f'#define TRIALS {TRIALS}',
+        reference, optimized, harness]), crtv=False)
+    result = subprocess.run([executable], stdout=subprocess.PIPE, universal_newlines=True)
+    assert result.stdout == 'ok\n'
+
+@pytest.mark.parametrize('description,n_tapes,idiom', IDIOM_PROGRAMS)
+def test_loop_idioms_match_unoptimized_code(build_program, description, n_tapes, idiom):
+    instructions = to_instructions(description)
+    optimized = vizh.optimizer.optimize([Function(FunctionSignature('f', n_tapes), instructions)], 1)[0]
+    assert idiom in [instruction.type for instruction in optimized.instructions]
+    run_differential_test(build_program, instructions, n_tapes)
+
+def test_loops_which_are_not_idioms_are_kept():
+    instructions = to_instructions([
+        # Reads and writes on the loop tape
+        LOOP_START, DEC, READ, RIGHT, WRITE, LEFT, LOOP_END,
+        # Even step might never terminate
+        LOOP_START, INC, INC, LOOP_END,
+        # Calls
+        LOOP_START, DEC, (InstructionType.CALL, 'print'), LOOP_END,
+        # Ends on a different tape
+        LOOP_START, DEC, DOWN, LOOP_END])
+    assert to_strings(vizh.optimizer.lower_loop_idioms(instructions)) == to_strings(instructions)
+
+@pytest.mark.parametrize('description,n_tapes', TAPE_TRACKING_PROGRAMS)
+def test_tape_tracking_matches_unoptimized_code(build_program, description, n_tapes):
+    run_differential_test(build_program, to_instructions(description), n_tapes)
+
+def test_heads_are_kept_in_locals():
+    function = Function(FunctionSignature('f', 2), to_instructions([INC, DOWN, RIGHT, INC, UP, DEC]))
+    code = vizh.compiler.Compiler(opt_level=1).compile_function_to_c(function, {})
+    assert 'current_tape]' not in code
+    assert '++head1;' in code
+    unoptimized = vizh.compiler.Compiler(opt_level=0).compile_function_to_c(function, {})
+    assert 'head1' not in unoptimized
+
+@pytest.mark.parametrize('description', INLINING_PROGRAMS)
+def test_inlining_matches_unoptimized_code(build_program, description):
+    run_differential_test(build_program, to_instructions(description), 3, CALLEES, opt_level=2)
+
+def test_inliner_guards():
+    newtape = function('allocates', 1, [(CALL, 'newtape'), INC])
+    big = function('big', 1, [INC, RIGHT] * vizh.optimizer.MAX_INLINE_SIZE)
+    caller = function('caller', 1, [(CALL, 'recursive'), (CALL, 'allocates'), (CALL, 'big'), (CALL, 'shuffle')])
+    inlined = vizh.optimizer.inline_functions([caller], CALLEES + [newtape, big])[0]
+
+    calls = [instruction.value for instruction in inlined.instructions if instruction.type == CALL]
+    # recursive is inlined once into the caller, then calls itself
+    assert calls == ['recursive', 'allocates', 'big']
+    assert [instruction.type for instruction in inlined.instructions].count(InstructionType.INLINE_ENTER) == 2
+
+def test_inlining_only_from_o2():
+    caller = function('caller', 2, [(CALL, 'shuffle')])
+    for level, expected in [(1, [CALL]), (2, [InstructionType.INLINE_ENTER])]:
+        optimized = vizh.optimizer.optimize([caller], level, CALLEES)[0]
+        assert optimized.instructions[0].type in expected
+
+def test_optimized_instructions_cover_their_locations():
+    instructions = [
+        Instruction(InstructionType.INC, location=(0, 10, 10, 10)),
+        Instruction(InstructionType.INC, location=(20, 12, 10, 10)),
+        Instruction(InstructionType.LOOP_START, location=(0, 40, 5, 30)),
+        Instruction(InstructionType.DEC, location=(10, 40, 10, 10)),
+        Instruction(InstructionType.LOOP_END, location=(30, 40, 5, 30)),
+        Instruction(InstructionType.WRITE),
+    ]
+    function = vizh.optimizer.optimize([Function(FunctionSignature('f', 1), instructions, 'f.png')], 1)[0]
+    assert to_strings(function.instructions) == ['ADD(2);', 'CLEAR;', 'WRITE;']
+    assert [instruction.location for instruction in function.instructions] == [(0, 10, 30, 12), (0, 40, 35, 30), None]
+    assert function.source == 'f.png'
+
+    # Locations and the source survive serialisation
+    copy = function_from_json(function_to_json(function))
+    assert [instruction.location for instruction in copy.instructions] == [(0, 10, 30, 12), (0, 40, 35, 30), None]
+    assert copy.source == 'f.png'
@@ -0,0 +1,44 @@
+import os
+import pytest
+from vizh.ir import *
+import vizh.build
+import vizh.compiler
+import vizh.driver
+import vizh.pipeline
+from tests.helpers import FakeCompiler, FakeLinker, FakeParser, caller
+
+def init_fake_parse_worker(use_parse_cache, batch_ocr, use_templates, time_passes=False):
+    vizh.driver.worker_parser = FakeParser()
+
+@pytest.mark.parametrize('opt_level', [1, 2])
+def test_pipeline_builds_every_function(tmp_path, monkeypatch, opt_level):
+    monkeypatch.setattr(vizh.driver, 'init_parse_worker', init_fake_parse_worker)
+    images = []
+    # main calls a function which is parsed after it. At -O2 helper could be inlined,
+    # which would leave main calling leaf without knowing its signature.
+    for f in [caller('main', 1, 'helper'), caller('helper', 1, 'leaf'), caller('leaf', 1)]:
+        images.append(str(tmp_path / f'{f.signature.name}.json'))
+        with open(images[-1], 'w') as image:
+            image.write(function_to_json(f))
+    c_file = tmp_path / 'user.c'
+    c_file.write_text('int user;\n')
+
+    linker = FakeLinker()
+    output = str(tmp_path / 'a.out')
+    pipeline = vizh.pipeline.Pipeline(vizh.compiler.Compiler(FakeCompiler(), opt_level=opt_level), linker, 2,
+                                      vizh.build.BuildDirectory(str(tmp_path / 'build')))
+    assert pipeline.run(images, [str(c_file)], [], output)
+    assert linker.links == 1
+    with open(output) as linked:
+        objects = sorted(os.path.basename(name) for name in linked.read().split('\n'))
+    assert objects == ['helper.c.o', 'leaf.c.o', 'user.c.o', 'vizh_main.c.o']
+
+def test_pipeline_reports_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(vizh.driver, 'init_parse_worker', init_fake_parse_worker)
+    image = str(tmp_path / 'main.json')
+    with open(image, 'w') as source:
+        source.write(function_to_json(caller('main', 1, 'missing')))
+    linker = FakeLinker()
+    pipeline = vizh.pipeline.Pipeline(vizh.compiler.Compiler(FakeCompiler()), linker, 2, vizh.build.BuildDirectory(str(tmp_path / 'build')))
+    assert not pipeline.run([image], [], [], str(tmp_path / 'a.out'))
+    assert linker.links == 0
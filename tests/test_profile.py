@@ -0,0 +1,50 @@
+import json
+import cv2
+import numpy as np
+import vizh.profile
+
+def write_profile(tmp_path, source):
+    data = {'version': 1, 'clock': 'cycles', 'functions': [
+        {'name': 'main', 'source': source, 'calls': 1, 'cycles': 5000, 'sites': [
+            {'instruction': 'ADD(3)', 'location': [10, 60, 40, 20], 'count': 1, 'cycles': 0},
+            {'instruction': 'LOOP_START', 'location': [10, 100, 20, 40], 'count': 1, 'cycles': 0},
+            {'instruction': 'CALL(work)', 'location': [40, 100, 30, 30], 'count': 300, 'cycles': 4000},
+            {'instruction': 'LOOP_END', 'location': [80, 100, 20, 40], 'count': 300, 'cycles': 0},
+        ]},
+        {'name': 'work', 'source': None, 'calls': 300, 'cycles': 3900, 'sites': [
+            {'instruction': 'SCAN(1)', 'location': None, 'count': 300, 'cycles': 0},
+            {'instruction': 'INC', 'location': None, 'count': 50, 'cycles': 0},
+        ]},
+    ]}
+    path = tmp_path / 'profile.json'
+    path.write_text(json.dumps(data))
+    return vizh.profile.Profile.load(str(path))
+
+def test_table_lists_the_hottest_instructions(tmp_path):
+    profile = write_profile(tmp_path, None)
+    lines = vizh.profile.format_table(profile, 3).splitlines()
+    # Ties are broken by the time spent in calls
+    assert lines[1].split() == ['300', '31.5%', '4000', 'main', '2', 'CALL(work)', '(40,', '100)', '30x30']
+    assert lines[2].split()[:2] == ['300', '31.5%'] and lines[3].split()[:2] == ['300', '31.5%']
+    assert len(lines) == 8
+    # Then the functions, slowest first
+    assert lines[-2].split() == ['1', '5000', 'main']
+    assert lines[-1].split() == ['300', '3900', 'work']
+
+def test_heatmaps_are_drawn_over_the_source_image(tmp_path):
+    image_path = tmp_path / 'main.png'
+    cv2.imwrite(str(image_path), np.full((200, 200, 3), 255, np.uint8))
+    profile = write_profile(tmp_path, str(image_path))
+
+    assert vizh.profile.write_heatmaps(profile, str(tmp_path)) == [str(tmp_path / 'main.profile.png')]
+    heatmap = cv2.imread(str(tmp_path / 'main.profile.png'))
+    assert heatmap.shape == (200, 200, 3)
+    # The call ran more than the ADD, so it's hotter: redder and less blue
+    call = heatmap[115, 55].astype(int)
+    add = heatmap[70, 30].astype(int)
+    assert call[2] - call[0] > add[2] - add[0]
+    # Nothing is drawn far away from the instructions
+    assert (heatmap[190, 190] == 255).all()
+
+def test_format_count():
+    assert [vizh.profile.format_count(n) for n in [950, 1234, 12345, 3400000]] == ['950', '1.2k', '12k', '3.4M']
@@ -0,0 +1,66 @@
+import cv2
+import numpy as np
+from vizh.ir import *
+import vizh.cache
+import vizh.parser
+import vizh.render
+from vizh.recogniser import TemplateRecogniser, render_name
+from tests.helpers import FakeOCR
+
+NAMES = ['print', 'putstr', 'readin', 'newtape']
+
+def handwritten(name):
+    """Draws a name in a font unlike the one vizh.render uses"""
+    (width, height), baseline = cv2.getTextSize(name, cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, 1, 3)
+    img = np.full((height + baseline + 8, width + 8), 255, dtype=np.uint8)
+    cv2.putText(img, name, (4, height + 4), cv2.FONT_HERSHEY_SCRIPT_SIMPLEX, 1, 0, 3)
+    return img
+
+def test_rendered_names_are_recognised():
+    recogniser = TemplateRecogniser(NAMES)
+    for name in NAMES:
+        assert recogniser.recognise(render_name(name)) == name
+
+def test_unknown_names_are_rejected():
+    recogniser = TemplateRecogniser(NAMES)
+    assert recogniser.recognise(render_name('seekclosbr')) is None
+    assert recogniser.recognise(render_name('prints')) is None
+    assert recogniser.recognise(np.full((40, 100), 255, dtype=np.uint8)) is None
+    # Names drawn differently are left to the OCR
+    for name in NAMES:
+        assert recogniser.recognise(handwritten(name)) is None
+
+def test_learned_templates_last_until_forgotten():
+    recogniser = TemplateRecogniser(NAMES)
+    config = recogniser.config()
+    recogniser.learn('readin', handwritten('readin'))
+    assert recogniser.recognise(handwritten('readin')) == 'readin'
+    assert recogniser.recognise(handwritten('putstr')) is None
+    assert recogniser.config() == config
+
+    recogniser.forget()
+    assert recogniser.recognise(handwritten('readin')) is None
+    assert recogniser.recognise(render_name('readin')) == 'readin'
+
+def test_names_are_part_of_the_config():
+    assert TemplateRecogniser(NAMES).config() == TemplateRecogniser(reversed(NAMES)).config()
+    assert TemplateRecogniser(NAMES).config() != TemplateRecogniser(NAMES[1:]).config()
+    recogniser = TemplateRecogniser(NAMES)
+    config = recogniser.config()
+    recogniser.add_name('getbfch')
+    assert recogniser.config() == config
+
+def test_calls_to_added_names_are_not_cached(tmp_path):
+    cache = vizh.cache.ParseCache(str(tmp_path))
+    recogniser = TemplateRecogniser(NAMES)
+    # As if another image in the build defined getbfch
+    recogniser.add_name('getbfch')
+    for callee, cached in [('print', True), ('getbfch', False)]:
+        function = Function(FunctionSignature('main', 1), [Instruction(InstructionType.CALL, callee)])
+        path = str(tmp_path / f'{callee}.png')
+        cv2.imwrite(path, vizh.render.render(function))
+        parser = vizh.parser.Parser(cache, interactive=False, recogniser=recogniser)
+        parser._ocr = FakeOCR(['main', '1'])
+        assert str(parser.parse(path).instructions[0]) == str(function.instructions[0])
+        with open(path, 'rb') as image_file:
+            assert (cache.get(image_file.read(), parser.cache_config()) is not None) == cached
@@ -0,0 +1,44 @@
+import pytest
+from vizh.ir import *
+import vizh.parser
+import vizh.render
+from vizh.recogniser import TemplateRecogniser
+from tests.helpers import FakeOCR
+
+T = InstructionType
+DRAWABLE = [T.LEFT, T.RIGHT, T.UP, T.DOWN, T.READ, T.WRITE, T.INC, T.DEC, T.LOOP_START, T.LOOP_END]
+NAMES = ['print', 'seekclosbr', 'x']
+
+def round_trip(function, **render_options):
+    parser = vizh.parser.Parser(interactive=False, recogniser=TemplateRecogniser(NAMES))
+    parser._ocr = FakeOCR([function.signature.name, str(function.signature.n_args)])
+    return parser.parse_image(vizh.render.render(function, **render_options), 'rendered.png')
+
+def assert_round_trips(function, **render_options):
+    parsed = round_trip(function, **render_options)
+    assert parsed.signature.name == function.signature.name
+    assert parsed.signature.n_args == function.signature.n_args
+    assert [str(inst) for inst in parsed.instructions] == [str(inst) for inst in function.instructions]
+
+def test_every_shape_round_trips():
+    instructions = [Instruction(t) for t in DRAWABLE] + [Instruction(T.CALL, name) for name in NAMES]
+    assert_round_trips(Function(FunctionSignature('main', 1), instructions))
+
+def test_wrapped_lines_round_trip():
+    instructions = [Instruction(t) for t in DRAWABLE] * 6 + [Instruction(T.CALL, 'print')] * 4
+    renderer = vizh.render.Renderer(max_width=600)
+    assert len(renderer.layout(instructions)) > 3
+    assert_round_trips(Function(FunctionSignature('wrapped', 2), instructions), max_width=600)
+
+def test_larger_symbols_round_trip():
+    instructions = [Instruction(t) for t in DRAWABLE] + [Instruction(T.CALL, 'x')]
+    assert_round_trips(Function(FunctionSignature('large', 1), instructions), symbol_size=96)
+
+def test_symbols_too_small_to_parse_are_refused():
+    with pytest.raises(vizh.render.RenderError):
+        vizh.render.Renderer(symbol_size=vizh.render.MIN_SYMBOL_SIZE - 1)
+
+def test_optimized_instructions_cannot_be_drawn():
+    function = Function(FunctionSignature('main', 1), [Instruction(T.ADD, 3)])
+    with pytest.raises(vizh.render.RenderError):
+        vizh.render.render(function)
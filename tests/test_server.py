@@ -0,0 +1,55 @@
+import sys
+import threading
+import pytest
+import vizh.client
+import vizh.server
+
+def test_builds_are_forwarded_to_the_server(tmp_path, capsys):
+    socket_path = str(tmp_path / 'vizh.sock')
+    toolchain = vizh.server.Toolchain(preload=False)
+    server = vizh.server.BuildServer(socket_path, toolchain)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        assert vizh.client.forward(['--help'], socket_path) == 0
+        assert 'Usage: vizh' in capsys.readouterr().out
+
+        assert vizh.client.forward(['does_not_exist.png'], socket_path) == 2
+        assert 'does not exist' in capsys.readouterr().err
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+@pytest.mark.filterwarnings('error')
+def test_only_one_server_listens_on_a_socket(tmp_path):
+    socket_path = str(tmp_path / 'vizh.sock')
+    toolchain = vizh.server.Toolchain(preload=False)
+    server = vizh.server.BuildServer(socket_path, toolchain)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with pytest.raises(RuntimeError):
+            vizh.server.serve(socket_path, toolchain)
+        # The server still handles builds after being probed
+        assert vizh.client.forward(['--help'], socket_path) == 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+def test_no_server_running(tmp_path):
+    assert vizh.client.forward(['--help'], str(tmp_path / 'missing.sock')) is None
+
+@pytest.mark.usefixtures('needs_cc')
+def test_failed_builds_fail_with_or_without_a_server(tmp_path, monkeypatch):
+    (tmp_path / 'bad.c').write_text('int broken = undeclared;\n')
+    status, _, _ = vizh.server.run_build(None, ['bad.c'], str(tmp_path))
+    assert status == 255
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('VIZH_NO_SERVER', '1')
+    monkeypatch.setattr(sys, 'argv', ['vizh', 'bad.c'])
+    with pytest.raises(SystemExit) as exit:
+        vizh.client.main()
+    assert exit.value.code == status
@@ -0,0 +1,65 @@
+import json
+import pytest
+import vizh.driver
+import vizh.timing
+
+@pytest.fixture(autouse=True)
+def stop_timing():
+    yield
+    vizh.timing.stop()
+
+def test_phases_cost_nothing_when_timing_is_off():
+    assert vizh.timing.current is None
+    assert vizh.timing.phase('parser.parse', file='main.png') is vizh.timing.NO_PHASE
+    assert vizh.timing.take() is None
+
+def test_phases_are_broken_down_by_file():
+    vizh.timing.start()
+    for file in ['a.png', 'b.png']:
+        with vizh.timing.phase('parser.parse', file=file):
+            with vizh.timing.phase('parser.threshold'):
+                pass
+            with vizh.timing.phase('ocr.recognise', each=True, width=10, height=5):
+                pass
+    with vizh.timing.phase('linker.link'):
+        pass
+    timings = vizh.timing.stop()
+
+    assert {name: stats.calls for name, stats in timings.phases.items()} == \
+        {'parser.parse': 2, 'parser.threshold': 2, 'ocr.recognise': 2, 'linker.link': 1}
+    # Nested phases are counted against the file of the phase around them
+    assert sorted(timings.files['parser.threshold']) == ['a.png', 'b.png']
+    assert 'linker.link' not in timings.files
+    assert [(call['file'], call['width']) for call in timings.calls] == [('a.png', 10), ('b.png', 10)]
+    assert timings.wall >= timings.phases['parser.parse'].wall
+
+    table = vizh.timing.format_table(timings)
+    assert table.splitlines()[1].split()[:2] == ['linker.link', '1']
+    assert 'ocr.recognise' in table.split('Individual calls')[1]
+
+def test_worker_timings_are_merged():
+    vizh.timing.start()
+    with vizh.timing.phase('parser.parse', file='a.png'):
+        pass
+    # What a worker process would send back
+    worker = json.loads(json.dumps(vizh.timing.take()))
+    assert vizh.timing.current.phases == {}
+
+    vizh.timing.merge(worker)
+    vizh.timing.merge(worker)
+    timings = vizh.timing.stop()
+    assert timings.phases['parser.parse'].calls == 2
+    assert timings.files['parser.parse']['a.png'].calls == 2
+
+@pytest.mark.usefixtures('needs_cc')
+def test_time_passes_json(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'user.c').write_text('int user;\n')
+    vizh.driver.entry.main(['user.c', '-c', '-q', '--no-object-cache', '--time-passes-json', 'timings.json'], standalone_mode=False)
+
+    data = json.loads((tmp_path / 'timings.json').read_text())
+    assert data['version'] == vizh.timing.TIMING_VERSION
+    assert data['phases']['compiler.cc']['calls'] == 1
+    assert list(data['files']['compiler.cc']) == ['user.c']
+    assert 'driver.parse' in data['phases']
+    assert vizh.timing.current is None
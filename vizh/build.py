@@ -0,0 +1,43 @@
+import os
+import os.path
+import shutil
+import tempfile
+
+class BuildDirectory(object):
+    """Holds the intermediate files of a build: generated C and object files.
+
+    Files are named after what they're built from rather than randomly, so the
+    same build always produces the same paths. A build directory created here is
+    removed when the with block using it ends, unless keep is set. An existing
+    directory, like the one incremental builds keep between runs, is never removed.
+    """
+    def __init__(self, path=None, keep=False):
+        if path is None:
+            self.path = tempfile.mkdtemp(prefix='vizh-build-')
+            self.owned = not keep
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.path = path
+            self.owned = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def cleanup(self):
+        if self.owned:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def source(self, name):
+        """The path for a generated C file"""
+        return os.path.join(self.path, f'{name}.c')
+
+    def objects(self):
+        """The directory object files are compiled into"""
+        return os.path.join(self.path, 'objects')
+
+    def object(self, name):
+        """The path for an object compiled from C which never touched the disk"""
+        return os.path.join(self.objects(), f'{name}{".obj" if os.name == "nt" else ".o"}')
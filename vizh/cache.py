@@ -0,0 +1,228 @@
+import hashlib
+import os
+import os.path
+import re
+import shutil
+import sys
+import tempfile
+import vizh.ir
+
+# Parsed IR is tiny, so this holds many thousands of images
+DEFAULT_PARSE_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_OBJECT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Bump this if the way object cache keys are computed changes
+OBJECT_CACHE_VERSION = 1
+
+def default_cache_dir():
+    """The directory vizh keeps its caches in.
+
+    VIZH_CACHE_DIR overrides the platform default.
+    """
+    if 'VIZH_CACHE_DIR' in os.environ:
+        return os.environ['VIZH_CACHE_DIR']
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', tempfile.gettempdir())
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'vizh')
+
+def hash_key(*parts):
+    """Hash a sequence of bytes/str parts into a hex key.
+
+    Parts are length-prefixed so that ('ab', 'c') and ('a', 'bc') differ.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+class DiskCache(object):
+    """A directory of entries keyed by content hash with a size cap.
+
+    Least recently used entries are evicted once the total size exceeds max_size.
+    Recency is tracked through file modification times, which are bumped on every hit.
+    Entries are written to a temporary file and renamed into place, so several
+    processes can share a cache directory.
+    """
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.total_size = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns the bytes stored for key, or None"""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as entry:
+                data = entry.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as entry:
+            entry.write(data)
+        os.replace(tmp_path, path)
+
+        if self.total_size is not None:
+            self.total_size += len(data)
+        self.evict()
+
+    def entries(self):
+        """Yields (modification time, size, path) for every entry in the cache"""
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield (stat.st_mtime, stat.st_size, path)
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size"""
+        # Only scan the directory the first time we write and when we need to evict
+        if self.total_size is None:
+            self.total_size = sum(size for _, size, _ in self.entries())
+        if self.total_size <= self.max_size:
+            return
+
+        entries = sorted(self.entries())
+        self.total_size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                self.total_size -= size
+            except OSError:
+                pass
+
+class ParseCache(object):
+    """Caches the IR parsed from an image, keyed by the image's bytes.
+
+    config must describe everything else that influences the parse result,
+    like the parser version and thresholds, so that changing them invalidates old entries.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_PARSE_CACHE_SIZE):
+        directory = directory or os.path.join(default_cache_dir(), 'parse')
+        self.cache = DiskCache(directory, max_size)
+
+    def key(self, image_bytes, config):
+        return hash_key(image_bytes, config)
+
+    def get(self, image_bytes, config):
+        data = self.cache.get(self.key(image_bytes, config))
+        if data is None:
+            return None
+        try:
+            return vizh.ir.function_from_json(data.decode('utf-8'))
+        except (ValueError, KeyError):
+            # A corrupt entry is just a miss
+            return None
+
+    def put(self, image_bytes, config, function):
+        data = vizh.ir.function_to_json(function).encode('utf-8')
+        try:
+            self.cache.put(self.key(image_bytes, config), data)
+        except OSError:
+            # Failing to cache shouldn't fail the build
+            pass
+
+include_regex = re.compile(r'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+def hash_source(source_path, include_dirs, h, seen):
+    """Hashes a C file and every header it includes with quotes, which are the ones which can change
+    between builds. Headers included with angle brackets belong to the compiler.
+    """
+    with open(source_path, 'rb') as source:
+        hash_text(source.read(), os.path.dirname(source_path), include_dirs, h, seen)
+
+def hash_text(text, directory, include_dirs, h, seen):
+    """Like hash_source, for C code which is in memory. Quoted includes are looked up in directory first, if there is one."""
+    h.update(len(text).to_bytes(8, 'little'))
+    h.update(text)
+
+    for include in include_regex.findall(text.decode('utf-8', 'replace')):
+        # Quoted includes are looked up next to the file including them first
+        candidates = [os.path.join(directory, include) for directory in ([directory] if directory else []) + include_dirs]
+        found = next((path for path in candidates if os.path.isfile(path)), None)
+        # Headers which don't exist yet are part of the key too, since they might be
+        # conditionally included with __has_include once they do. Where they were found
+        # isn't, since builds happen in temporary directories.
+        h.update(f'{include}={found is not None}'.encode('utf-8'))
+        if found and os.path.abspath(found) not in seen:
+            seen.add(os.path.abspath(found))
+            hash_source(found, include_dirs, h, seen)
+
+def compiler_identity(c_compiler):
+    """Something which changes whenever the C compiler or its default flags do"""
+    command = getattr(c_compiler, 'compiler_so', None) or [c_compiler.compiler_type]
+    identity = [sys.platform] + list(command)
+    executable = shutil.which(command[0])
+    if executable:
+        stat = os.stat(executable)
+        identity += [os.path.realpath(executable), str(stat.st_size), str(stat.st_mtime_ns)]
+    return '\0'.join(identity)
+
+class ObjectCache(object):
+    """Caches object files compiled from C, like ccache.
+
+    Keys are computed from the source and its local headers rather than by
+    running the preprocessor, so a hit doesn't start the C compiler at all.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_OBJECT_CACHE_SIZE):
+        directory = directory or os.path.join(default_cache_dir(), 'objects')
+        self.cache = DiskCache(directory, max_size)
+
+    def key(self, source_path, include_dirs, flags, compiler):
+        h = hashlib.sha256()
+        hash_source(source_path, include_dirs, h, set())
+        return self.finish_key(h, include_dirs, flags, compiler)
+
+    def text_key(self, text, include_dirs, flags, compiler):
+        """The key for C code which is compiled from memory"""
+        h = hashlib.sha256()
+        hash_text(text.encode('utf-8'), None, include_dirs, h, set())
+        return self.finish_key(h, include_dirs, flags, compiler)
+
+    def finish_key(self, h, include_dirs, flags, compiler):
+        return hash_key(str(OBJECT_CACHE_VERSION), h.hexdigest(), compiler, '\0'.join(include_dirs), '\0'.join(flags))
+
+    def get(self, key, object_path):
+        """Writes the object stored for key to object_path, returning whether there was one"""
+        data = self.cache.get(key)
+        if data is None:
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(object_path)), exist_ok=True)
+        with open(object_path, 'wb') as object_file:
+            object_file.write(data)
+        return True
+
+    def put(self, key, object_path):
+        try:
+            with open(object_path, 'rb') as object_file:
+                self.cache.put(key, object_file.read())
+        except OSError:
+            # Failing to cache shouldn't fail the build
+            pass
+
+    def stats(self):
+        return f'{self.cache.hits} hits, {self.cache.misses} misses'
@@ -0,0 +1,95 @@
+"""The vizh command line entry point.
+
+If a compile server is running (see vizh.server), builds are forwarded to it
+so that they don't pay for loading OpenCV and Tesseract. This module is
+imported on every invocation, so it deliberately avoids importing the rest of vizh.
+"""
+import json
+import os
+import os.path
+import socket
+import sys
+
+# Arguments which have to be handled by a local process. Programs run with --run need our stdin.
+LOCAL_ONLY_ARGS = ['--server', '--no-server', '--debug-parser', '--run']
+
+def default_socket_path():
+    """Where the compile server listens. VIZH_SERVER_SOCKET overrides the default."""
+    if 'VIZH_SERVER_SOCKET' in os.environ:
+        return os.environ['VIZH_SERVER_SOCKET']
+    # Mirrors vizh.cache.default_cache_dir
+    if 'VIZH_CACHE_DIR' in os.environ:
+        cache_dir = os.environ['VIZH_CACHE_DIR']
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+        cache_dir = os.path.join(base, 'vizh')
+    return os.path.join(cache_dir, 'server.sock')
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+def receive_message(sock_file):
+    line = sock_file.readline()
+    if not line:
+        raise ConnectionError('Connection closed by the compile server')
+    return json.loads(line.decode('utf-8'))
+
+def connect(socket_path):
+    """Returns a socket connected to the compile server, or None if it isn't running"""
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # Stale socket left behind by a server which has gone away
+        sock.close()
+        return None
+    return sock
+
+def forward(args, socket_path=None):
+    """Runs a build on the compile server.
+
+    Returns the exit status, or None if there's no server to forward to.
+    """
+    sock = connect(socket_path or default_socket_path())
+    if sock is None:
+        return None
+
+    with sock, sock.makefile('rb') as sock_file:
+        send_message(sock, {'args': args, 'cwd': os.getcwd()})
+        reply = receive_message(sock_file)
+
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+def socket_path_from_args(args):
+    """Finds the value of --socket in the arguments, if it was given"""
+    for arg, value in zip(args, args[1:]):
+        if arg == '--socket':
+            return value
+    for arg in args:
+        if arg.startswith('--socket='):
+            return arg[len('--socket='):]
+    return None
+
+def main():
+    args = sys.argv[1:]
+    # Reports only read files, so there's nothing for the server to speed up
+    if args[:1] == ['profile-report']:
+        import vizh.profile
+        vizh.profile.report(args[1:], prog_name='vizh profile-report')
+
+    use_server = os.environ.get('VIZH_NO_SERVER') is None and not any(arg in LOCAL_ONLY_ARGS for arg in args)
+    if use_server:
+        try:
+            status = forward(args, socket_path_from_args(args))
+        except (OSError, ValueError):
+            status = None
+        if status is not None:
+            sys.exit(status)
+
+    # Exits with the same status the server would have given
+    import vizh.server
+    sys.exit(vizh.server.run_command_line(args))
@@ -1,21 +1,43 @@
 from vizh.ir import *
+import vizh.optimizer
+import vizh.cache
 import vizh.util
-import tempfile
+import vizh.build
+import vizh.timing
+import concurrent.futures
 import distutils.ccompiler 
+import distutils.errors
 import os.path
-import sys
 import os
 
 libv_decls = []
+libv_functions = []
 try:
     # This is generated when the package is built
-    # and contains declarations for libv
+    # and contains declarations for libv, and the IR
+    # of the libv functions written in vizh
     import vizh.libv_decls
     libv_decls = vizh.libv_decls.libv_decls
+    libv_functions = vizh.libv_decls.libv_functions
 except ImportError:
     # If we're compiling libv itself then it doesn't exist yet
     pass
 
+# The header shared by translation units from compile_function_units
+FUNCTIONS_HEADER_NAME = 'vizh_functions.h'
+
+def mangle(name):
+    """The C name of a vizh function. main is provided by crtv, which calls vizh_main."""
+    return 'vizh_main' if name == 'main' else name
+
+def unmangle(name):
+    return 'main' if name == 'vizh_main' else name
+
+def c_string(text):
+    """A C string literal for text"""
+    escaped = ''.join(f'\\{ord(c):03o}' if ord(c) < 0x20 or c in '"\\?' else c for c in text)
+    return f'"{escaped}"'
+
 class CompilerError(Exception):
     pass
 
@@ -34,10 +56,241 @@ class Labels(object):
     def pop_label(self):
         return self.stack.pop()
 
+TAPE_MOVES = {InstructionType.UP: -1, InstructionType.DOWN: 1}
+ALLOCATING_CALLS = ['newtape', 'freetape']
+
+def analyse_loops(instructions):
+    """For every loop, in order of their LOOP_START, works out (balanced, allocates).
+
+    A loop is balanced if every iteration ends on the tape it started on,
+    and it allocates if it creates or destroys tapes.
+    """
+    loops = []
+    # Each entry is [index into loops, net tape movement (None if unknown), allocates]
+    stack = []
+    # The depth of the loop stack and the movement of the innermost loop at every INLINE_ENTER
+    inlines = []
+    for instruction in instructions:
+        if instruction.type == InstructionType.INLINE_ENTER:
+            inlines.append((len(stack), stack[-1][1] if stack else 0))
+        elif instruction.type == InstructionType.INLINE_EXIT and inlines:
+            # Leaving inlined code puts us back on the tape we entered it on
+            depth, delta = inlines.pop()
+            if stack and len(stack) == depth:
+                stack[-1][1] = delta
+        elif instruction.type == InstructionType.LOOP_START:
+            stack.append([len(loops), 0, False])
+            loops.append(None)
+        elif instruction.type == InstructionType.LOOP_END and stack:
+            index, delta, allocates = stack.pop()
+            loops[index] = (delta == 0, allocates)
+            if stack:
+                # A loop which doesn't end where it started makes the enclosing loop unpredictable
+                if delta != 0:
+                    stack[-1][1] = None
+                stack[-1][2] = stack[-1][2] or allocates
+        elif stack:
+            if instruction.type in TAPE_MOVES and stack[-1][1] is not None:
+                stack[-1][1] += TAPE_MOVES[instruction.type]
+            elif instruction.type == InstructionType.MOVE_TAPE and stack[-1][1] is not None:
+                stack[-1][1] += instruction.value
+            elif instruction.type == InstructionType.CALL and instruction.value in ALLOCATING_CALLS:
+                stack[-1][2] = True
+    # Unterminated loops are unpredictable
+    return [loop or (False, True) for loop in loops]
+
+class Tapes(object):
+    """Keeps track of the tapes while generating code for a given function.
+
+    While the current tape is known at compile time (which it is at the start of
+    every function, through straight-line code, and through loops which end on the
+    tape they started on), the head of tape k is kept in a local variable headk rather
+    than accessed through vizh_tapes.tapes[current_tape], which the C compiler can't
+    keep in a register because of aliasing through uint8_t*. The local variables are
+    written back to vizh_tapes.tapes where something else may read them: before tapes
+    are allocated or freed, at loop boundaries, and when we lose track of the current tape.
+    After that, the generated code uses current_tape for the rest of the function.
+
+    Methods which return an expression may need some code to run first, which
+    is collected and handed out by take_pending.
+    """
+    def __init__(self, function, static):
+        self.n_args = function.signature.n_args
+        self.current = 0 if static else None
+        self.loops = analyse_loops(function.instructions)
+        self.next_loop = 0
+        # Each entry is the set of loaded heads at the start of the loop, or None if it's dynamic
+        self.loop_stack = []
+        # Heads whose local variable is up to date, and those where vizh_tapes.tapes is out of date
+        self.loaded = set(range(self.n_args))
+        self.dirty = set()
+        self.declared = set(range(self.n_args)) if static else set()
+        self.pending = []
+        # The current tape (None if it's dynamic) at every INLINE_ENTER
+        self.inline_stack = []
+
+    def is_static(self):
+        return self.current is not None
+
+    def take_pending(self):
+        code, self.pending = self.pending, []
+        return code
+
+    def head(self, offset=0):
+        """The head of the tape offset tapes below the current one"""
+        if not self.is_static():
+            if offset == 0:
+                return 'vizh_tapes.tapes[current_tape]'
+            if offset > 0:
+                return f'vizh_tapes.tapes[current_tape + {offset}]'
+            return f'vizh_tapes.tapes[current_tape - {-offset}]'
+
+        tape = self.current + offset
+        if tape < 0:
+            # Reading above the first tape is a bug in the program, but behave like we used to
+            return f'vizh_tapes.tapes[(size_t){tape}]'
+        if tape not in self.loaded:
+            self.pending.append(f'  head{tape} = vizh_tapes.tapes[{tape}];')
+            self.loaded.add(tape)
+            self.declared.add(tape)
+        return f'head{tape}'
+
+    def moved(self, offset=0):
+        """Record that the head of the tape offset tapes below the current one has moved"""
+        if self.is_static() and self.current + offset >= 0:
+            self.dirty.add(self.current + offset)
+
+    def write_back(self, tapes):
+        code = [f'  vizh_tapes.tapes[{tape}] = head{tape};' for tape in sorted(tapes & self.dirty)]
+        self.dirty -= tapes
+        return code
+
+    def go_dynamic(self):
+        """Stop tracking the current tape at compile time"""
+        if self.is_static():
+            self.pending += self.write_back(set(self.dirty))
+            self.pending.append(f'  current_tape = (size_t){self.current};')
+            self.current = None
+            self.loaded = set()
+
+    def move_tape(self, amount):
+        if self.is_static():
+            # Passing above the first tape on the way somewhere else is fine
+            self.current += amount
+            return []
+        return [add_assign('current_tape', amount)]
+
+    def allocate(self):
+        """Code to run before newtape or freetape, which may move or reuse the slots after the arguments"""
+        if not self.is_static():
+            return []
+        allocated = set(tape for tape in self.loaded if tape >= self.n_args)
+        self.loaded -= allocated
+        return self.write_back(allocated)
+
+    def loop_start(self):
+        """Code to run before the start label of a loop"""
+        balanced, allocates = self.loops[self.next_loop]
+        self.next_loop += 1
+
+        if self.is_static() and balanced:
+            # Both ways into the loop must agree on what's loaded, so everything is written back.
+            # The loop tape is loaded too, unless the loop allocates and it's one of the tapes which
+            # allocating unloads. Then the loop's condition loads it after the start label, every time round.
+            if allocates:
+                self.pending += self.allocate()
+            self.pending += self.write_back(set(self.dirty))
+            if not allocates:
+                self.head()
+            self.loop_stack.append(frozenset(self.loaded))
+        else:
+            self.go_dynamic()
+            self.loop_stack.append(None)
+        return self.take_pending()
+
+    def loop_end(self):
+        """Code to run before jumping back to the start of a loop"""
+        loaded_at_start = self.loop_stack.pop()
+        if loaded_at_start is None:
+            return []
+        code = self.write_back(set(self.dirty))
+        self.loaded = set(loaded_at_start)
+        return code
+
+    def inline_enter(self, n_args):
+        """Code to save everything an inlined function with n_args arguments could change"""
+        heads = [self.head(arg) for arg in range(n_args)]
+        code = self.take_pending()
+        code += ['  {', '  uint8_t saved_storage = head_storage;']
+        if not self.is_static():
+            code += ['  size_t saved_tape = current_tape;']
+        code += [f'  uint8_t* saved{arg} = {head};' for arg, head in enumerate(heads)]
+        code += ['  head_storage = 0;']
+        self.inline_stack.append(self.current)
+        return code
+
+    def inline_exit(self, n_args):
+        """Code to restore what was saved by the matching inline_enter"""
+        entry_tape = self.inline_stack.pop()
+        code = []
+        if entry_tape is None:
+            code += ['  current_tape = saved_tape;']
+        else:
+            # We know where we are again, even if we lost track of the current tape in the inlined code.
+            # go_dynamic wrote every head back, and only the ones we're about to restore have changed since.
+            self.current = entry_tape
+        for arg in range(n_args):
+            tape = self.current + arg if self.is_static() else None
+            if tape is not None and tape >= 0:
+                # The head is about to be overwritten, so there's no need to load it
+                self.loaded.add(tape)
+                self.declared.add(tape)
+            code += [f'  {self.head(arg)} = saved{arg};']
+            self.moved(arg)
+        code += ['  head_storage = saved_storage;', '  }']
+        return self.take_pending() + code
+
+    def declarations(self):
+        """Declarations of the local heads, to go after the prologue"""
+        return [f'  uint8_t* head{tape} = arg{tape};' if tape < self.n_args else f'  uint8_t* head{tape};'
+                for tape in sorted(self.declared)]
+
+def allocates_tapes(function):
+    return any(instruction.type == InstructionType.CALL and instruction.value == 'newtape' for instruction in function.instructions)
+
+def iteration_count(step, tapes):
+    """The number of times a loop which adds step to the current cell each iteration will run"""
+    if step == 255:
+        return f'*{tapes.head()}'
+    return f'(uint8_t)(-*{tapes.head()} * {vizh.optimizer.inverse_mod_256(step)})'
+
+def add_assign(lvalue, amount):
+    """Emits a statement adding amount to lvalue, subtracting for negative amounts"""
+    if amount < 0:
+        return f'  {lvalue} -= {-amount};'
+    return f'  {lvalue} += {amount};'
+
 class Compiler(object):
-    def __init__(self, c_compiler=None):
-        self.c_compiler = c_compiler or distutils.ccompiler.new_compiler()
-        pass
+    def __init__(self, c_compiler=None, opt_level=1, object_cache=None, jobs=1, pipe_source=False, tape_size=None, profile=False,
+                 position_independent=False):
+        """opt_level controls which vizh.optimizer passes run over the IR before generating C.
+        If object_cache is given, compiled objects are looked up there before running the C compiler.
+        Up to jobs C files are compiled at once. If pipe_source is set, generated C is fed to
+        the C compiler through its stdin rather than written to the build directory.
+        If tape_size is given, programs use tapes of that many bytes rather than libv's default.
+        If profile is set, the generated code counts the instructions it runs and times its calls (see emit_profile).
+        If position_independent is set, objects are compiled so they can be linked into shared libraries.
+        """
+        self.c_compiler = vizh.util.capture_output(c_compiler or distutils.ccompiler.new_compiler())
+        self.opt_level = opt_level
+        self.object_cache = object_cache
+        self.jobs = jobs
+        self.pipe_source = pipe_source
+        self.tape_size = tape_size
+        self.profile = profile
+        self.position_independent = position_independent
+        # The IR of functions which will be linked in later, which can be inlined from -O2
+        self.library = libv_functions
 
     def emit_prologue(self, function):
         """The prologue sets up the available tapes and read head for the function.
@@ -45,61 +298,178 @@ class Compiler(object):
         It looks like this:
 
         void getA(uint8_t* arg0) {
-           uint8_t* static_tapes[1] = {
-             arg0
-           };
-           vizh_tapes_t vizh_tapes;
-           vizh_tapes.tapes = static_tapes;
-           vizh_tapes.n_tapes = 1;
-           vizh_tapes.to_free = NULL;
-           vizh_tapes.capacity = 0;
+           uint8_t* static_tapes[1] = { arg0 };
+           vizh_tapes_t vizh_tapes = { 1, 1, static_tapes, NULL, 0 };
            size_t current_tape = 0;
            uint8_t head_storage = 0;
+
+        Functions which allocate tapes leave room for VIZH_INLINE_TAPES more in
+        static_tapes, and have a matching static_to_free, so the first few calls
+        to newtape don't need to grow the table.
         """
+        n_args = function.signature.n_args
+        arguments = ', '.join([f'arg{n}' for n in range(n_args)])
+        if not allocates_tapes(function):
+            return [
+                str(function.signature) + ' {',
+                f'  uint8_t* static_tapes[{n_args}] = {{ {arguments} }};',
+                f'  vizh_tapes_t vizh_tapes = {{ {n_args}, {n_args}, static_tapes, NULL, 0 }};',
+                '  size_t current_tape = 0;',
+                '  uint8_t head_storage = 0;',
+            ]
 
         return [
             str(function.signature) + ' {',
-            f'  uint8_t* static_tapes[{function.signature.n_args}] = {{ ',
-            '    ' + ', '.join([f'arg{n}' for n in range(function.signature.n_args)]),
-            '  };',
-            '  vizh_tapes_t vizh_tapes;',
-            '  vizh_tapes.tapes = static_tapes;',
-            f'  vizh_tapes.n_tapes = {function.signature.n_args}; ',
-            '  vizh_tapes.to_free = NULL;'
-            '  vizh_tapes.capacity = 0;',
+            f'  uint8_t* static_tapes[{n_args} + VIZH_INLINE_TAPES] = {{ {arguments or "NULL"} }};',
+            f'  uint8_t* static_to_free[{n_args} + VIZH_INLINE_TAPES] = {{ NULL }};',
+            f'  vizh_tapes_t vizh_tapes = {{ {n_args}, {n_args} + VIZH_INLINE_TAPES, static_tapes, static_to_free, 0 }};',
             '  size_t current_tape = 0;',
             '  uint8_t head_storage = 0;',
         ]
-        
 
     def emit_epilogue(self, function):
         """The epilogue tears down the function, deallocating any leftover tapes.
         """
+        if not allocates_tapes(function):
+            return ['}']
         return [
-            f'  for(size_t i = 0; i < vizh_tapes.n_tapes - {function.signature.n_args}; ++i) {{',
+            f'  while (vizh_tapes.n_tapes > {function.signature.n_args}) {{',
             '    freetape(&vizh_tapes);',
             '  }',
+            '  vizh_release_tapes(&vizh_tapes);',
+            '}',
+        ]
+
+    def emit_entry_point(self, function):
+        """crtv sets up the tapes for main, but doesn't know how many it takes, so it calls
+        vizh_main_entry with them in an array instead. The tape size the program was built with goes here too.
+        """
+        n_args = function.signature.n_args
+        code = [
+            f'const size_t vizh_main_n_tapes = {n_args};',
+            'void vizh_main_entry(uint8_t** tapes) {',
+            f'  {function.signature.name}(' + ', '.join([f'tapes[{n}]' for n in range(n_args)]) + ');',
             '}',
         ]
+        if self.tape_size is not None:
+            # libv picks this up instead of its own default
+            code.append(f'size_t vizh_compiled_tape_size = {self.tape_size};')
+        return code
+
+    def emit_profile(self, function):
+        """The counters for a function built with profiling, which go before it.
+
+        Every instruction has a count of how many times it ran, and a
+        count of the clock ticks spent in the calls it made. These are registered
+        with libv along with where each instruction was drawn, for vizh profile-report:
+
+        static uint64_t vizh_profile_counts_getA[2];
+        static uint64_t vizh_profile_cycles_getA[2];
+        static const vizh_profile_site_t vizh_profile_sites_getA[2] = {
+          { "ADD(65)", { 12, 80, 40, 40 } },
+          ...
+        };
+        static vizh_profile_t vizh_profile_getA = { "getA", "/path/to/getA.png", 2, ... };
+        """
+        name = function.signature.name
+        sites = [(str(instruction)[:-1], instruction.location or (-1, -1, -1, -1)) for instruction in function.instructions]
+        # C doesn't allow empty arrays
+        size = max(1, len(sites))
+        source = c_string(function.source) if function.source is not None else 'NULL'
+        code = [
+            f'static uint64_t vizh_profile_counts_{name}[{size}];',
+            f'static uint64_t vizh_profile_cycles_{name}[{size}];',
+            f'static const vizh_profile_site_t vizh_profile_sites_{name}[{size}] = {{',
+        ]
+        code += [f'  {{ {c_string(text)}, {{ {", ".join(str(n) for n in location)} }} }},' for text, location in sites]
+        code += [
+            '};',
+            f'static vizh_profile_t vizh_profile_{name} = {{ {c_string(unmangle(name))}, {source}, {len(sites)}, vizh_profile_sites_{name}, '
+            f'vizh_profile_counts_{name}, vizh_profile_cycles_{name}, 0, 0, 0, NULL }};',
+        ]
+        return code
+
+    def profile_instruction(self, name, index, instruction, code):
+        """Counts an instruction's code, and times it if it's a call"""
+        counter = f'  ++vizh_profile_counts_{name}[{index}];'
+        if instruction.type != InstructionType.CALL:
+            return [counter] + code
+        return [counter, '  {', '  uint64_t vizh_call_start = vizh_profile_clock();'] + code + \
+            [f'  vizh_profile_cycles_{name}[{index}] += vizh_profile_clock() - vizh_call_start;', '  }']
 
-    def emit_instruction(self, instruction, labels, signatures):
+    def emit_instruction(self, instruction, labels, signatures, tapes):
         code = []
         if instruction.type == InstructionType.LEFT:
-            code = ['  --vizh_tapes.tapes[current_tape];']
+            code = [f'  --{tapes.head()};']
+            tapes.moved()
         elif instruction.type == InstructionType.RIGHT:
-            code = ['  ++vizh_tapes.tapes[current_tape];']
+            code = [f'  ++{tapes.head()};']
+            tapes.moved()
         elif instruction.type == InstructionType.UP:
-            code = ['  --current_tape;']
+            code = tapes.move_tape(-1)
         elif instruction.type == InstructionType.DOWN:
-            code = ['  ++current_tape;']
+            code = tapes.move_tape(1)
         elif instruction.type == InstructionType.INC:
-            code = ['  ++*vizh_tapes.tapes[current_tape];']
+            code = [f'  ++*{tapes.head()};']
         elif instruction.type == InstructionType.DEC:
-            code = ['  --*vizh_tapes.tapes[current_tape];']
+            code = [f'  --*{tapes.head()};']
         elif instruction.type == InstructionType.READ:
-            code = ['  head_storage = *vizh_tapes.tapes[current_tape];']
+            code = [f'  head_storage = *{tapes.head()};']
         elif instruction.type == InstructionType.WRITE:
-            code = ['  *vizh_tapes.tapes[current_tape] = head_storage;']
+            code = [f'  *{tapes.head()} = head_storage;']
+
+        # Folded runs from the optimizer. Cells wrap, so adding 255 is the same as subtracting 1.
+        elif instruction.type == InstructionType.ADD:
+            amount = instruction.value - 256 if instruction.value > 128 else instruction.value
+            code = [add_assign(f'*{tapes.head()}', amount)]
+        elif instruction.type == InstructionType.MOVE_HEAD:
+            code = [add_assign(tapes.head(), instruction.value)]
+            tapes.moved()
+        elif instruction.type == InstructionType.MOVE_TAPE:
+            code = tapes.move_tape(instruction.value)
+
+        # Loop idioms from the optimizer
+        elif instruction.type == InstructionType.CLEAR:
+            code = [f'  *{tapes.head()} = 0;']
+        elif instruction.type == InstructionType.MUL_ADD:
+            step, targets = instruction.value
+            code = ['  {', f'    uint8_t n = {iteration_count(step, tapes)};']
+            code += [f'    {tapes.head(tape)}[{offset}] += (uint8_t)(n * {factor});' for tape, offset, factor in targets]
+            code += [f'    *{tapes.head()} = 0;', '  }']
+        elif instruction.type == InstructionType.SCAN:
+            head = tapes.head()
+            if instruction.value == 1:
+                code = [f'  {head} += strlen((const char*){head});']
+            else:
+                code = [f'  while (*{head}) {add_assign(head, instruction.value).strip()}']
+            tapes.moved()
+        elif instruction.type == InstructionType.COPY:
+            step, source_tape, source_offset, destination_tape, destination_offset = instruction.value
+            code = [
+                '  {',
+                f'    size_t n = {iteration_count(step, tapes)};',
+                f'    uint8_t* source = {tapes.head(source_tape)} + {source_offset};',
+                f'    uint8_t* destination = {tapes.head(destination_tape)} + {destination_offset};',
+                '    if (n != 0) {',
+                # The loop copies forwards a byte at a time, which only
+                # differs from memmove if the destination overlaps the end of the source
+                '      if (destination <= source || destination >= source + n) {',
+                '        head_storage = source[n - 1];',
+                '        memmove(destination, source, n);',
+                '      } else {',
+                '        for (size_t i = 0; i < n; ++i) {',
+                '          head_storage = source[i];',
+                '          destination[i] = head_storage;',
+                '        }',
+                '      }',
+                f'      {tapes.head(source_tape)} += n;',
+                f'      {tapes.head(destination_tape)} += n;',
+                '    }',
+                f'    *{tapes.head()} = 0;',
+                '  }',
+            ]
+            tapes.moved(source_tape)
+            tapes.moved(destination_tape)
 
         # Loops are implemented by outputting a start label
         # where the LOOP_START instruction is, then checking
@@ -107,34 +477,42 @@ class Compiler(object):
         # we jump to the end label for this loop.
         elif instruction.type == InstructionType.LOOP_START:
             new_label = labels.generate_label()
-            code = [
-                f'{new_label}_start:',
-                f'  if (*vizh_tapes.tapes[current_tape] == 0) goto {new_label}_end;'
-            ]
+            code = tapes.loop_start() + [f'{new_label}_start:']
+            condition = f'  if (*{tapes.head()} == 0) goto {new_label}_end;'
+            # The condition may need to load the loop tape, which has to happen on both ways into the loop
+            code += tapes.take_pending() + [condition]
         elif instruction.type == InstructionType.LOOP_END:
             label = labels.pop_label()
-            code = [
+            code = tapes.loop_end()
+            code += [
                 f'  goto {label}_start;',
                 f'{label}_end: ;'
             ]
 
+        # Inlined calls save and restore the caller's state
+        elif instruction.type == InstructionType.INLINE_ENTER:
+            code = tapes.inline_enter(instruction.value)
+        elif instruction.type == InstructionType.INLINE_EXIT:
+            code = tapes.inline_exit(instruction.value)
+
         # Function calls will fulfil arguments from the tape which
         # is currently active.
         elif instruction.type == InstructionType.CALL:
             # Creating or destroying tapes requires having access to our tapes
             if instruction.value == 'newtape':
-                code = ['  newtape(&vizh_tapes);']
+                code = tapes.allocate() + ['  newtape(&vizh_tapes);']
             elif instruction.value == 'freetape':
-                code = ['  freetape(&vizh_tapes);']
+                code = tapes.allocate() + ['  freetape(&vizh_tapes);']
             else:
                 if instruction.value not in signatures:
                     raise CompilerError(f'Unrecognised function call: {instruction.value}')
                 callee_signature = signatures[instruction.value]
                 code = [f'  {instruction.value}(']
-                code += [',\n'.join([f'    vizh_tapes.tapes[current_tape + {arg}]' for arg in range(callee_signature.n_args) ])] 
+                code += [',\n'.join([f'    {tapes.head(arg)}' for arg in range(callee_signature.n_args) ])] 
                 code += ['  );']
 
-        return (code, labels)
+        # Anything the tapes need to do first, like loading heads, goes before the instruction
+        return (tapes.take_pending() + code, labels)
         
     def compile_function_to_c(self, function, signatures):
         """Compiles the given IR to C.
@@ -143,75 +521,215 @@ class Compiler(object):
         must be present in signatures so that the code generator
         knows how many arguments to pass."""
 
-        code = []
-        code += self.emit_prologue(function)
+        body = []
         labels = Labels()
-        for instruction in function.instructions:
-            (new_code, new_labels) = self.emit_instruction(instruction, labels, signatures)
-            code += new_code
+        # Tracking the current tape at compile time is an optimization
+        tapes = Tapes(function, static=self.opt_level >= 1)
+        for index, instruction in enumerate(function.instructions):
+            (new_code, new_labels) = self.emit_instruction(instruction, labels, signatures, tapes)
+            if self.profile:
+                new_code = self.profile_instruction(function.signature.name, index, instruction, new_code)
+            body += new_code
             labels = new_labels
-        code += self.emit_epilogue(function)
+
+        name = function.signature.name
+        epilogue = self.emit_epilogue(function)
+        code = []
+        if self.profile:
+            code += self.emit_profile(function)
+        code += self.emit_prologue(function)
+        code += tapes.declarations()
+        if self.profile:
+            code += [f'  uint64_t vizh_profile_start = vizh_profile_enter(&vizh_profile_{name});']
+            epilogue = epilogue[:-1] + [f'  vizh_profile_leave(&vizh_profile_{name}, vizh_profile_start);'] + epilogue[-1:]
+        code += body
+        code += epilogue
         return '\n'.join(code)
 
-    def compile_functions_to_c(self, functions, externs=[]):
+    def generate_functions(self, functions, externs=[], library=None):
         """Compiles the given IR functions to C.
-        
-        Any functions which are called by these functions and
-        are not present (i.e. they'll be linked against later)
-        must have their signatures passed as externs.
+
+        Returns (header, [(function name, C code for the function)]), where
+        the header has the includes and forward declarations every function needs.
+        library overrides the functions which may be inlined (see Compiler.library).
         """
         # Mangle main function: real main is provided by libv
         for function in functions:
-            if function.signature.name == "main":
-                function.signature.name = "vizh_main"
+            function.signature.name = mangle(function.signature.name)
+
+        # Inlined code would be counted against the wrong image, so profiling keeps calls as calls
+        opt_level = min(self.opt_level, vizh.optimizer.INLINE_LEVEL - 1) if self.profile else self.opt_level
+        with vizh.timing.phase('compiler.optimize'):
+            functions = vizh.optimizer.optimize(functions, opt_level, self.library if library is None else library)
 
         signature_list = externs + [function.signature for function in functions]
         
-        # We need size_t and libv functions
-        code = ['#include <stddef.h>',
-                '#include "libv.h"']
+        # We need size_t, memmove/strlen for lowered loops, and libv functions
+        header = ['#include <stddef.h>',
+                  '#include <string.h>',
+                  '#include "libv.h"']
 
-        # First output forward declarations for all functions and externs
-        code += [f'{str(signature)};' for signature in signature_list]
+        # Forward declarations for all functions and externs
+        header += [f'{str(signature)};' for signature in signature_list]
 
         signature_list += libv_decls
         signatures = {signature.name: signature for signature in signature_list}
 
+        units = []
         errors = []
         for function in functions:
             try:
-                code.append(self.compile_function_to_c(function, signatures))
+                with vizh.timing.phase('compiler.codegen', file=function.signature.name):
+                    units.append((function.signature.name, self.compile_function_to_c(function, signatures)))
             except CompilerError as err:
                 errors.append((function.signature.name,err))
 
         if len(errors) > 0:
             messages = [f'Error while compiling {func_name}: {err}' for func_name, err in errors]
             raise CompilerError('\n'.join(messages))
+
+        # crtv calls main through its entry point, which goes in the same unit
+        entry_points = {function.signature.name: self.emit_entry_point(function) for function in functions
+                        if function.signature.name == mangle('main')}
+        units = [(name, '\n'.join([code] + entry_points.get(name, []))) for name, code in units]
+
+        return '\n'.join(header), units
+
+    def compile_functions_to_c(self, functions, externs=[], library=None):
+        """Compiles the given IR functions to C.
         
-        return '\n'.join(code)
+        Any functions which are called by these functions and
+        are not present (i.e. they'll be linked against later)
+        must have their signatures passed as externs.
+        """
+        header, units = self.generate_functions(functions, externs, library)
+        return '\n'.join([header] + [code for _, code in units])
 
-    def compile_functions(self, functions, externs=[]):
+    def compile_functions(self, functions, build, externs=[]):
+        """Compiles the given IR functions to a single object file in the vizh.build.BuildDirectory build"""
         code = self.compile_functions_to_c(functions, externs)
+        return self.compile_generated([('vizh', code)], build)[0][0]
 
-        # Write the C code out to a temporary file and compile it 
-        # to an object file with the system C compiler.
-        c_file_name = None
-        with tempfile.NamedTemporaryFile(suffix='.c', mode = "w", delete=False) as c_file:
-            c_file.write(code)
-            c_file_name = c_file.name
+    def compile_function_units(self, functions, build, externs=[], c_files=[], names=None):
+        """Compiles each of the given IR functions to its own object file.
 
-        return self.compile_c_programs([c_file_name], output_dir=os.path.dirname(c_file_name))[0]
+        The functions share a generated header with their declarations, so
+        with an object cache, changing one function only recompiles that function.
+        Any C files given are compiled alongside them, and the result is
+        (objects for the functions, objects for the C files).
 
-    def compile_c_programs(self, file_names, output_dir):
+        Everything is built in the vizh.build.BuildDirectory build. If names is
+        given, only the functions with those (mangled) names are compiled.
+        """
+        header, units = self.generate_functions(functions, externs)
+        units = [(name, code) for name, code in units if names is None or name in names]
+
+        if self.can_pipe_source():
+            # There's no file to include, so every unit gets its own copy of the header
+            return self.compile_generated([(name, f'{header}\n{code}') for name, code in units], build, c_files)
+
+        with open(os.path.join(build.path, FUNCTIONS_HEADER_NAME), 'w') as header_file:
+            header_file.write(header)
+        return self.compile_generated([(name, f'#include "{FUNCTIONS_HEADER_NAME}"\n{code}') for name, code in units], build, c_files)
+
+    def can_pipe_source(self):
+        # Reading source from stdin with -x c - is a gcc and clang feature
+        return self.pipe_source and self.c_compiler.compiler_type == 'unix'
+
+    def compile_generated(self, units, build, c_files=[]):
+        """Compiles generated C, given as (name, code) pairs, and any C files into build.
+
+        Returns (objects for the generated code, objects for the C files).
+        """
+        if not self.can_pipe_source():
+            for name, code in units:
+                with open(build.source(name), 'w') as c_file:
+                    c_file.write(code)
+            objects = self.compile_c_programs([build.source(name) for name, _ in units] + c_files, build.objects())
+            return objects[:len(units)], objects[len(units):]
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, self.jobs)) as pool:
+            compiles = [pool.submit(self.compile_piped, name, code, build) for name, code in units]
+            c_compile = pool.submit(self.compile_c_programs, c_files, build.objects())
+        errors = [str(compile.exception()) for compile in compiles + [c_compile] if compile.exception()]
+        if errors:
+            raise CompilerError('\n'.join(errors))
+        return [compile.result() for compile in compiles], c_compile.result()
+
+    def compile_piped(self, name, code, build):
+        """Compiles C code from memory by piping it to the C compiler"""
+        include_dirs, opt_args = self.c_options()
+        object_name = build.object(name)
+        os.makedirs(build.objects(), exist_ok=True)
+
+        key = None
+        if self.object_cache is not None:
+            with vizh.timing.phase('compiler.object_cache', file=name):
+                key = self.object_cache.text_key(code, include_dirs, opt_args, vizh.cache.compiler_identity(self.c_compiler))
+                hit = self.object_cache.get(key, object_name)
+            if hit:
+                return object_name
+
+        command = self.c_compiler.compiler_so + [f'-I{include_dir}' for include_dir in include_dirs] + \
+            opt_args + ['-x', 'c', '-c', '-', '-o', object_name]
+        try:
+            with vizh.timing.phase('compiler.cc', file=name):
+                vizh.util.run_captured(command, input=code)
+        except distutils.errors.DistutilsExecError as err:
+            raise CompilerError(f'{name}: {err}')
+
+        if key is not None:
+            self.object_cache.put(key, object_name)
+        return object_name
+
+    def c_options(self):
+        """The include directories and optimization flags C is compiled with"""
         # If we're compiling the standard library then the libv header is in ./libv, otherwise it's where this file is
         libv_header_path = 'libv' if libv_decls == [] else os.path.dirname(__file__)
+        if os.name == 'nt':
+            # Everything MSVC compiles can go in a DLL
+            return [libv_header_path], ['/O2']
+        return [libv_header_path], ['-O3', '-fPIC'] if self.position_independent else ['-O3']
 
-        err_log_name = os.path.join(tempfile.gettempdir(), next(tempfile._get_candidate_names()))
-        with vizh.util.stdchannel_redirected(sys.stdout, err_log_name) as err_file:
-            try:
-                opt_args = '/O2' if os.name == 'nt' else '-O3'
-                return self.c_compiler.compile(file_names, output_dir, extra_postargs=[opt_args], include_dirs=[libv_header_path])
-            except distutils.errors.CompileError:
-                err_file.seek(0)
-                err_log = err_file.read()
-                raise CompilerError(err_log)
\ No newline at end of file
+    def compile_c_programs(self, file_names, output_dir):
+        include_dirs, opt_args = self.c_options()
+
+        if self.object_cache is None:
+            return self.run_c_compiler(file_names, output_dir, include_dirs, opt_args)
+
+        # Only compile the files which aren't in the cache
+        object_names = self.c_compiler.object_filenames(file_names, output_dir=output_dir)
+        compiler = vizh.cache.compiler_identity(self.c_compiler)
+        misses = []
+        for file_name, object_name in zip(file_names, object_names):
+            with vizh.timing.phase('compiler.object_cache', file=file_name):
+                key = self.object_cache.key(file_name, include_dirs, opt_args, compiler)
+                hit = self.object_cache.get(key, object_name)
+            if not hit:
+                misses.append((file_name, object_name, key))
+
+        if misses:
+            self.run_c_compiler([file_name for file_name, _, _ in misses], output_dir, include_dirs, opt_args)
+            for _, object_name, key in misses:
+                self.object_cache.put(key, object_name)
+        return object_names
+
+    def run_c_compiler(self, file_names, output_dir, include_dirs, extra_args):
+        if not file_names:
+            return []
+        if self.jobs > 1 and len(file_names) > 1:
+            # The C compiler runs in a subprocess whose output is captured separately
+            # for every command, so threads are enough to compile in parallel
+            with concurrent.futures.ThreadPoolExecutor(min(self.jobs, len(file_names))) as pool:
+                compiles = [pool.submit(self.run_c_compiler, [file_name], output_dir, include_dirs, extra_args) for file_name in file_names]
+            errors = [str(compile.exception()) for compile in compiles if compile.exception()]
+            if errors:
+                raise CompilerError('\n'.join(errors))
+            return [compile.result()[0] for compile in compiles]
+
+        try:
+            # Parallel compiles come through here one file at a time
+            with vizh.timing.phase('compiler.cc', file=file_names[0] if len(file_names) == 1 else None):
+                return self.c_compiler.compile(file_names, output_dir, extra_postargs=extra_args, include_dirs=include_dirs)
+        except distutils.errors.CompileError as err:
+            raise CompilerError(str(err))
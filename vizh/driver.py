@@ -2,10 +2,25 @@ import click
 import vizh.parser
 import vizh.linker
 import vizh.compiler
+import vizh.cache
+import vizh.recogniser
+import vizh.server
+import vizh.interp
+import vizh.optimizer
+import vizh.manifest
+import vizh.ir
+import vizh.pipeline
+import vizh.build
+import vizh.util
+import vizh.timing
 import shutil
-import tempfile
 import sys
+import os
 import os.path
+import io
+import contextlib
+import multiprocessing
+import multiprocessing.util
 import cv2
 
 def find_if(l, pred):
@@ -29,11 +44,64 @@ def get_file_types(files):
 
     return object_files, c_source_files, vizh_source_files
 
-def parse_vizh_files(compiler, files, debug_parser):
+# Each worker process in a parallel parse keeps a single parser (and so a single
+# Tesseract instance) alive for all of the images it is given
+worker_parser = None
+
+def make_recogniser(use_templates):
+    return vizh.recogniser.TemplateRecogniser(vizh.recogniser.libv_names()) if use_templates else None
+
+def init_parse_worker(use_parse_cache, batch_ocr, use_templates, time_passes=False):
+    global worker_parser
+    if time_passes:
+        vizh.timing.start()
+    parse_cache = vizh.cache.ParseCache() if use_parse_cache else None
+    worker_parser = vizh.parser.Parser(parse_cache, interactive=False, batch_ocr=batch_ocr, recogniser=make_recogniser(use_templates))
+    # Release Tesseract when the worker shuts down
+    multiprocessing.util.Finalize(worker_parser, worker_parser.__exit__, args=(None, None, None), exitpriority=10)
+
+def parse_in_worker(file):
+    """Parse a file in a worker process, returning the function, any diagnostics printed,
+    and the worker's timings for vizh.timing.merge if it's timing phases
+    """
+    diagnostics = io.StringIO()
+    with contextlib.redirect_stdout(diagnostics):
+        func = worker_parser.parse(file)
+    return func, diagnostics.getvalue(), vizh.timing.take()
+
+def parse_vizh_files_in_parallel(files, use_parse_cache, batch_ocr, use_templates, jobs):
+    time_passes = vizh.timing.current is not None
+    with multiprocessing.Pool(jobs, init_parse_worker, (use_parse_cache, batch_ocr, use_templates, time_passes)) as pool:
+        # imap hands results back in input order
+        for func, diagnostics, timings in pool.imap(parse_in_worker, files, chunksize=1):
+            vizh.timing.merge(timings)
+            if diagnostics:
+                print(diagnostics, end='', file=sys.stdout)
+            yield func
+
+def parse_vizh_files(compiler, files, debug_parser, use_parse_cache=True, jobs=1, batch_ocr=False, use_templates=True, parser=None):
+    """Parses the given files, returning the functions or None if any failed to parse.
+
+    If parser is given then it is used for serial parsing rather than creating a new one.
+    """
     vizh_funcs = []
     had_error = False
+    jobs = jobs or os.cpu_count()
+
+    # Debugging the parser shows windows, which only makes sense one file at a time
+    if jobs > 1 and len(files) > 1 and not debug_parser:
+        for func in parse_vizh_files_in_parallel(files, use_parse_cache, batch_ocr, use_templates, min(jobs, len(files))):
+            if func:
+                vizh_funcs.append(func)
+            else:
+                had_error = True
+        return None if had_error else vizh_funcs
+
+    parse_cache = vizh.cache.ParseCache() if use_parse_cache else None
     
-    with vizh.parser.Parser() as parser:
+    with contextlib.ExitStack() as stack:
+        if parser is None:
+            parser = stack.enter_context(vizh.parser.Parser(parse_cache, batch_ocr=batch_ocr, recogniser=make_recogniser(use_templates)))
         for file in files:
             func = parser.parse(file, debug_parser)
             if func:
@@ -46,12 +114,12 @@ def parse_vizh_files(compiler, files, debug_parser):
     else:
         return vizh_funcs    
 
-def compile_c_files(compiler, files):
+def compile_c_files(compiler, files, build):
     object_files = []
     had_error = False
 
     try:
-        object_files = compiler.compile_c_programs(files, tempfile.gettempdir())
+        object_files = compiler.compile_c_programs(files, build.objects())
     except vizh.compiler.CompilerError as err:
         had_error = True
         print(f'C compiler reported an error in compiling {files}:\n{err}', file=sys.stderr)
@@ -61,6 +129,131 @@ def compile_c_files(compiler, files):
     else: 
         return object_files
 
+def run_vizh_functions(vizh_funcs, other_inputs, opt_level, max_steps, tape_size):
+    """Runs the parsed functions in the interpreter, which doesn't need a C compiler"""
+    if other_inputs:
+        print(f'Only vizh programs can be run with --run, not {other_inputs}', file=sys.stderr)
+        return -1
+    if vizh_funcs is None:
+        print("Compilation failed :(", file=sys.stderr)
+        return -1
+
+    library = vizh.compiler.libv_functions
+    vizh_funcs = vizh.optimizer.optimize(vizh_funcs, opt_level, library)
+    try:
+        vizh.interp.run(vizh_funcs, library, max_steps=max_steps, tape_size=tape_size or vizh.interp.TAPE_SIZE)
+    except vizh.interp.InterpreterError as err:
+        print(f'Error while running program: {err}', file=sys.stderr)
+        return -1
+    return 0
+
+def compile_function_units(compiler, vizh_funcs, c_source_files, build):
+    """Compiles a translation unit per vizh function together with the C files.
+
+    Returns (vizh objects, C objects), where either is None if compilation failed.
+    """
+    if vizh_funcs is None:
+        return None, compile_c_files(compiler, c_source_files, build)
+    try:
+        return compiler.compile_function_units(vizh_funcs, build, c_files=c_source_files)
+    except vizh.compiler.CompilerError as err:
+        print(f'C compiler reported an error in compiling {c_source_files} and the generated code:\n{err}', file=sys.stderr)
+        return None, None
+
+def copy_function(function):
+    """Compiling renames main, so this lets us keep the functions we record in a manifest as they were parsed"""
+    return vizh.ir.function_from_json(vizh.ir.function_to_json(function))
+
+def build_incrementally(compiler, linker, parse, vizh_source_files, c_source_files, supplied_object_files, output_file, quiet):
+    """Builds an executable, only redoing the work for inputs which changed since the last build of output_file.
+
+    parse is called with the images which need parsing, and returns their functions or None.
+    """
+    vizh_source_files = [os.path.abspath(path) for path in vizh_source_files]
+    c_source_files = [os.path.abspath(path) for path in c_source_files]
+    supplied_object_files = [os.path.abspath(path) for path in supplied_object_files]
+    output_file = os.path.abspath(output_file)
+
+    # The build directory is kept between builds
+    build = vizh.build.BuildDirectory(vizh.manifest.build_dir_for(output_file))
+    config = f'opt={compiler.opt_level};tape={compiler.tape_size};profile={compiler.profile};compiler={vizh.cache.compiler_identity(compiler.c_compiler)}'
+    old_manifest = vizh.manifest.BuildManifest(build.path, config).load()
+    new_manifest = vizh.manifest.BuildManifest(build.path, config)
+
+    hashes = {path: vizh.manifest.hash_file(path) for path in vizh_source_files + c_source_files + supplied_object_files}
+    stale_images = [path for path in vizh_source_files if not old_manifest.is_current(path, hashes[path])]
+    stale_c_files = [path for path in c_source_files if not old_manifest.is_current(path, hashes[path])]
+
+    with vizh.timing.phase('driver.parse'):
+        parsed = parse(stale_images)
+    if parsed is None:
+        print("Compilation failed :(", file=sys.stderr)
+        return -1
+    parsed = dict(zip(stale_images, parsed))
+    functions = {path: parsed[path] if path in parsed else old_manifest.function(path) for path in vizh_source_files}
+
+    inline = compiler.opt_level >= vizh.optimizer.INLINE_LEVEL
+    rebuild = vizh.manifest.functions_to_rebuild(old_manifest.functions(),
+                                                 {function.signature.name: function for function in functions.values()}, inline)
+    rebuild |= set(parsed[path].signature.name for path in stale_images)
+    rebuild = set(vizh.compiler.mangle(name) for name in rebuild)
+    rebuilt_names = [vizh.compiler.mangle(function.signature.name) for function in functions.values()
+                     if vizh.compiler.mangle(function.signature.name) in rebuild]
+
+    try:
+        with vizh.timing.phase('driver.compile'):
+            vizh_objects, c_objects = compiler.compile_function_units([copy_function(function) for function in functions.values()], build,
+                                                                      c_files=stale_c_files, names=rebuild)
+    except vizh.compiler.CompilerError as err:
+        print(f'C compiler reported an error:\n{err}', file=sys.stderr)
+        print("Compilation failed :(", file=sys.stderr)
+        return -1
+    vizh_objects = dict(zip(rebuilt_names, vizh_objects))
+    c_objects = dict(zip(stale_c_files, c_objects))
+
+    for path, function in functions.items():
+        name = vizh.compiler.mangle(function.signature.name)
+        object_file = vizh_objects[name] if name in vizh_objects else old_manifest.entries[path]['object']
+        new_manifest.record(path, hashes[path], object_file, function)
+    for path in c_source_files:
+        new_manifest.record(path, hashes[path], c_objects[path] if path in c_objects else old_manifest.entries[path]['object'])
+    for path in supplied_object_files:
+        new_manifest.record(path, hashes[path], None)
+    new_manifest.output = output_file
+
+    if new_manifest.entries == old_manifest.entries and old_manifest.output == output_file and os.path.exists(output_file):
+        if not quiet:
+            print(output_file, 'is up to date')
+        return 0
+
+    object_files = supplied_object_files + [new_manifest.entries[path]['object'] for path in c_source_files + vizh_source_files]
+    link_crtv = any(function.signature.name == 'main' for function in functions.values())
+    try:
+        linker.link(object_files, output_file, link_crtv, build)
+    except vizh.linker.LinkerError as err:
+        print(f'C compiler reported an error in linking:\n{err}', file=sys.stderr)
+        return -1
+    new_manifest.save()
+
+    if not quiet:
+        print(f'Rebuilt {len(rebuilt_names)} of {len(functions)} functions and {len(stale_c_files)} of {len(c_source_files)} C files')
+        print(vizh_source_files + c_source_files + supplied_object_files, '->', output_file)
+    return 0
+
+def make_build_directory(keep, quiet):
+    build = vizh.build.BuildDirectory(keep=keep)
+    if keep and not quiet:
+        print('Build directory:', build.path)
+    return build
+
+def parse_tape_size(ctx, param, value):
+    if value is None:
+        return None
+    size = vizh.util.parse_size(value)
+    if size is None:
+        raise click.BadParameter(f'{value} is not a size like 4096, 64K or 16M')
+    return size
+
 def get_default_output_file(compile_only, vizh_functions):
     """Get the default object file, which is:
     - a.exe/a.out if linking an executable,
@@ -79,63 +272,158 @@ def get_default_output_file(compile_only, vizh_functions):
     else:
         return 'a.exe' if os.name == 'nt' else 'a.out'
 
-@click.command()
-@click.version_option()
-@click.argument('inputs', nargs=-1, type=click.Path(exists=True))
-@click.option('-c', '--compile-only', 'compile_only', is_flag=True, help="Only compile, don't link.")
-@click.option('-o', '--output-file', 'output_file', type=click.Path(), default=None, help="Output file for executables or vizh object files.")
-@click.option('-q', '--quiet', is_flag=True, help="Suppress output.")
-@click.option('--debug-parser', 'debug_parser', is_flag=True, help="Display how the parser understands your source file.")
-def entry(inputs, compile_only, output_file, quiet, debug_parser):
+def report_timings(timings, time_passes, time_passes_json):
+    if time_passes:
+        print(vizh.timing.format_table(timings), file=sys.stderr)
+    if time_passes_json:
+        timings.write_json(time_passes_json)
+
+def build_program(toolchain, inputs, compile_only, output_file, quiet, debug_parser, no_parse_cache, no_object_cache, cache_stats, jobs, incremental, pipeline, split_units, pipe_c, keep_build_dir, batch_ocr, no_name_templates, opt_level, tape_size, profile, run, max_steps):
+    """Does everything entry does other than running a server"""
     supplied_object_files, c_source_files, vizh_source_files = get_file_types(inputs)
-    compiler = vizh.compiler.Compiler()
-    
-    vizh_funcs = parse_vizh_files(compiler, vizh_source_files, debug_parser)
-    vizh_object_file = None
-    try:
-        vizh_object_file = compiler.compile_functions(vizh_funcs) if vizh_funcs else None
-    except vizh.compiler.CompilerError as err:
-        print(err)
-        return -1
 
-    c_object_files = compile_c_files(compiler, c_source_files)
+    # When running in a compile server, the toolchain is already loaded
+    compiler = toolchain.compiler if toolchain else vizh.compiler.Compiler()
+    compiler.opt_level = opt_level
+    compiler.jobs = jobs or os.cpu_count()
+    compiler.pipe_source = pipe_c
+    compiler.tape_size = tape_size
+    compiler.profile = profile
+    if no_object_cache:
+        compiler.object_cache = None
+    else:
+        compiler.object_cache = toolchain.object_cache if toolchain else vizh.cache.ObjectCache()
+    parser = toolchain.configure_parser(not no_parse_cache, batch_ocr, not no_name_templates) if toolchain else None
     
-    compilation_failed = vizh_object_file == None or c_object_files == None
+    parse = lambda files: parse_vizh_files(compiler, files, debug_parser, not no_parse_cache, jobs, batch_ocr, not no_name_templates, parser)
 
-    output_file = output_file or get_default_output_file(compile_only, vizh_funcs)
-       
-    # If we're only compiling, move the compiled object files into the current directory and exit
-    if compile_only:
-        if vizh_object_file:
-            shutil.move(vizh_object_file, output_file)
-        for file in c_object_files:
-            shutil.move(file, os.path.join(os.getcwd(), os.path.basename(file)))
+    if incremental and not compile_only and not run:
+        linker = toolchain.linker if toolchain else vizh.linker.Linker()
+        return build_incrementally(compiler, linker, parse, vizh_source_files, c_source_files, supplied_object_files,
+                                   output_file or get_default_output_file(False, []), quiet)
+
+    # The pipeline parses in worker processes, which can't show the parser's debug windows
+    if pipeline and not compile_only and not run and not debug_parser:
+        linker = toolchain.linker if toolchain else vizh.linker.Linker()
+        output_file = output_file or get_default_output_file(False, [])
+        with make_build_directory(keep_build_dir, quiet) as build:
+            succeeded = vizh.pipeline.Pipeline(compiler, linker, compiler.jobs, build, not no_parse_cache, batch_ocr, not no_name_templates).run(
+                vizh_source_files, c_source_files, supplied_object_files, output_file)
+        if not succeeded:
+            return -1
         if not quiet:
-            if vizh_object_file:
-                print(vizh_source_files, '->', output_file)
-            for (source,object) in zip(c_source_files, c_object_files):
-                print(source, '->', os.path.basename(object), file=sys.stdout)
+            print(vizh_source_files + c_source_files + supplied_object_files, '->', output_file)
+        return 0
+
+    with vizh.timing.phase('driver.parse'):
+        vizh_funcs = parse(vizh_source_files)
+
+    if run:
+        return run_vizh_functions(vizh_funcs, supplied_object_files + c_source_files, opt_level, max_steps, tape_size)
+
+    # Everything but the output is built in a directory which is removed afterwards
+    with make_build_directory(keep_build_dir, quiet) as build:
+        with vizh.timing.phase('driver.compile'):
+            if split_units:
+                vizh_object_files, c_object_files = compile_function_units(compiler, vizh_funcs, c_source_files, build)
+            else:
+                vizh_object_files = None
+                try:
+                    vizh_object_files = [compiler.compile_functions(vizh_funcs, build)] if vizh_funcs else None
+                except vizh.compiler.CompilerError as err:
+                    print(err)
+                    return -1
+
+                c_object_files = compile_c_files(compiler, c_source_files, build)
+        if cache_stats and compiler.object_cache:
+            print(f'Object cache: {compiler.object_cache.stats()}', file=sys.stderr)
+
+        compilation_failed = vizh_object_files == None or c_object_files == None
+
+        output_file = output_file or get_default_output_file(compile_only, vizh_funcs)
+
+        # If we're only compiling, move the compiled object files into the current directory and exit
+        if compile_only:
+            if vizh_object_files and len(vizh_object_files) == 1:
+                shutil.move(vizh_object_files[0], output_file)
+            elif vizh_object_files:
+                # Split units are named after their functions
+                for file in vizh_object_files:
+                    shutil.move(file, os.path.join(os.getcwd(), os.path.basename(file)))
+            for file in c_object_files or []:
+                shutil.move(file, os.path.join(os.getcwd(), os.path.basename(file)))
+            if not quiet:
+                if vizh_object_files and len(vizh_object_files) == 1:
+                    print(vizh_source_files, '->', output_file)
+                elif vizh_object_files:
+                    print(vizh_source_files, '->', [os.path.basename(file) for file in vizh_object_files])
+                for (source,object) in zip(c_source_files, c_object_files):
+                    print(source, '->', os.path.basename(object), file=sys.stdout)
+            if compilation_failed:
+                print("Compilation failed :(", file=sys.stderr)
+                return -1
+            else:
+                return 0
+
         if compilation_failed:
             print("Compilation failed :(", file=sys.stderr)
             return -1
-        else:
-            return 0
 
-    if compilation_failed:
-        print("Compilation failed :(", file=sys.stderr)
-        return -1
+        object_files = supplied_object_files + c_object_files + vizh_object_files
+        linker = toolchain.linker if toolchain else vizh.linker.Linker()
+        link_crtv = find_if(vizh_funcs, lambda f: f.signature.name == 'vizh_main') != None
 
-    object_files = supplied_object_files + c_object_files + [vizh_object_file]
-    linker = vizh.linker.Linker()
-    link_crtv = find_if(vizh_funcs, lambda f: f.signature.name == 'vizh_main') != None
+        try:
+            linker.link(object_files, output_file, link_crtv, build)
 
-    try:
-        linker.link(object_files, output_file, link_crtv)
+            if not quiet:
+                print(vizh_source_files + c_source_files + supplied_object_files, '->', output_file)
+        except vizh.linker.LinkerError as err:
+                print(f'C compiler reported an error in linking:\n{err}', file=sys.stderr)
 
-        if not quiet:
-            print(vizh_source_files + c_source_files + supplied_object_files, '->', output_file)
-    except vizh.linker.LinkerError as err:
-            print(f'C compiler reported an error in linking:\n{err}', file=sys.stderr)
+@click.command()
+@click.version_option()
+@click.argument('inputs', nargs=-1, type=click.Path(exists=True))
+@click.option('-c', '--compile-only', 'compile_only', is_flag=True, help="Only compile, don't link.")
+@click.option('-o', '--output-file', 'output_file', type=click.Path(), default=None, help="Output file for executables or vizh object files.")
+@click.option('-q', '--quiet', is_flag=True, help="Suppress output.")
+@click.option('--debug-parser', 'debug_parser', is_flag=True, help="Display how the parser understands your source file.")
+@click.option('--no-parse-cache', 'no_parse_cache', is_flag=True, help="Always parse images, even if they haven't changed since the last build.")
+@click.option('--no-object-cache', 'no_object_cache', is_flag=True, help="Always run the C compiler, even if its input hasn't changed since the last build.")
+@click.option('--cache-stats', 'cache_stats', is_flag=True, help="Report how many objects were found in the object cache.")
+@click.option('-j', '--jobs', 'jobs', type=click.IntRange(min=0), default=1, help="Number of images to parse and C files to compile in parallel (0 for one per CPU).")
+@click.option('--incremental', 'incremental', is_flag=True, help="Only rebuild what changed since the last build of the same output file.")
+@click.option('--pipeline', 'pipeline', is_flag=True, help="Compile functions while other images are still being parsed.")
+@click.option('--split-units', 'split_units', is_flag=True, help="Compile each vizh function to its own object file.")
+@click.option('--pipe-c', 'pipe_c', is_flag=True, help="Feed generated C to the C compiler through stdin instead of writing it to disk.")
+@click.option('--keep-build-dir', 'keep_build_dir', is_flag=True, help="Keep the generated C and object files, and print where they are.")
+@click.option('--batch-ocr', 'batch_ocr', is_flag=True, help="Recognise all the text in an image in a single OCR pass.")
+@click.option('--no-name-templates', 'no_name_templates', is_flag=True, help="Always use OCR for function calls rather than matching known names first.")
+@click.option('-O', '--optimize', 'opt_level', type=click.IntRange(0, 3), default=1, help="Optimization level for vizh code (0 disables optimizations, 2 and up inline small functions).")
+@click.option('--tape-size', 'tape_size', callback=parse_tape_size, default=None, help="Size of the program's tapes, like 64K or 16M. Run the program with --vizh-tape-size= or VIZH_TAPE_SIZE set to override it.")
+@click.option('--profile', 'profile', is_flag=True, help="Build a program which counts how often every instruction runs and times its calls, for vizh profile-report.")
+@click.option('--run', 'run', is_flag=True, help="Run the program with the interpreter instead of building it.")
+@click.option('--max-steps', 'max_steps', type=click.IntRange(min=1), default=None, help="Stop a program run with --run after this many instructions.")
+@click.option('--time-passes', 'time_passes', is_flag=True, help="Report how long each stage of the build took.")
+@click.option('--time-passes-json', 'time_passes_json', type=click.Path(dir_okay=False), default=None, help="Write how long each stage of the build took to this file as JSON.")
+@click.option('--server', 'server', is_flag=True, help="Run a compile server which keeps the toolchain loaded between builds.")
+@click.option('--no-server', 'no_server', is_flag=True, help="Build in this process even if a compile server is running.")
+@click.option('--socket', 'socket_path', type=click.Path(), default=None, help="Unix socket for the compile server.")
+@click.pass_obj
+def entry(toolchain, inputs, compile_only, output_file, quiet, debug_parser, no_parse_cache, no_object_cache, cache_stats, jobs, incremental, pipeline, split_units, pipe_c, keep_build_dir, batch_ocr, no_name_templates, opt_level, tape_size, profile, run, max_steps, time_passes, time_passes_json, server, no_server, socket_path):
+    if server:
+        vizh.server.serve(socket_path)
+        return 0
+
+    time_build = time_passes or time_passes_json
+    if time_build:
+        vizh.timing.start()
+    try:
+        return build_program(toolchain, inputs, compile_only, output_file, quiet, debug_parser, no_parse_cache, no_object_cache, cache_stats, jobs,
+                             incremental, pipeline, split_units, pipe_c, keep_build_dir, batch_ocr, no_name_templates, opt_level, tape_size, profile, run, max_steps)
+    finally:
+        if time_build:
+            report_timings(vizh.timing.stop(), time_passes, time_passes_json)
 
 if __name__ == '__main__':
     entry()
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""Calls vizh functions from Python, without building a program around them.
+
+    library = vizh.embed.load(['memcopy.png'])
+    size = np.array([200], dtype=np.uint8)
+    library.memcopy(size, source, destination)
+
+The functions are compiled with libv into a shared library, which is loaded with
+cffi. Shared libraries are kept in the object cache, keyed by the C generated for
+the functions, so loading the same functions again doesn't run the C compiler.
+
+Each function takes as many tapes as its signature says. Tapes are writable NumPy
+uint8 arrays, or anything else with a writable buffer like a bytearray, and are
+passed by pointer: the function works on them in place and nothing is copied.
+Unlike the tapes vizh allocates, they have no guard pages, so they must be big
+enough for everywhere the function moves its heads.
+"""
+import copy
+import hashlib
+import os
+import os.path
+import cffi
+import numpy as np
+from vizh.ir import Function, FunctionSignature
+import vizh.build
+import vizh.cache
+import vizh.compiler
+import vizh.linker
+import vizh.parser
+import vizh.recogniser
+
+# Bump this whenever a change here could change the shared libraries built from the same C
+EMBED_VERSION = 1
+
+class EmbedError(Exception):
+    pass
+
+class EmbeddedFunction(object):
+    """A vizh function in a loaded Library. Calling it calls the native function once, with pointers to its tapes."""
+    def __init__(self, library, signature, c_function):
+        self.library = library
+        self.name = signature.name
+        self.n_args = signature.n_args
+        self.c_function = c_function
+
+    def tape_pointer(self, tape):
+        if isinstance(tape, np.ndarray) and tape.dtype != np.uint8:
+            raise TypeError(f'Tapes must be uint8 arrays, not {tape.dtype}')
+        try:
+            pointer = self.library.ffi.from_buffer('uint8_t[]', tape, require_writable=True)
+        except (TypeError, BufferError) as err:
+            raise TypeError(f'Tapes must be writable contiguous buffers: {err}')
+        # Every function can read the cell under its head before doing anything else
+        if len(pointer) == 0:
+            raise ValueError('Tapes must have at least one cell')
+        return pointer
+
+    def __call__(self, *tapes):
+        if len(tapes) != self.n_args:
+            raise TypeError(f'{self.name} takes {self.n_args} tapes but {len(tapes)} were given')
+        self.c_function(*[self.tape_pointer(tape) for tape in tapes])
+
+    def __repr__(self):
+        return f'<vizh function {self.name} taking {self.n_args} tapes>'
+
+class Library(object):
+    """A shared library of vizh functions, which are available by name as attributes or items.
+
+    The library is loaded from a copy in a build directory of its own, which is removed when it's closed.
+    """
+    def __init__(self, path, signatures, build):
+        self.path = path
+        self.build = build
+        self.ffi = cffi.FFI()
+        mangled = [FunctionSignature(vizh.compiler.mangle(signature.name), signature.n_args) for signature in signatures]
+        self.ffi.cdef('\n'.join(f'{signature};' for signature in mangled))
+        self.lib = self.ffi.dlopen(path)
+        self.functions = {signature.name: EmbeddedFunction(self, signature, getattr(self.lib, c_signature.name))
+                          for signature, c_signature in zip(signatures, mangled)}
+
+    def __getitem__(self, name):
+        return self.functions[name]
+
+    def __getattr__(self, name):
+        # Only called for names which aren't attributes of the library itself
+        functions = self.__dict__.get('functions', {})
+        if name not in functions:
+            raise AttributeError(f'There is no vizh function called {name} in {self.path}')
+        return functions[name]
+
+    def __contains__(self, name):
+        return name in self.functions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, exception_traceback):
+        self.close()
+
+    def close(self):
+        """Unloads the library. Its functions mustn't be called after this."""
+        if self.lib is not None:
+            self.ffi.dlclose(self.lib)
+            self.lib = None
+            self.build.cleanup()
+
+def parse_images(files):
+    """Parses image files into functions, raising EmbedError if any of them don't parse"""
+    recogniser = vizh.recogniser.TemplateRecogniser(vizh.recogniser.libv_names())
+    with vizh.parser.Parser(vizh.cache.ParseCache(), interactive=False, recogniser=recogniser) as parser:
+        functions = [parser.parse(file) for file in files]
+    failed = [file for file, function in zip(files, functions) if function is None]
+    if failed:
+        raise EmbedError(f"Couldn't parse {', '.join(failed)}")
+    return functions
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def library_key(object_cache, code, compiler, linker):
+    """The key for the shared library built from code, which also depends on the libv it's linked with"""
+    include_dirs, flags = compiler.c_options()
+    identity = '\0'.join([vizh.cache.compiler_identity(compiler.c_compiler), vizh.cache.compiler_identity(linker.c_compiler),
+                          file_digest(linker.libv)])
+    return object_cache.text_key(code, include_dirs, flags + [f'embed={EMBED_VERSION}'], identity)
+
+def build_library(code, exports, path, compiler, linker):
+    """Compiles generated C into a shared library at path, which exports the functions named in exports"""
+    with vizh.build.BuildDirectory() as build:
+        objects, _ = compiler.compile_generated([('embed', code)], build)
+        linker.link_shared(objects, path, exports, build)
+
+def load(inputs, opt_level=1, object_cache=None, compiler=None, linker=None):
+    """Compiles vizh functions, given as image files or vizh.ir.Functions, and loads them as a Library.
+
+    Shared libraries are cached in object_cache, which defaults to vizh's object cache.
+    Pass False to always build them. compiler and linker default to a position independent
+    Compiler at opt_level, and a Linker using the installed libv.
+    """
+    images = [input for input in inputs if not isinstance(input, Function)]
+    parsed = iter(parse_images(images) if images else [])
+    functions = [input if isinstance(input, Function) else next(parsed) for input in inputs]
+    names = [function.signature.name for function in functions]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise EmbedError(f"Functions can only be defined once, but there's more than one {', '.join(duplicates)}")
+
+    compiler = compiler or vizh.compiler.Compiler(opt_level=opt_level, position_independent=True)
+    linker = linker or vizh.linker.Linker()
+    if not os.path.isfile(linker.libv):
+        raise EmbedError(f"There's no libv at {linker.libv}. Install vizh, or give a Linker with a position independent libv.")
+    if object_cache is None:
+        object_cache = vizh.cache.ObjectCache()
+
+    # Code generation renames functions and the optimizer changes them, so they're compiled as copies
+    try:
+        code = compiler.compile_functions_to_c(copy.deepcopy(functions))
+    except vizh.compiler.CompilerError as err:
+        raise EmbedError(str(err))
+
+    build = vizh.build.BuildDirectory()
+    path = os.path.join(build.path, f'vizh_embed{vizh.linker.SHARED_LIBRARY_EXTENSION}')
+    try:
+        key = library_key(object_cache, code, compiler, linker) if object_cache else None
+        if key is None or not object_cache.get(key, path):
+            build_library(code, [vizh.compiler.mangle(name) for name in names], path, compiler, linker)
+            if key is not None:
+                object_cache.put(key, path)
+        return Library(path, [function.signature for function in functions], build)
+    except (vizh.compiler.CompilerError, vizh.linker.LinkerError) as err:
+        build.cleanup()
+        raise EmbedError(str(err))
+    except Exception:
+        build.cleanup()
+        raise
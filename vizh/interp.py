@@ -0,0 +1,297 @@
+"""Runs vizh IR directly, without going through C.
+
+Tapes are NumPy uint8 arrays and the libv functions written in C have Python
+equivalents, so programs can be run and tested without a C toolchain.
+Every instruction the optimizer produces is supported, so optimized and
+unoptimized IR can be run against each other.
+"""
+import sys
+import numpy as np
+from vizh.ir import *
+import vizh.optimizer
+
+# Matches the default TAPE_SIZE in libv.h. numpy's zeroed arrays only take memory as they're touched too.
+TAPE_SIZE = 16 * 1024 * 1024
+
+class InterpreterError(Exception):
+    pass
+
+class StepLimitExceeded(InterpreterError):
+    """Raised when a program runs for more instructions than it was allowed"""
+    pass
+
+def resolve_loops(instructions):
+    """Turns a function's instructions into (type, value) pairs where loops carry the index of their other end"""
+    code = [(instruction.type, instruction.value) for instruction in instructions]
+    starts = []
+    for index, (instruction_type, _) in enumerate(code):
+        if instruction_type == InstructionType.LOOP_START:
+            starts.append(index)
+        elif instruction_type == InstructionType.LOOP_END:
+            if not starts:
+                raise InterpreterError('Loop end without a matching loop start')
+            start = starts.pop()
+            code[start] = (InstructionType.LOOP_START, index)
+            code[index] = (InstructionType.LOOP_END, start)
+    if starts:
+        raise InterpreterError('Loop start without a matching loop end')
+    return code
+
+def iteration_count(step, cell):
+    """The number of times a loop which adds step to a cell holding cell each iteration will run"""
+    return (-cell * vizh.optimizer.inverse_mod_256(step)) % 256
+
+def find_zero(tape, position, chunk=4096):
+    """The position of the first zero on tape at or after position, or None if there isn't one"""
+    # Tapes are big and mostly untouched, so look through them a bit at a time
+    for start in range(position, len(tape), chunk):
+        zeros = np.flatnonzero(tape[start:start + chunk] == 0)
+        if len(zeros) > 0:
+            return start + int(zeros[0])
+    return None
+
+def store(tape, position, data, name):
+    if position + len(data) > len(tape):
+        raise InterpreterError(f'{name} ran off the end of the tape')
+    tape[position:position + len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+class Frame(object):
+    """The state of a running function.
+
+    Each function has its own heads for the tapes it was given, so
+    heads are positions into the tapes rather than shared objects.
+    """
+    def __init__(self, name, code, tapes, heads):
+        self.name = name
+        self.code = code
+        self.pc = 0
+        self.tapes = tapes
+        self.heads = heads
+        self.n_args = len(tapes)
+        self.current_tape = 0
+        self.head_storage = 0
+        # Saved (heads, head storage, current tape) for every INLINE_ENTER we're inside
+        self.inline_stack = []
+
+    def check_tape(self, tape):
+        if not 0 <= tape < len(self.tapes):
+            raise InterpreterError(f'{self.name} accessed tape {tape}, but only has {len(self.tapes)}')
+
+    def check_head(self, tape, position):
+        if not 0 <= position < len(self.tapes[tape]):
+            raise InterpreterError(f'{self.name} moved the head of tape {tape} off the tape to cell {position}')
+
+    def cell(self, tape_offset=0, cell_offset=0):
+        """(tape array, index) for a cell relative to the current tape and its head"""
+        tape = self.current_tape + tape_offset
+        self.check_tape(tape)
+        position = self.heads[tape] + cell_offset
+        self.check_head(tape, position)
+        return self.tapes[tape], position
+
+class Interpreter(object):
+    """Runs vizh functions.
+
+    library holds the IR of functions which would be linked in, like the libv functions written in vizh.
+    Output from print goes to stdout and readin reads from stdin, both binary streams.
+    If max_steps is given, running more than that many instructions raises StepLimitExceeded.
+    New tapes are tape_size bytes long.
+    """
+    def __init__(self, functions, library=None, stdin=None, stdout=None, max_steps=None, tape_size=TAPE_SIZE):
+        if library is None:
+            import vizh.compiler
+            library = vizh.compiler.libv_functions
+        self.functions = {}
+        # Functions being run shadow library functions with the same name
+        for function in list(library) + list(functions):
+            self.functions[function.signature.name] = function
+        self.code = {}
+        self.stdin = stdin if stdin is not None else sys.stdin.buffer
+        self.stdout = stdout if stdout is not None else sys.stdout.buffer
+        self.max_steps = max_steps
+        self.tape_size = tape_size
+        self.steps = 0
+
+        self.natives = {
+            'print': self.native_print,
+            'readin': self.native_readin,
+            'putstr': self.native_putstr,
+            'readline': self.native_readline,
+            'readn': self.native_readn,
+        }
+
+    def native_print(self, tape, position):
+        self.stdout.write(bytes([tape[position]]))
+
+    def native_readin(self, tape, position):
+        byte = self.stdin.read(1)
+        # getchar returns EOF, which is truncated to 255
+        tape[position] = byte[0] if byte else 255
+
+    def native_putstr(self, tape, position):
+        end = find_zero(tape, position)
+        if end is None:
+            raise InterpreterError('putstr ran off the end of the tape')
+        self.stdout.write(tape[position:end].tobytes())
+
+    def native_readline(self, tape, position):
+        line = self.stdin.readline()
+        if line.endswith(b'\n'):
+            line = line[:-1]
+        store(tape, position, line + b'\0', 'readline')
+
+    def native_readn(self, tape, position):
+        data = self.stdin.read(int(tape[position]))
+        store(tape, position + 1, data, 'readn')
+        tape[position] = len(data)
+
+    def compiled(self, name):
+        if name not in self.code:
+            self.code[name] = resolve_loops(self.functions[name].instructions)
+        return self.code[name]
+
+    def run_main(self):
+        """Runs main on as many fresh tapes as it takes, like crtv does, and returns the first if there is one"""
+        name = 'main' if 'main' in self.functions else 'vizh_main'
+        if name not in self.functions:
+            raise InterpreterError('There is no main function')
+        tapes = [np.zeros(self.tape_size, dtype=np.uint8) for _ in range(self.functions[name].signature.n_args)]
+        self.call(name, tapes, [0] * len(tapes))
+        self.stdout.flush()
+        return tapes[0] if tapes else None
+
+    def call(self, name, tapes, heads):
+        """Calls a function with the given tapes, where the heads are at the given positions"""
+        if name in self.natives:
+            self.natives[name](tapes[0], heads[0])
+            return
+        if name not in self.functions:
+            raise InterpreterError(f'Unrecognised function call: {name}')
+        signature = self.functions[name].signature
+        if len(tapes) != signature.n_args:
+            raise InterpreterError(f'{name} takes {signature.n_args} tapes, but was given {len(tapes)}')
+
+        stack = [Frame(name, self.compiled(name), list(tapes), list(heads))]
+        while stack:
+            frame = stack[-1]
+            callee = self.run_frame(frame)
+            if callee is None:
+                stack.pop()
+            else:
+                stack.append(callee)
+
+    def run_frame(self, frame):
+        """Runs a frame until it returns, in which case this returns None, or
+        until it calls a vizh function, in which case this returns the frame for the callee
+        """
+        code = frame.code
+        tapes = frame.tapes
+        heads = frame.heads
+        max_steps = self.max_steps
+
+        while frame.pc < len(code):
+            instruction_type, value = code[frame.pc]
+            frame.pc += 1
+            self.steps += 1
+            if max_steps is not None and self.steps > max_steps:
+                raise StepLimitExceeded(f'Ran for more than {max_steps} steps')
+
+            if instruction_type in (InstructionType.INC, InstructionType.DEC, InstructionType.ADD):
+                tape, position = frame.cell()
+                amount = 1 if instruction_type == InstructionType.INC else -1 if instruction_type == InstructionType.DEC else value
+                tape[position] = (int(tape[position]) + amount) % 256
+            elif instruction_type in (InstructionType.LEFT, InstructionType.RIGHT, InstructionType.MOVE_HEAD):
+                frame.check_tape(frame.current_tape)
+                amount = -1 if instruction_type == InstructionType.LEFT else 1 if instruction_type == InstructionType.RIGHT else value
+                heads[frame.current_tape] += amount
+            elif instruction_type in (InstructionType.UP, InstructionType.DOWN, InstructionType.MOVE_TAPE):
+                # Moving off the tapes is only a problem if they're accessed
+                frame.current_tape += -1 if instruction_type == InstructionType.UP else 1 if instruction_type == InstructionType.DOWN else value
+            elif instruction_type == InstructionType.LOOP_START:
+                tape, position = frame.cell()
+                if tape[position] == 0:
+                    frame.pc = value + 1
+            elif instruction_type == InstructionType.LOOP_END:
+                # Equivalent to jumping back to the start and checking there
+                tape, position = frame.cell()
+                if tape[position] != 0:
+                    frame.pc = value + 1
+            elif instruction_type == InstructionType.READ:
+                tape, position = frame.cell()
+                frame.head_storage = int(tape[position])
+            elif instruction_type == InstructionType.WRITE:
+                tape, position = frame.cell()
+                tape[position] = frame.head_storage
+
+            elif instruction_type == InstructionType.CALL:
+                if value == 'newtape':
+                    tapes.append(np.zeros(self.tape_size, dtype=np.uint8))
+                    heads.append(0)
+                elif value == 'freetape':
+                    # Only tapes created by this function can be freed
+                    if len(tapes) <= frame.n_args:
+                        raise InterpreterError(f'{frame.name} freed a tape it didn\'t create')
+                    tapes.pop()
+                    heads.pop()
+                elif value in self.natives:
+                    tape, position = frame.cell()
+                    self.natives[value](tape, position)
+                else:
+                    if value not in self.functions:
+                        raise InterpreterError(f'Unrecognised function call: {value}')
+                    n_args = self.functions[value].signature.n_args
+                    start = frame.current_tape
+                    for arg in range(n_args):
+                        frame.check_tape(start + arg)
+                    return Frame(value, self.compiled(value), tapes[start:start + n_args], heads[start:start + n_args])
+
+            # Loop idioms produced by the optimizer
+            elif instruction_type == InstructionType.CLEAR:
+                tape, position = frame.cell()
+                tape[position] = 0
+            elif instruction_type == InstructionType.MUL_ADD:
+                step, targets = value
+                tape, position = frame.cell()
+                n = iteration_count(step, int(tape[position]))
+                for target_tape, offset, factor in targets:
+                    target, target_position = frame.cell(target_tape, offset)
+                    target[target_position] = (int(target[target_position]) + n * factor) % 256
+                tape[position] = 0
+            elif instruction_type == InstructionType.COPY:
+                step, source_tape, source_offset, destination_tape, destination_offset = value
+                tape, position = frame.cell()
+                n = iteration_count(step, int(tape[position]))
+                if n != 0:
+                    source, source_position = frame.cell(source_tape, source_offset)
+                    destination, destination_position = frame.cell(destination_tape, destination_offset)
+                    frame.check_head(frame.current_tape + source_tape, source_position + n - 1)
+                    frame.check_head(frame.current_tape + destination_tape, destination_position + n - 1)
+                    destination[destination_position:destination_position + n] = source[source_position:source_position + n]
+                    frame.head_storage = int(source[source_position + n - 1])
+                    heads[frame.current_tape + source_tape] += n
+                    heads[frame.current_tape + destination_tape] += n
+                tape[position] = 0
+            elif instruction_type == InstructionType.SCAN:
+                tape, position = frame.cell()
+                while tape[position] != 0:
+                    position += value
+                    frame.check_head(frame.current_tape, position)
+                heads[frame.current_tape] = position
+
+            # Inlined functions get their own heads, head storage and current tape
+            elif instruction_type == InstructionType.INLINE_ENTER:
+                start = frame.current_tape
+                frame.inline_stack.append((heads[start:start + value], frame.head_storage, start))
+                frame.head_storage = 0
+            elif instruction_type == InstructionType.INLINE_EXIT:
+                saved_heads, frame.head_storage, frame.current_tape = frame.inline_stack.pop()
+                heads[frame.current_tape:frame.current_tape + len(saved_heads)] = saved_heads
+
+            else:
+                raise InterpreterError(f'Unknown instruction {instruction_type}')
+
+        return None
+
+def run(functions, library=None, stdin=None, stdout=None, max_steps=None, tape_size=TAPE_SIZE):
+    """Runs the main function of a program, returning its first tape"""
+    return Interpreter(functions, library, stdin, stdout, max_steps, tape_size).run_main()
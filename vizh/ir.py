@@ -1,4 +1,5 @@
 from enum import Enum, auto
+import json
 
 class InstructionType(Enum):
     """All the instructions available in vizh"""
@@ -14,14 +15,36 @@ class InstructionType(Enum):
     LOOP_END = auto()
     CALL = auto()
 
+    # These are only produced by the optimizer (see vizh.optimizer)
+    # and carry an integer value
+    ADD = auto()        # Add value to the current cell
+    MOVE_HEAD = auto()  # Move the r/w head value cells to the right
+    MOVE_TAPE = auto()  # Move the r/w head value tapes down
+
+    # Loop idioms recognised by the optimizer. See vizh.optimizer for their values.
+    CLEAR = auto()      # Set the current cell to 0
+    MUL_ADD = auto()    # Add multiples of the current cell to other cells, then clear it
+    COPY = auto()       # Copy a block of cells from one tape to another
+    SCAN = auto()       # Move the r/w head until it reaches a 0 cell
+
+    # Inlined function bodies are surrounded by these, which carry the callee's number of arguments.
+    # The callee's changes to the r/w heads, current tape and head storage are undone at INLINE_EXIT.
+    INLINE_ENTER = auto()
+    INLINE_EXIT = auto()
+
 
 class Instruction(object):
     """An instruction has a type and potentially a value
-    Currently only the call instruction can have a value
+    Calls have the name of the function as their value,
+    and optimizer instructions have an integer or tuple
+
+    Instructions parsed from an image know where they were drawn: location is
+    the (x, y, width, height) of their symbol in the image, or None.
     """
-    def __init__(self, type, value=None):
+    def __init__(self, type, value=None, location=None):
         self.type = type
         self.value = value
+        self.location = tuple(location) if location is not None else None
 
     def __str__(self):
         """Turns instruction into '<instruction type> (<value>);'
@@ -53,10 +76,23 @@ class FunctionSignature(object):
     def __repr__(self):
         return f'FunctionSignature("{self.name}", {self.n_args})'
 
+def covering_location(instructions):
+    """The smallest box around the locations of the given instructions, or None if none of them have one"""
+    boxes = [instruction.location for instruction in instructions if instruction.location is not None]
+    if not boxes:
+        return None
+    left = min(x for x, _, _, _ in boxes)
+    top = min(y for _, y, _, _ in boxes)
+    right = max(x + w for x, _, w, _ in boxes)
+    bottom = max(y + h for _, y, _, h in boxes)
+    return (left, top, right - left, bottom - top)
+
 class Function(object):
-    def __init__(self, signature, instructions):
+    """source is the path of the image the function was parsed from, if there was one"""
+    def __init__(self, signature, instructions, source=None):
         self.signature = signature
         self.instructions = instructions
+        self.source = source
 
     def __str__(self):
         """Turns function into:
@@ -74,4 +110,32 @@ class Function(object):
             ret += f'\n\t{instr}'
         ret += '\n}'
         return ret
-    
\ No newline at end of file
+
+def function_to_json(function):
+    """Serialise a function to a compact JSON string.
+
+    Example:
+        {"name":"getA","n_args":1,"instructions":[["INC"],["CALL","print"]]}
+
+    Instructions with a location have it as a third element, after their value (which may be null),
+    and functions parsed from an image have its path as "source".
+    """
+    def instruction_to_json(instr):
+        if instr.location is not None:
+            return [instr.type.name, instr.value, list(instr.location)]
+        return [instr.type.name] if instr.value is None else [instr.type.name, instr.value]
+
+    data = {
+        'name': function.signature.name,
+        'n_args': function.signature.n_args,
+        'instructions': [instruction_to_json(instr) for instr in function.instructions]
+    }
+    if function.source is not None:
+        data['source'] = function.source
+    return json.dumps(data, separators=(',', ':'))
+
+def function_from_json(text):
+    """Inverse of function_to_json"""
+    data = json.loads(text)
+    instructions = [Instruction(InstructionType[instr[0]], *instr[1:]) for instr in data['instructions']]
+    return Function(FunctionSignature(data['name'], data['n_args']), instructions, data.get('source'))
@@ -6,7 +6,7 @@ import os.path
 import re
 import distutils.ccompiler
 import shutil
-import tempfile
+import vizh.build
 
 LIBV_HEADER_NAME = 'libv.h'
 LIBV_VIZH_HEADER_NAME = 'libv_vizh.h'
@@ -68,39 +68,44 @@ def parse_libv_c_decls(libv_source_path):
     return libv_c_decls
 
 def generate_libv_python_decls(vizh_funcs, libv_c_decls, output_dir):
-    libv_python_imports = 'from vizh.ir import FunctionSignature\n'
+    libv_python_imports = 'from vizh.ir import FunctionSignature, function_from_json\n'
     libv_python_imports += 'libv_decls = [\n\t'
     libv_python_imports += ',\n\t'.join([repr(func.signature) for func in vizh_funcs])
     libv_python_imports += ',\n\t'
     libv_python_imports += ',\n\t'.join([repr(signature) for signature in libv_c_decls])
     libv_python_imports += '\n]\n'
+    # The IR of the functions written in vizh, so that they can be inlined
+    libv_python_imports += 'libv_functions = [\n\t'
+    libv_python_imports += ',\n\t'.join([f'function_from_json({vizh.ir.function_to_json(func)!r})' for func in vizh_funcs])
+    libv_python_imports += '\n]\n'
     with open(os.path.join(output_dir, LIBV_PYTHON_IMPORT_NAME), 'w') as header_file:
         header_file.write(libv_python_imports)  
 
 def compile_libv(libv_source_path, output_dir):
     c_files, vizh_files, crtv_file = find_libv_files(libv_source_path)
 
-    c = vizh.compiler.Compiler()
-    
-    libv_objects = c.compile_c_programs(c_files, tempfile.gettempdir())
-    crtv_object = c.compile_c_programs([crtv_file], tempfile.gettempdir())[0]
-    vizh_funcs = parse_vizh_files(vizh_files)
+    # libv is linked into shared libraries by vizh.embed as well as into programs
+    c = vizh.compiler.Compiler(position_independent=True)
+    with vizh.build.BuildDirectory() as build:
+        libv_objects = c.compile_c_programs(c_files, build.objects())
+        crtv_object = c.compile_c_programs([crtv_file], build.objects())[0]
+        vizh_funcs = parse_vizh_files(vizh_files)
+
+        write_libv_vizh_header(vizh_funcs, output_dir) 
+        libv_c_decls = parse_libv_c_decls(libv_source_path)
 
-    write_libv_vizh_header(vizh_funcs, output_dir) 
-    libv_c_decls = parse_libv_c_decls(libv_source_path)
+        shutil.copyfile(os.path.join(libv_source_path, LIBV_HEADER_NAME), os.path.join(output_dir, LIBV_HEADER_NAME))
 
-    shutil.copyfile(os.path.join(libv_source_path, LIBV_HEADER_NAME), os.path.join(output_dir, LIBV_HEADER_NAME))
+        generate_libv_python_decls(vizh_funcs, libv_c_decls, output_dir)
 
-    generate_libv_python_decls(vizh_funcs, libv_c_decls, output_dir)
+        libv_objects.append(c.compile_functions(vizh_funcs, build, libv_c_decls))
 
-    libv_objects.append(c.compile_functions(vizh_funcs, libv_c_decls))
-    
-    # Create static libv and move crtv.o into the build dir
-    linker = c.c_compiler
+        # Create static libv and move crtv.o into the build dir
+        linker = c.c_compiler
         
-    if os.name == 'nt':
-        shutil.copyfile(crtv_object, f'{output_dir}/crtv.obj')
-        linker.create_static_lib(libv_objects, 'libv', output_dir=output_dir)
-    else:
-        shutil.copyfile(crtv_object, f'{output_dir}/crtv.o')
-        linker.create_static_lib(libv_objects, 'v', output_dir=output_dir)
\ No newline at end of file
+        if os.name == 'nt':
+            shutil.copyfile(crtv_object, f'{output_dir}/crtv.obj')
+            linker.create_static_lib(libv_objects, 'libv', output_dir=output_dir)
+        else:
+            shutil.copyfile(crtv_object, f'{output_dir}/crtv.o')
+            linker.create_static_lib(libv_objects, 'v', output_dir=output_dir)
\ No newline at end of file
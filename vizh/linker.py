@@ -1,37 +1,51 @@
 import distutils.ccompiler
 import os.path
 import os
+import vizh.timing
 import vizh.util
-import sys
-import tempfile
 
 LIBV_NAME = 'libv.lib' if os.name == 'nt' else 'libv.a'
 CRTV_NAME = 'crtv.obj' if os.name == 'nt' else 'crtv.o'
+SHARED_LIBRARY_EXTENSION = '.dll' if os.name == 'nt' else '.so'
 
 class LinkerError(Exception):
     pass
 
 class Linker(object):
-    def __init__(self, c_compiler=None):
-        self.c_compiler = c_compiler or distutils.ccompiler.new_compiler()
+    def __init__(self, c_compiler=None, libv=None):
+        """libv is the path of the libv library to link against, which defaults to the one installed with vizh"""
+        self.c_compiler = vizh.util.capture_output(c_compiler or distutils.ccompiler.new_compiler())
+        # libv.a and crtv.o are installed in the same directory as this file
+        vizh_path = os.path.dirname(__file__)
+        self.libv = libv or os.path.join(vizh_path, LIBV_NAME)
+        self.crtv = os.path.join(vizh_path, CRTV_NAME)
 
-    def link(self, object_files, output_name, link_crtv=True):
+    def link(self, object_files, output_name, link_crtv=True, build=None):
         """Links the given object files into an executable with the given name.
 
-        link_crtv specifies whether to link crtv.o, which defines main
+        link_crtv specifies whether to link crtv.o, which defines main. Any intermediate
+        files the linker makes, like the import libraries MSVC writes, go in build.
         """
 
-        # libv.a and crtv.o are installed in the same directory as this file
-        vizh_path = os.path.dirname(__file__)
-        object_files.append(os.path.join(vizh_path, LIBV_NAME))
+        object_files.append(self.libv)
         if link_crtv:
-            object_files.append(os.path.join(vizh_path, CRTV_NAME))
-
-        err_log_name = os.path.join(tempfile.gettempdir(), next(tempfile._get_candidate_names()))
-        with vizh.util.stdchannel_redirected(sys.stdout, err_log_name) as err_file:
-            try:
-                return self.c_compiler.link(self.c_compiler.EXECUTABLE, object_files, output_name)
-            except distutils.errors.LinkError:
-                err_file.seek(0)
-                err_log = err_file.read()
-                raise LinkerError(err_log)
+            object_files.append(self.crtv)
+
+        try:
+            with vizh.timing.phase('linker.link'):
+                return self.c_compiler.link(self.c_compiler.EXECUTABLE, object_files, output_name,
+                                            build_temp=build.path if build else None)
+        except distutils.errors.LinkError as err:
+            raise LinkerError(str(err))
+
+    def link_shared(self, object_files, output_name, exports, build=None):
+        """Links the given object files and libv into a shared library which exports the functions named in exports.
+
+        Everything linked in, libv included, has to have been compiled to be position independent.
+        """
+        try:
+            with vizh.timing.phase('linker.link'):
+                return self.c_compiler.link(self.c_compiler.SHARED_OBJECT, object_files + [self.libv], output_name,
+                                            export_symbols=exports, build_temp=build.path if build else None)
+        except distutils.errors.LinkError as err:
+            raise LinkerError(str(err))
@@ -0,0 +1,128 @@
+"""Build manifests, which let vizh --incremental rebuild only what changed.
+
+A manifest lives in a .vizh-build directory next to the output file, along
+with the objects from the last build.
+"""
+import json
+import os
+import os.path
+import tempfile
+import vizh.cache
+import vizh.ir
+from vizh.ir import InstructionType
+
+# Bump this whenever the manifest format changes
+MANIFEST_VERSION = 1
+
+BUILD_DIR_NAME = '.vizh-build'
+MANIFEST_NAME = 'manifest.json'
+
+def build_dir_for(output_file):
+    return os.path.join(os.path.dirname(os.path.abspath(output_file)), BUILD_DIR_NAME)
+
+def hash_file(path):
+    with open(path, 'rb') as input_file:
+        return vizh.cache.hash_key(input_file.read())
+
+def callees(function):
+    """The names of the functions called by function"""
+    return sorted(set(instruction.value for instruction in function.instructions if instruction.type == InstructionType.CALL))
+
+def callers(graph, names, transitive=False):
+    """The functions in graph (a map from function name to callees) which call any of names"""
+    found = set()
+    frontier = set(names)
+    while frontier:
+        new_callers = set(caller for caller, called in graph.items() if frontier & set(called)) - found
+        found |= new_callers
+        frontier = new_callers if transitive else set()
+    return found
+
+class BuildManifest(object):
+    """Records what every input of the last build was and what was built from it.
+
+    Each entry has the content hash of the input and the object built from it.
+    Entries for vizh images also have the parsed function, and its signature
+    and callees, which tell us which other functions need rebuilding when it changes.
+
+    config describes everything else which affects the objects, like the optimization
+    level, so that changing it starts from scratch.
+    """
+    def __init__(self, build_dir, config):
+        self.build_dir = build_dir
+        self.config = config
+        self.entries = {}
+        self.output = None
+
+    def path(self):
+        return os.path.join(self.build_dir, MANIFEST_NAME)
+
+    def load(self):
+        """Reads the manifest from the last build, if there was one with the same config"""
+        try:
+            with open(self.path()) as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError):
+            return self
+        if data.get('version') != MANIFEST_VERSION or data.get('config') != self.config:
+            return self
+        self.entries = data['entries']
+        self.output = data['output']
+        return self
+
+    def save(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        data = {'version': MANIFEST_VERSION, 'config': self.config, 'entries': self.entries, 'output': self.output}
+        # Write atomically so that an interrupted build doesn't leave a corrupt manifest
+        fd, tmp_path = tempfile.mkstemp(dir=self.build_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as manifest_file:
+            json.dump(data, manifest_file, indent=1)
+        os.replace(tmp_path, self.path())
+
+    def is_current(self, path, content_hash):
+        """Whether path is unchanged since the last build and its object is still there"""
+        entry = self.entries.get(path)
+        return entry is not None and entry['hash'] == content_hash and \
+            (entry['object'] is None or os.path.exists(entry['object']))
+
+    def function(self, path):
+        return vizh.ir.function_from_json(self.entries[path]['function'])
+
+    def record(self, path, content_hash, object_file, function=None):
+        entry = {'hash': content_hash, 'object': object_file}
+        if function:
+            entry['function'] = vizh.ir.function_to_json(function)
+            entry['signature'] = [function.signature.name, function.signature.n_args]
+            entry['callees'] = callees(function)
+        self.entries[path] = entry
+
+    def functions(self):
+        """Maps function names to their entries"""
+        return {entry['signature'][0]: entry for entry in self.entries.values() if 'signature' in entry}
+
+    def dependency_graph(self):
+        """Maps the name of every function to the names of the functions it calls"""
+        return {name: entry['callees'] for name, entry in self.functions().items()}
+
+def functions_to_rebuild(old_functions, new_functions, inline):
+    """Works out which functions need to be compiled again.
+
+    old_functions maps names to the manifest entries from the last build, and
+    new_functions maps names to the functions in this build. Functions need rebuilding if
+    they're new or changed, or if they call a function whose signature changed or which
+    appeared or disappeared. If inline is set then callers of changed functions are
+    rebuilt too, all the way up the call graph, since they may have inlined the old version.
+    """
+    new_json = {name: vizh.ir.function_to_json(function) for name, function in new_functions.items()}
+    changed = set(name for name in new_functions if name not in old_functions or old_functions[name]['function'] != new_json[name])
+    removed = set(old_functions) - set(new_functions)
+
+    new_signatures = {name: function.signature.n_args for name, function in new_functions.items()}
+    changed_signatures = removed | set(name for name in changed
+                                       if name not in old_functions or old_functions[name]['signature'][1] != new_signatures[name])
+
+    graph = {name: callees(function) for name, function in new_functions.items()}
+    rebuild = changed | callers(graph, changed_signatures)
+    if inline:
+        rebuild |= callers(graph, changed | removed, transitive=True)
+    return rebuild
@@ -6,7 +6,17 @@ import platform
 from ctypes.util import find_library
 
 import cffi
+import cv2
 import numpy as np
+import vizh.timing
+
+# Anything that changes the text we get back for an image should bump this,
+# since it's part of the key for cached parse results
+OCR_VERSION = 2
+USER_DEFINED_DPI = 70
+# Function names are [a-zA-Z][a-zA-Z0-9]* and argument counts are numbers,
+# so there's no point in Tesseract considering anything else
+CHARACTER_WHITELIST = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
 ffi = cffi.FFI()
 ffi.cdef("""
@@ -99,6 +109,21 @@ ffi.cdef("""
     int TessBaseAPIRecognize(TessBaseAPI* handle, ETEXT_DESC* monitor);
     char*  TessBaseAPIGetUTF8Text(TessBaseAPI* handle);
     void   TessDeleteText(char* text);
+
+    typedef enum TessPageIteratorLevel {
+        RIL_BLOCK    = 0,
+        RIL_PARA     = 1,
+        RIL_TEXTLINE = 2,
+        RIL_WORD     = 3,
+        RIL_SYMBOL   = 4} TessPageIteratorLevel;
+
+    TessResultIterator* TessBaseAPIGetIterator(TessBaseAPI* handle);
+    void   TessResultIteratorDelete(TessResultIterator* handle);
+    BOOL   TessResultIteratorNext(TessResultIterator* handle, TessPageIteratorLevel level);
+    char*  TessResultIteratorGetUTF8Text(const TessResultIterator* handle, TessPageIteratorLevel level);
+    const TessPageIterator* TessResultIteratorGetPageIteratorConst(const TessResultIterator* handle);
+    BOOL   TessPageIteratorBoundingBox(const TessPageIterator* handle, TessPageIteratorLevel level,
+                                       int* left, int* top, int* right, int* bottom);
   
     void   TessBaseAPIEnd(TessBaseAPI* handle);
     void   TessBaseAPIDelete(TessBaseAPI* handle);
@@ -106,7 +131,10 @@ ffi.cdef("""
 
 
 def matToPix8(leptonica, im):
-    """Convert OpenCV image to leptonica PIX."""
+    """Convert OpenCV image to leptonica PIX one pixel at a time.
+
+    This is slow, prefer matToImageData, which doesn't copy the image.
+    """
     height, width = len(im), len(im[0])
     depth = 32 if type(im[0][0]) is np.ndarray else 8
     pixs = leptonica.pixCreate(width, height, depth)
@@ -120,6 +148,50 @@ def matToPix8(leptonica, im):
                 
     return pixs
 
+def matToImageData(im):
+    """Describe an OpenCV image in the form TessBaseAPISetImage expects.
+
+    Returns (data, width, height, bytes_per_pixel, bytes_per_line, owner).
+    data points straight into the NumPy buffer where possible (crops are views
+    with a row stride larger than their width, which Tesseract handles fine),
+    so owner must be kept alive until Tesseract has finished with the image.
+    Colour images are passed through in BGR order, the same as matToPix8 did.
+    """
+    if im.dtype != np.uint8:
+        im = im.astype(np.uint8)
+
+    height, width = im.shape[:2]
+    bytes_per_pixel = 1 if im.ndim == 2 else im.shape[2]
+
+    # Pixels within a row must be packed, but rows can be any distance apart
+    row_is_packed = im.strides[-1] == 1 and (im.ndim == 2 or im.strides[1] == bytes_per_pixel)
+    if not row_is_packed or im.strides[0] <= 0:
+        im = np.ascontiguousarray(im)
+
+    data = ffi.cast('const unsigned char*', im.ctypes.data)
+    return data, width, height, bytes_per_pixel, im.strides[0], im
+
+# Blank space left around each crop when tiling them for batch recognition
+BATCH_PADDING = 20
+
+def tile_images(images, padding=BATCH_PADDING):
+    """Stack images vertically on a white grayscale canvas.
+
+    Returns the canvas and the (top, bottom) rows each image was placed at.
+    """
+    grays = [im if im.ndim == 2 else cv2.cvtColor(im, cv2.COLOR_BGR2GRAY) for im in images]
+    width = max(im.shape[1] for im in grays) + 2 * padding
+    height = sum(im.shape[0] for im in grays) + (len(grays) + 1) * padding
+    canvas = np.full((height, width), 255, dtype=np.uint8)
+
+    rows = []
+    y = padding
+    for im in grays:
+        canvas[y:y + im.shape[0], padding:padding + im.shape[1]] = im
+        rows.append((y, y + im.shape[0]))
+        y += im.shape[0] + padding
+    return canvas, rows
+
 class TesseractOCR(object):
     def __init__(self):
         self.zlib = ffi.dlopen(find_library('zlib1' if os.name == 'nt' else 'z'))
@@ -140,7 +212,8 @@ class TesseractOCR(object):
         tess_data_bytes = tess_data_dir.encode('utf-8')
         self.tesseract.TessBaseAPIInit3(self.api, tess_data_bytes, ffi.NULL)
         self.tesseract.TessBaseAPISetPageSegMode(self.api, self.tesseract.PSM_SINGLE_LINE)
-        self.tesseract.TessBaseAPISetVariable(self.api, "user_defined_dpi".encode('utf-8'), "70".encode('utf-8'))
+        self.tesseract.TessBaseAPISetVariable(self.api, "user_defined_dpi".encode('utf-8'), str(USER_DEFINED_DPI).encode('utf-8'))
+        self.tesseract.TessBaseAPISetVariable(self.api, "tessedit_char_whitelist".encode('utf-8'), CHARACTER_WHITELIST.encode('utf-8'))
     
     def __enter__(self):
         return self
@@ -153,8 +226,14 @@ class TesseractOCR(object):
         ffi.dlclose(self.tesseract)
 
     def ocr(self, image):
-        pix = matToPix8(self.leptonica, image)
-        self.tesseract.TessBaseAPISetImage2(self.api, pix)
+        with vizh.timing.phase('ocr.recognise', each=True, width=image.shape[1], height=image.shape[0]):
+            return self.recognise(image)
+
+    def recognise(self, image):
+        # Tesseract copies the pixels into its own PIX in SetImage,
+        # so the NumPy buffer only needs to outlive this call
+        data, width, height, bytes_per_pixel, bytes_per_line, owner = matToImageData(image)
+        self.tesseract.TessBaseAPISetImage(self.api, data, width, height, bytes_per_pixel, bytes_per_line)
         self.tesseract.TessBaseAPIRecognize(
             self.api, ffi.NULL)
 
@@ -162,9 +241,58 @@ class TesseractOCR(object):
         decoded_text = ffi.string(text).decode('utf-8')
 
         self.tesseract.TessDeleteText(text)
-        pix_ptr = ffi.new('PIX*[1]')
-        pix_ptr[0] = pix
-        self.leptonica.pixDestroy(pix_ptr)
 
         return decoded_text
 
+    def ocr_batch(self, images):
+        """OCR several images with a single recognition pass.
+
+        The images are tiled onto one canvas, recognised together, then the
+        words Tesseract finds are handed back to the image they lie in.
+        Returns the text for each image, in order.
+        """
+        if len(images) == 0:
+            return []
+        with vizh.timing.phase('ocr.batch', each=True, images=len(images)):
+            return self.recognise_batch(images)
+
+    def recognise_batch(self, images):
+        canvas, rows = tile_images(images)
+        texts = [[] for _ in images]
+
+        data, width, height, bytes_per_pixel, bytes_per_line, owner = matToImageData(canvas)
+        self.tesseract.TessBaseAPISetImage(self.api, data, width, height, bytes_per_pixel, bytes_per_line)
+        # The canvas has one line of text per image rather than a single line
+        self.tesseract.TessBaseAPISetPageSegMode(self.api, self.tesseract.PSM_SINGLE_BLOCK)
+        try:
+            self.tesseract.TessBaseAPIRecognize(self.api, ffi.NULL)
+            iterator = self.tesseract.TessBaseAPIGetIterator(self.api)
+            if iterator != ffi.NULL:
+                try:
+                    self.collect_words(iterator, rows, texts)
+                finally:
+                    self.tesseract.TessResultIteratorDelete(iterator)
+        finally:
+            self.tesseract.TessBaseAPISetPageSegMode(self.api, self.tesseract.PSM_SINGLE_LINE)
+
+        return [' '.join(words) for words in texts]
+
+    def collect_words(self, iterator, rows, texts):
+        """Walk the words in a recognised canvas, appending each to the text of the tile it's in"""
+        level = self.tesseract.RIL_WORD
+        page_iterator = self.tesseract.TessResultIteratorGetPageIteratorConst(iterator)
+        left, top, right, bottom = (ffi.new('int*') for _ in range(4))
+
+        while True:
+            text = self.tesseract.TessResultIteratorGetUTF8Text(iterator, level)
+            if text != ffi.NULL:
+                word = ffi.string(text).decode('utf-8').strip()
+                self.tesseract.TessDeleteText(text)
+                if word and self.tesseract.TessPageIteratorBoundingBox(page_iterator, level, left, top, right, bottom):
+                    centre = (top[0] + bottom[0]) // 2
+                    for index, (tile_top, tile_bottom) in enumerate(rows):
+                        if tile_top <= centre < tile_bottom:
+                            texts[index].append(word)
+                            break
+            if not self.tesseract.TessResultIteratorNext(iterator, level):
+                break
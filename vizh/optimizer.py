@@ -0,0 +1,277 @@
+from vizh.ir import *
+
+# How each instruction contributes to a folded run
+RUN_FOLDS = {
+    InstructionType.INC: (InstructionType.ADD, 1),
+    InstructionType.DEC: (InstructionType.ADD, -1),
+    InstructionType.RIGHT: (InstructionType.MOVE_HEAD, 1),
+    InstructionType.LEFT: (InstructionType.MOVE_HEAD, -1),
+    InstructionType.DOWN: (InstructionType.MOVE_TAPE, 1),
+    InstructionType.UP: (InstructionType.MOVE_TAPE, -1),
+}
+
+def fold_contribution(instruction):
+    """Returns (folded type, amount) for an instruction which can be part of a run, otherwise None"""
+    if instruction.type in RUN_FOLDS:
+        return RUN_FOLDS[instruction.type]
+    if instruction.type in (InstructionType.ADD, InstructionType.MOVE_HEAD, InstructionType.MOVE_TAPE):
+        return (instruction.type, instruction.value)
+    return None
+
+def folded_instruction(folded_type, amount, location=None):
+    """Builds the instruction for a folded run, or None if the run has no effect"""
+    if folded_type == InstructionType.ADD:
+        # Cells are 8-bit
+        amount %= 256
+    if amount == 0:
+        return None
+    return Instruction(folded_type, amount, location)
+
+def fold_runs(instructions):
+    """Folds runs of INC/DEC into ADD, LEFT/RIGHT into MOVE_HEAD, and UP/DOWN into MOVE_TAPE.
+
+    Example:
+        INC; INC; DEC; INC; RIGHT; RIGHT; UP;
+    becomes
+        ADD(2); MOVE_HEAD(2); UP;
+    """
+    folded = []
+    run = []
+
+    def end_run():
+        # A run of one instruction is left as it is
+        if len(run) == 1:
+            folded.append(run[0])
+        elif len(run) > 1:
+            instruction = folded_instruction(fold_contribution(run[0])[0], sum(fold_contribution(i)[1] for i in run),
+                                             covering_location(run))
+            if instruction:
+                folded.append(instruction)
+        run.clear()
+
+    for instruction in instructions:
+        contribution = fold_contribution(instruction)
+        if contribution is None:
+            end_run()
+            folded.append(instruction)
+        else:
+            if run and fold_contribution(run[0])[0] != contribution[0]:
+                end_run()
+            run.append(instruction)
+    end_run()
+
+    return folded
+
+def inverse_mod_256(step):
+    """The multiplicative inverse of an odd number modulo 256"""
+    return next(inverse for inverse in range(1, 256, 2) if (step * inverse) % 256 == 1)
+
+class LoopEffect(object):
+    """The effect of a single iteration of a loop body without any nested loops or calls.
+
+    Tapes are numbered relative to the tape the loop starts on, and
+    cells relative to where that tape's head was at the start of the iteration.
+    """
+    def __init__(self):
+        self.tape = 0
+        self.heads = {}
+        self.adds = {}
+        self.accesses = []
+
+    def cell(self):
+        return (self.tape, self.heads.get(self.tape, 0))
+
+    def moved_heads(self):
+        return {tape: offset for tape, offset in self.heads.items() if offset != 0}
+
+    def changed_cells(self):
+        return {cell: amount % 256 for cell, amount in self.adds.items() if amount % 256 != 0}
+
+def simulate_loop_body(body):
+    """Works out the LoopEffect of a loop body, or None if it does anything we can't reason about"""
+    effect = LoopEffect()
+    for instruction in body:
+        contribution = fold_contribution(instruction)
+        if contribution:
+            folded_type, amount = contribution
+            if folded_type == InstructionType.ADD:
+                effect.adds[effect.cell()] = effect.adds.get(effect.cell(), 0) + amount
+            elif folded_type == InstructionType.MOVE_HEAD:
+                effect.heads[effect.tape] = effect.heads.get(effect.tape, 0) + amount
+            else:
+                effect.tape += amount
+        elif instruction.type in (InstructionType.READ, InstructionType.WRITE):
+            effect.accesses.append((instruction.type, effect.cell()))
+        else:
+            return None
+    return effect
+
+def recognise_loop_idiom(body):
+    """Recognises the body of an innermost loop as one of the idioms which can be lowered to native operations.
+
+    Returns the replacement for the whole loop, or None. The replacements are:
+
+        CLEAR
+            [-] and other loops which only step the current cell by an odd amount.
+
+        MUL_ADD(step, ((tape, offset, factor), ...))
+            Loops which step the current cell by an odd amount and add constants to
+            other cells, leaving every head where it started. The loop runs n times,
+            where n*step = -cell (mod 256), so each other cell gains factor*n.
+
+        COPY(step, source tape, source offset, destination tape, destination offset)
+            Loops which step the current cell by an odd amount and copy one cell on the
+            source tape to the destination tape through the head storage, then advance
+            both of those heads by one. This is memcopy.
+
+        SCAN(stride)
+            Loops which only move the head of the current tape.
+
+    These assume that different tapes don't overlap, which is true of all tapes vizh creates.
+    """
+    effect = simulate_loop_body(body)
+    # If we don't end up on the tape we started on then the loop condition changes every iteration
+    if effect is None or effect.tape != 0:
+        return None
+
+    moved_heads = effect.moved_heads()
+    changed_cells = effect.changed_cells()
+
+    if len(changed_cells) == 0 and len(effect.accesses) == 0:
+        if list(moved_heads) == [0]:
+            return Instruction(InstructionType.SCAN, moved_heads[0])
+        return None
+
+    # Everything else is a counted loop: it must step its own cell by an odd amount
+    # (so that it's guaranteed to reach 0) and not move its own head
+    step = changed_cells.pop((0, 0), 0)
+    if step % 2 == 0 or 0 in moved_heads:
+        return None
+
+    if len(effect.accesses) == 0 and len(moved_heads) == 0:
+        if len(changed_cells) == 0:
+            return Instruction(InstructionType.CLEAR)
+        targets = tuple(sorted((tape, offset, factor) for (tape, offset), factor in changed_cells.items()))
+        return Instruction(InstructionType.MUL_ADD, (step, targets))
+
+    if len(changed_cells) == 0 and [access for access, _ in effect.accesses] == [InstructionType.READ, InstructionType.WRITE]:
+        (source_tape, source_offset), (destination_tape, destination_offset) = [cell for _, cell in effect.accesses]
+        if source_tape != destination_tape and 0 not in (source_tape, destination_tape) \
+                and moved_heads == {source_tape: 1, destination_tape: 1}:
+            return Instruction(InstructionType.COPY, (step, source_tape, source_offset, destination_tape, destination_offset))
+
+    return None
+
+def lower_loop_idioms(instructions):
+    """Replaces innermost loops which match a known idiom (see recognise_loop_idiom)"""
+    lowered = []
+    loop_starts = []
+    for instruction in instructions:
+        if instruction.type == InstructionType.LOOP_START:
+            loop_starts.append(len(lowered))
+        elif instruction.type == InstructionType.LOOP_END and loop_starts:
+            start = loop_starts.pop()
+            # Loops containing other loops or idioms are rejected by recognise_loop_idiom
+            idiom = recognise_loop_idiom(lowered[start+1:])
+            if idiom:
+                # The idiom stands for the whole loop, so it covers everything drawn for it
+                idiom.location = covering_location(lowered[start:] + [instruction])
+                del lowered[start:]
+                lowered.append(idiom)
+                continue
+        lowered.append(instruction)
+    return lowered
+
+# Callees with more instructions than this, after their own calls have been inlined, are called instead
+MAX_INLINE_SIZE = 64
+# Calls are inlined at most this many levels deep
+MAX_INLINE_DEPTH = 4
+
+def can_inline(function):
+    """Functions which create or destroy tapes need a tape table of their own, so they can't be inlined.
+    Neither can functions with unmatched loops.
+    """
+    depth = 0
+    for instruction in function.instructions:
+        if instruction.type == InstructionType.CALL and instruction.value in ('newtape', 'freetape'):
+            return False
+        if instruction.type == InstructionType.LOOP_START:
+            depth += 1
+        elif instruction.type == InstructionType.LOOP_END:
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+class Inliner(object):
+    """Replaces calls to small functions with the bodies of those functions.
+
+    Tapes are relative to the current one in vizh, so the callee's body can be
+    used as it is: its tape k is the caller's current tape + k. Inlined bodies are
+    surrounded by INLINE_ENTER and INLINE_EXIT so that the code generator can undo
+    the callee's changes to anything which is passed by value.
+    """
+    def __init__(self, functions, max_size=MAX_INLINE_SIZE, max_depth=MAX_INLINE_DEPTH):
+        self.functions = {function.signature.name: function for function in functions}
+        self.max_size = max_size
+        self.max_depth = max_depth
+
+    def inlined_body(self, name, active):
+        """The instructions to replace a call to name with, or None if it should stay a call.
+
+        active is the list of functions we're already inlining into, which guards against recursion.
+        """
+        if name in active or len(active) > self.max_depth or name not in self.functions:
+            return None
+        function = self.functions[name]
+        if not can_inline(function):
+            return None
+
+        body = self.inline_calls(function.instructions, active + [name])
+        if len(body) > self.max_size:
+            return None
+        n_args = function.signature.n_args
+        return [Instruction(InstructionType.INLINE_ENTER, n_args)] + body + [Instruction(InstructionType.INLINE_EXIT, n_args)]
+
+    def inline_calls(self, instructions, active=[]):
+        inlined = []
+        for instruction in instructions:
+            if instruction.type == InstructionType.CALL:
+                body = self.inlined_body(instruction.value, active)
+                if body is not None:
+                    inlined += body
+                    continue
+            inlined.append(instruction)
+        return inlined
+
+def inline_functions(functions, library=[]):
+    """Inlines calls between the given functions and to the library functions written in vizh"""
+    # Functions being compiled shadow library functions with the same name
+    inliner = Inliner(list(library) + list(functions))
+    return [Function(function.signature, inliner.inline_calls(function.instructions, [function.signature.name]), function.source)
+            for function in functions]
+
+# Inlining needs to see every function at once, so it runs before the other passes at this level
+INLINE_LEVEL = 2
+
+# Passes are run in order if the optimization level is at least their minimum level
+PASSES = [
+    (1, fold_runs),
+    (1, lower_loop_idioms),
+]
+
+def optimize_function(function, level):
+    instructions = function.instructions
+    for min_level, optimization_pass in PASSES:
+        if level >= min_level:
+            instructions = optimization_pass(instructions)
+    return Function(function.signature, instructions, function.source)
+
+def optimize(functions, level, library=[]):
+    """Runs the optimization pipeline over the given functions, returning the optimized functions.
+
+    library holds the IR of functions which are linked in later, which may be inlined.
+    """
+    if level >= INLINE_LEVEL:
+        functions = inline_functions(functions, library)
+    return [optimize_function(function, level) for function in functions]
@@ -2,10 +2,24 @@ import cv2
 import numpy as np
 from vizh.ir import *
 import vizh.ocr
+import vizh.recogniser
+import vizh.timing
 from enum import Enum, auto
 import sys
 from collections import namedtuple
 import itertools
+import os.path
+
+# Bump this whenever a change to the parser could change its output for an image,
+# since it's part of the key for cached parse results
+PARSER_VERSION = 2
+
+# Pixels lighter than this are background
+BINARY_THRESHOLD = 240
+# Size of the dilation kernel which merges the characters of the signature into blobs
+SIGNATURE_KERNEL_SIZE = 18
+# Tolerance for polygon approximation as a fraction of the contour's perimeter
+POLYGON_EPSILON = 0.01
 
 def crop_by_bounding_box(image, box):
     x,y,w,h = box
@@ -36,7 +50,8 @@ def recognise_instruction_lines(instructions):
 
     return lines
 
-def decorate_and_show_image(img, lines, y_offset):
+def decorate_lines(img, lines, y_offset):
+    """Draws a box around each line of instructions and writes every instruction's name above it"""
     for line in lines:
         # We're going to draw a box around the line, so find the min y and max x for the line
         min_y = min(line, key=lambda i: i.bounding_box[1]).bounding_box[1]
@@ -52,22 +67,59 @@ def decorate_and_show_image(img, lines, y_offset):
         for bounding_box, instruction in line:
             write_text(img, str(instruction), bounding_box[0], min_y+y_offset)
 
+def decorate_and_show_image(img, lines, y_offset):
+    decorate_lines(img, lines, y_offset)
     cv2.imshow('Debug', img)
     cv2.waitKey(0)
 
 class Parser(object):
-    def __init__(self):
-        self.ocr = vizh.ocr.TesseractOCR()
+    def __init__(self, cache=None, interactive=True, batch_ocr=False, recogniser=None):
+        """cache is an optional vizh.cache.ParseCache to look up and store results in.
+
+        If interactive is False then parse errors are printed rather than shown in a window.
+
+        If batch_ocr is True then all the text in an image is recognised in a single
+        Tesseract pass rather than one pass per function call and signature element.
+
+        recogniser is an optional vizh.recogniser.TemplateRecogniser which is tried
+        on function calls before falling back to OCR. Names it doesn't know about
+        are learned from the signatures of the images parsed.
+        """
+        self.cache = cache
+        self.interactive = interactive
+        self.batch_ocr = batch_ocr
+        self.recogniser = recogniser
+        self.pending_calls = []
+        # Results which call names the recogniser only knows from earlier images depend
+        # on the order images are parsed in, so they aren't cached
+        self.cacheable = True
+        self._ocr = None
+
+    @property
+    def ocr(self):
+        # Tesseract is only loaded the first time we actually need to read text,
+        # so builds where every image is cached never pay for it
+        if self._ocr is None:
+            self._ocr = vizh.ocr.TesseractOCR()
+        return self._ocr
 
     def __enter__(self):
         return self
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
-        self.ocr.__exit__(exception_type, exception_value, exception_traceback)
+        if self._ocr is not None:
+            self._ocr.__exit__(exception_type, exception_value, exception_traceback)
 
-    def parse_function_signature(self, img, threshold):
+    def cache_config(self):
+        """Everything other than the image which determines the result of a parse"""
+        return (f'parser={PARSER_VERSION};ocr={vizh.ocr.OCR_VERSION};dpi={vizh.ocr.USER_DEFINED_DPI};'
+                f'threshold={BINARY_THRESHOLD};kernel={SIGNATURE_KERNEL_SIZE};epsilon={POLYGON_EPSILON};'
+                f'batch={self.batch_ocr};{self.recogniser.config() if self.recogniser else "recogniser=None"}')
+
+    def find_function_signature(self, threshold):
+        """Finds the bounding boxes of the function name and the number of arguments"""
         # We want to find largeish rectangles of text
-        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (18, 18))
+        rect_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (SIGNATURE_KERNEL_SIZE, SIGNATURE_KERNEL_SIZE))
     
         # Dilate the image so that characters in the token aren't separated
         dilation = cv2.dilate(threshold, rect_kernel, iterations = 1)
@@ -78,31 +130,57 @@ class Parser(object):
 
         # Sort to find the two contours closest to the top of the image
         y_sorter = lambda c: cv2.boundingRect(c)[1]
-        text_contours.sort(reverse=False, key=y_sorter)
+        text_contours = sorted(text_contours, reverse=False, key=y_sorter)
 
         # Sort by x to have the first element be the function name and the second be the number of args
         x_sorter = lambda c: cv2.boundingRect(c)[0]
         signature = sorted(text_contours[:2], key=x_sorter)
 
+        return cv2.boundingRect(signature[0]), cv2.boundingRect(signature[1])
+
+    def parse_function_signature(self, img, threshold):
+        func_rect, arg_rect = self.find_function_signature(threshold)
+
         # OCR the function name
-        func_rect = cv2.boundingRect(signature[0])
         function_name = self.ocr.ocr(crop_by_bounding_box(img,func_rect)).strip()
 
         # OCR the number of arguments
-        arg_rect = cv2.boundingRect(signature[1])
         n_args = self.ocr.ocr(crop_by_bounding_box(img,arg_rect)).strip()
 
         return ((function_name, func_rect), (int(n_args), arg_rect))
 
+    def recognise_batched_text(self, img, func_rect, arg_rect):
+        """OCR the signature and every call found so far in one go.
+
+        Fills in the function names of the pending calls and returns
+        the function name, the number of arguments, and any errors.
+        """
+        crops = [crop_by_bounding_box(img, func_rect), crop_by_bounding_box(img, arg_rect)]
+        crops += [function_image for _, _, function_image in self.pending_calls]
+        texts = [text.strip() for text in self.ocr.ocr_batch(crops)]
+
+        errors = []
+        for (instruction, contour, function_image), function_name in zip(self.pending_calls, texts[2:]):
+            if function_name == '':
+                errors.append(ParseError("Found a circle, but couldn't parse a function name inside it", contour))
+            elif self.recogniser and function_name in self.recogniser:
+                self.recogniser.learn(function_name, function_image)
+            instruction.value = function_name
+        self.pending_calls = []
+
+        return texts[0], int(texts[1]), errors
+
     def parse_contours(self, img, shape_contours):
         instructions = []
         errors = []
         for contour in shape_contours:
-            approx = cv2.approxPolyDP(contour, 0.01* cv2.arcLength(contour, True), True)
-            points = [point.ravel() for point in approx]
-            bounding_rect = cv2.boundingRect(contour)
+            with vizh.timing.phase('parser.approx_poly'):
+                approx = cv2.approxPolyDP(contour, POLYGON_EPSILON * cv2.arcLength(contour, True), True)
+                points = [point.ravel() for point in approx]
+                bounding_rect = cv2.boundingRect(contour)
             try:
-                instruction = self.parse_polygon(img, contour, points)
+                with vizh.timing.phase('parser.classify'):
+                    instruction = self.parse_polygon(img, contour, points)
                 if instruction:
                     instructions.append(InstructionData(bounding_rect, instruction))
             except ParseError as err:
@@ -160,35 +238,111 @@ class Parser(object):
             function_image = crop_by_bounding_box(img, cv2.boundingRect(contour))
             # Inverting first helps OCR
             inverse_function_image = cv2.bitwise_not(function_image)
+
+            # Most calls are to functions we already know, which are cheap to recognise
+            if self.recogniser:
+                with vizh.timing.phase('parser.templates'):
+                    function_name = self.recogniser.recognise(inverse_function_image)
+                if function_name:
+                    if function_name not in self.recogniser.names:
+                        self.cacheable = False
+                    return Instruction(InstructionType.CALL, function_name)
+
+            # In batch mode the name is filled in once the whole image has been scanned
+            if self.batch_ocr:
+                instruction = Instruction(InstructionType.CALL)
+                self.pending_calls.append((instruction, contour, inverse_function_image))
+                return instruction
+
             function_name = self.ocr.ocr(inverse_function_image).strip()
             if function_name == '':
                 raise ParseError("Found a circle, but couldn't parse a function name inside it")
+            if self.recogniser and function_name in self.recogniser:
+                self.recogniser.learn(function_name, inverse_function_image)
             return Instruction(InstructionType.CALL, function_name)
 
         raise ParseError("Didn't recognise the instruction")
 
     def parse(self, img_file, debug=False):
-        img = cv2.imread(img_file)
-
-        # Convert the image to grayscale
-        gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
-
-        # Binarise the image
-        ret, threshold = cv2.threshold(gray, 240 , 255, cv2.CHAIN_APPROX_NONE)
-
-        (function_name, function_name_box), (n_args, argument_box) = self.parse_function_signature(img, threshold) 
+        with vizh.timing.phase('parser.parse', file=img_file):
+            return self.parse_file(img_file, debug)
+
+    def parse_file(self, img_file, debug):
+        with vizh.timing.phase('parser.read'):
+            with open(img_file, 'rb') as f:
+                image_bytes = f.read()
+
+        # Debugging needs the image decorated, so always parse it for real
+        if self.cache and not debug:
+            with vizh.timing.phase('parser.cache'):
+                function = self.cache.get(image_bytes, self.cache_config())
+            if function:
+                function.source = os.path.abspath(img_file)
+                return function
+
+        with vizh.timing.phase('parser.decode'):
+            img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+        function = self.parse_image(img, img_file, debug)
+
+        if self.cache and function and self.cacheable:
+            with vizh.timing.phase('parser.cache'):
+                self.cache.put(image_bytes, self.cache_config(), function)
+        if function:
+            # The same image can live in different places, so this isn't cached
+            function.source = os.path.abspath(img_file)
+        return function
+
+    def parse_image(self, img, img_file, debug=False):
+        self.cacheable = True
+        if self.recogniser:
+            self.recogniser.forget()
+
+        with vizh.timing.phase('parser.threshold'):
+            # Convert the image to grayscale
+            gray = cv2.cvtColor(img,cv2.COLOR_BGR2GRAY)
+
+            # Binarise the image
+            ret, threshold = cv2.threshold(gray, BINARY_THRESHOLD, 255, cv2.CHAIN_APPROX_NONE)
+
+        with vizh.timing.phase('parser.signature'):
+            if self.batch_ocr:
+                self.pending_calls = []
+                function_name_box, argument_box = self.find_function_signature(threshold)
+            else:
+                (function_name, function_name_box), (n_args, argument_box) = self.parse_function_signature(img, threshold)
         bottom_of_signature_area = max(function_name_box[1] + function_name_box[3], argument_box[1] + argument_box[3])
 
         # Crop the image from the bottom of the signature area to get the statements area
         statements = threshold[bottom_of_signature_area:, :]
         
         # Find all shapes in the statements area
-        shape_contours, _ = cv2.findContours(statements, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        with vizh.timing.phase('parser.find_contours'):
+            shape_contours, _ = cv2.findContours(statements, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
 
         instructions, errors = self.parse_contours(statements, shape_contours)
-        lines = recognise_instruction_lines(instructions)
+        if self.batch_ocr:
+            function_name, n_args, call_errors = self.recognise_batched_text(img, function_name_box, argument_box)
+            errors += call_errors
+
+        # Other images in this build may call this function
+        if self.recogniser and function_name:
+            self.recogniser.add_name(function_name)
+
+        with vizh.timing.phase('parser.lines'):
+            lines = recognise_instruction_lines(instructions)
+
+        # Boxes are relative to the statements area, but locations are in the whole image
+        for (x, y, w, h), instruction in instructions:
+            instruction.location = (x, y + bottom_of_signature_area, w, h)
             
-        if len(errors) > 0:
+        if len(errors) > 0 and not self.interactive:
+            # Nowhere to show the image, so describe where the bad tokens are instead
+            print(f"Error parsing {img_file}:", file=sys.stdout)
+            for err in errors:
+                box = cv2.boundingRect(err.contour)
+                print(f"  at ({box[0]}, {box[1]+bottom_of_signature_area}): {err}", file=sys.stdout)
+
+        elif len(errors) > 0:
             print(f"Error parsing {img_file} (see image for details)", file=sys.stdout)
             # Draw rectangles around all the bad tokens
             for err in errors:
@@ -205,7 +359,8 @@ class Parser(object):
             write_text(img, 'Arguments: ' + str(n_args), argument_box[0]-100,argument_box[1]+argument_box[3]+20)
             decorate_and_show_image(img, lines, bottom_of_signature_area)
 
-        cv2.destroyAllWindows()
+        if debug or (len(errors) > 0 and self.interactive):
+            cv2.destroyAllWindows()
 
         if len(errors) > 0:
             return None
@@ -0,0 +1,140 @@
+"""A build which overlaps parsing, code generation, C compilation and linking.
+
+Images are parsed in a pool of processes, and each function is compiled to its own
+self-contained translation unit as soon as the signatures of the functions it calls
+are known, so the C compiler runs while Tesseract is still reading other images.
+User C files start compiling straight away, and linking starts when the last object is ready.
+"""
+import asyncio
+import concurrent.futures
+import sys
+import vizh.compiler
+import vizh.ir
+import vizh.linker
+import vizh.manifest
+import vizh.timing
+
+class Pipeline(object):
+    """Runs the stages of a build concurrently on an asyncio event loop.
+
+    Parsing happens in a pool of up to jobs processes, and C compilation in a pool of jobs
+    threads, since the C compiler runs in its own process anyway.
+    """
+    def __init__(self, compiler, linker, jobs, build, use_parse_cache=True, batch_ocr=False, use_templates=True):
+        self.compiler = compiler
+        self.linker = linker
+        self.jobs = jobs
+        self.parse_options = (use_parse_cache, batch_ocr, use_templates, vizh.timing.current is not None)
+        self.build = build
+        # Maps function names to futures for the parsed functions. These resolve
+        # to None for functions which won't be parsed, like ones defined in C.
+        self.functions = {}
+        self.parsing_done = False
+        self.errors = []
+
+    def function_future(self, name):
+        if name not in self.functions:
+            self.functions[name] = self.loop.create_future()
+            # Functions we first hear of after parsing won't be parsed
+            if self.parsing_done:
+                self.functions[name].set_result(None)
+        return self.functions[name]
+
+    def run(self, vizh_source_files, c_source_files, supplied_object_files, output_file):
+        """Builds an executable, returning whether it succeeded"""
+        # Imported here because vizh.driver imports this module
+        import vizh.driver
+
+        self.loop = asyncio.new_event_loop()
+        parse_pool = concurrent.futures.ProcessPoolExecutor(max(1, min(self.jobs, len(vizh_source_files))),
+                                                            initializer=vizh.driver.init_parse_worker, initargs=self.parse_options)
+        self.compile_pool = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        try:
+            return self.loop.run_until_complete(self.build_all(parse_pool, vizh_source_files, c_source_files, supplied_object_files, output_file))
+        finally:
+            parse_pool.shutdown()
+            self.compile_pool.shutdown()
+            self.loop.close()
+
+    async def build_all(self, parse_pool, vizh_source_files, c_source_files, supplied_object_files, output_file):
+        import vizh.driver
+
+        c_tasks = [self.loop.create_task(self.compile_c(file)) for file in c_source_files]
+        function_tasks = []
+
+        parses = [self.loop.run_in_executor(parse_pool, vizh.driver.parse_in_worker, file) for file in vizh_source_files]
+        for parse in asyncio.as_completed(parses):
+            function, diagnostics, timings = await parse
+            vizh.timing.merge(timings)
+            if diagnostics:
+                print(diagnostics, end='', file=sys.stdout)
+            if function is None:
+                self.errors.append(None)
+                continue
+            future = self.function_future(function.signature.name)
+            if future.done():
+                self.errors.append(f'{function.signature.name} is defined more than once')
+                continue
+            future.set_result(function)
+            function_tasks.append(self.loop.create_task(self.compile_function(function)))
+
+        # Everything which is going to be parsed has been, so any other callees are defined elsewhere
+        self.parsing_done = True
+        for future in self.functions.values():
+            if not future.done():
+                future.set_result(None)
+
+        objects = await asyncio.gather(*(c_tasks + function_tasks))
+        if self.errors:
+            for error in self.errors:
+                if error:
+                    print(error, file=sys.stderr)
+            print("Compilation failed :(", file=sys.stderr)
+            return False
+
+        link_crtv = 'main' in self.functions and self.functions['main'].result() is not None
+        try:
+            await self.loop.run_in_executor(None, self.linker.link, supplied_object_files + objects, output_file, link_crtv, self.build)
+        except vizh.linker.LinkerError as err:
+            print(f'C compiler reported an error in linking:\n{err}', file=sys.stderr)
+            return False
+        return True
+
+    async def compile_c(self, file):
+        try:
+            objects = await self.loop.run_in_executor(self.compile_pool, self.compiler.compile_c_programs, [file], self.build.objects())
+            return objects[0]
+        except vizh.compiler.CompilerError as err:
+            self.errors.append(f'C compiler reported an error in compiling {file}:\n{err}')
+
+    async def compile_function(self, function):
+        """Generates and compiles a translation unit for a function once we know about the functions it calls"""
+        callees = [name for name in vizh.manifest.callees(function)
+                   if name not in ('newtape', 'freetape') and name not in self.known_externs()]
+        callee_functions = [await self.function_future(name) for name in callees]
+        callee_functions = [callee for callee in callee_functions if callee is not None]
+
+        # Compiling renames main, so use a copy
+        function = vizh.ir.function_from_json(vizh.ir.function_to_json(function))
+        externs = [callee.signature for callee in callee_functions]
+        # Only the direct callees are available for inlining, so that the code doesn't depend
+        # on the order images are parsed in. Inlining a callee brings its calls into this function,
+        # so callees which call anything we don't have a signature for aren't inlined.
+        declared = set(callees) | self.known_externs() | {'newtape', 'freetape'}
+        library = self.compiler.library + [callee for callee in callee_functions
+                                           if set(vizh.manifest.callees(callee)) <= declared]
+        try:
+            code = self.compiler.compile_functions_to_c([function], externs, library)
+        except vizh.compiler.CompilerError as err:
+            self.errors.append(str(err))
+            return None
+
+        try:
+            objects, _ = await self.loop.run_in_executor(self.compile_pool, self.compiler.compile_generated,
+                                                         [(function.signature.name, code)], self.build)
+            return objects[0]
+        except vizh.compiler.CompilerError as err:
+            self.errors.append(f'C compiler reported an error in compiling {function.signature.name}:\n{err}')
+
+    def known_externs(self):
+        return set(signature.name for signature in vizh.compiler.libv_decls)
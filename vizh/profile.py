@@ -0,0 +1,158 @@
+"""Reports on the profiles written by programs built with vizh --profile.
+
+A profile has, for every function which ran, how many times each of its
+instructions ran and how many clock ticks were spent in the calls each one made,
+along with where the instruction was drawn. The report prints the hottest
+instructions, and draws a heatmap of every function over its source image.
+"""
+import click
+import json
+import math
+import os
+import os.path
+import sys
+import cv2
+import numpy as np
+import vizh.parser
+
+# Bump this whenever libv's profile format changes
+PROFILE_VERSION = 1
+
+DEFAULT_PROFILE_FILE = 'vizh-profile.json'
+# How opaque the heat is over the image
+HEAT_OPACITY = 0.6
+
+class ProfileError(Exception):
+    pass
+
+class Site(object):
+    """One instruction in a profile"""
+    def __init__(self, function, index, data):
+        self.function = function
+        self.index = index
+        self.instruction = data['instruction']
+        self.location = tuple(data['location']) if data['location'] is not None else None
+        self.count = data['count']
+        self.cycles = data['cycles']
+
+class FunctionProfile(object):
+    def __init__(self, data):
+        self.name = data['name']
+        self.source = data['source']
+        self.calls = data['calls']
+        self.cycles = data['cycles']
+        self.sites = [Site(self, index, site) for index, site in enumerate(data['sites'])]
+
+class Profile(object):
+    def __init__(self, data):
+        if data.get('version') != PROFILE_VERSION:
+            raise ProfileError(f'Profile version {data.get("version")} is not supported')
+        # Whether clock ticks are CPU cycles or nanoseconds depends on the platform
+        self.clock = data['clock']
+        self.functions = [FunctionProfile(function) for function in data['functions']]
+
+    @staticmethod
+    def load(path):
+        try:
+            with open(path) as profile_file:
+                return Profile(json.load(profile_file))
+        except (OSError, ValueError, KeyError) as err:
+            raise ProfileError(f"Couldn't read the profile in {path}: {err}")
+
+    def sites(self):
+        return [site for function in self.functions for site in function.sites]
+
+    def hottest(self, n):
+        """The n instructions which ran the most, hottest first"""
+        return sorted(self.sites(), key=lambda site: (-site.count, -site.cycles))[:n]
+
+def format_count(count):
+    """A short label for a count, like 950, 12k or 3.4M"""
+    for suffix, scale in (('G', 10**9), ('M', 10**6), ('k', 10**3)):
+        if count >= scale:
+            value = count / scale
+            return f'{value:.1f}{suffix}' if value < 10 else f'{value:.0f}{suffix}'
+    return str(count)
+
+def format_table(profile, top):
+    """The text table of the top instructions, followed by the time spent in each function"""
+    total = sum(site.count for site in profile.sites()) or 1
+    lines = [f'{"Count":>12} {"%":>6} {f"Call {profile.clock}":>14}  {"Function":<16} {"#":>4}  {"Instruction":<20} Location']
+    for site in profile.hottest(top):
+        location = '({}, {}) {}x{}'.format(*site.location) if site.location else '-'
+        cycles = str(site.cycles) if site.cycles else ''
+        lines.append(f'{site.count:>12} {100 * site.count / total:>5.1f}% {cycles:>14}  '
+                     f'{site.function.name:<16} {site.index:>4}  {site.instruction:<20} {location}')
+
+    lines += ['', f'{"Calls":>12} {f"Total {profile.clock}":>21}  Function']
+    for function in sorted(profile.functions, key=lambda function: -function.cycles):
+        lines.append(f'{function.calls:>12} {function.cycles:>21}  {function.name}')
+    return '\n'.join(lines)
+
+def heat(count, max_count):
+    """How hot a count is between 0 and 1. Counts vary wildly, so this is logarithmic."""
+    if count == 0:
+        return 0.0
+    return math.log1p(count) / math.log1p(max_count)
+
+def draw_heatmap(img, sites, max_count):
+    """Shades each instruction which ran by how hot it is, and labels it with its count, over img"""
+    ran = [site for site in sites if site.location and site.count > 0]
+    if not ran:
+        return img
+
+    overlay = img.copy()
+    # Hotter instructions are drawn last so they stay visible when boxes overlap
+    for site in sorted(ran, key=lambda site: site.count):
+        x, y, w, h = site.location
+        level = np.uint8([[round(255 * heat(site.count, max_count))]])
+        colour = tuple(int(c) for c in cv2.applyColorMap(level, cv2.COLORMAP_JET)[0][0])
+        cv2.rectangle(overlay, (x, y), (x + w, y + h), colour, -1)
+    img = cv2.addWeighted(overlay, HEAT_OPACITY, img, 1 - HEAT_OPACITY, 0)
+
+    # Label the counts the same way the parser's debug view labels instructions
+    data = [vizh.parser.InstructionData(site.location, format_count(site.count)) for site in ran]
+    vizh.parser.decorate_lines(img, vizh.parser.recognise_instruction_lines(data), 0)
+    return img
+
+def heatmap_path(function, output_dir):
+    name = os.path.splitext(os.path.basename(function.source))[0]
+    return os.path.join(output_dir, f'{name}.profile.png')
+
+def write_heatmaps(profile, output_dir):
+    """Writes a heatmap for every function with a source image, returning their paths"""
+    max_count = max([site.count for site in profile.sites()], default=0)
+    written = []
+    for function in profile.functions:
+        if function.source is None:
+            continue
+        img = cv2.imread(function.source, cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"Couldn't read {function.source}, so there's no heatmap for {function.name}", file=sys.stderr)
+            continue
+        path = heatmap_path(function, output_dir)
+        cv2.imwrite(path, draw_heatmap(img, function.sites, max_count))
+        written.append(path)
+    return written
+
+@click.command()
+@click.argument('profile_file', type=click.Path(exists=True), default=DEFAULT_PROFILE_FILE)
+@click.option('-n', '--top', 'top', type=click.IntRange(min=1), default=20, help="Number of instructions to list.")
+@click.option('-d', '--output-dir', 'output_dir', type=click.Path(file_okay=False), default='.', help="Directory to write the heatmaps to.")
+@click.option('--no-images', 'no_images', is_flag=True, help="Only print the table, without drawing heatmaps.")
+def report(profile_file, top, output_dir, no_images):
+    """Shows where a program built with --profile spent its time.
+
+    Prints the hottest instructions, and draws the counts of every instruction over
+    the image it came from as NAME.profile.png.
+    """
+    try:
+        profile = Profile.load(profile_file)
+    except ProfileError as err:
+        raise click.ClickException(str(err))
+
+    print(format_table(profile, top))
+    if not no_images:
+        os.makedirs(output_dir, exist_ok=True)
+        for path in write_heatmaps(profile, output_dir):
+            print('Heatmap:', path)
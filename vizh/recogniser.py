@@ -0,0 +1,138 @@
+import hashlib
+import cv2
+import numpy as np
+import vizh.render
+
+# Bump this whenever a change here could change which name an image is recognised as,
+# since it's part of the key for cached parse results
+RECOGNISER_VERSION = 2
+
+# Every glyph image is scaled to this size (height, width) before comparison
+TEMPLATE_SIZE = (32, 128)
+# Minimum normalised cross-correlation for a match to be trusted. Names drawn by vizh.render score
+# 1.0 against the rendered templates, but the hand drawn names in samples score from 0.45 to 0.82
+# against their own and up to 0.48 against others, so those are left to the OCR and learned templates.
+DEFAULT_CONFIDENCE = 0.9
+# The best match must beat the best match for any other name by at least this much
+MIN_MARGIN = 0.03
+# Candidates whose width/height ratio differs from the image's by more than this factor are skipped
+MAX_ASPECT_RATIO_DIFFERENCE = 1.5
+# Learned templates kept per name
+MAX_TEMPLATES_PER_NAME = 8
+
+def libv_names():
+    """The names of every function in libv"""
+    try:
+        import vizh.libv_decls
+        return [signature.name for signature in vizh.libv_decls.libv_decls]
+    except ImportError:
+        # If we're compiling libv itself then it doesn't exist yet
+        return []
+
+def normalise_glyphs(image):
+    """Trims an image of dark text on a light background to its ink and scales it to TEMPLATE_SIZE.
+
+    Returns (glyphs, aspect ratio), or None if there's no ink.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    ink = gray < 128
+    ys, xs = np.nonzero(ink)
+    if len(ys) == 0:
+        return None
+
+    trimmed = ink[ys.min():ys.max()+1, xs.min():xs.max()+1].astype(np.float32)
+    aspect_ratio = trimmed.shape[1] / trimmed.shape[0]
+    glyphs = cv2.resize(trimmed, (TEMPLATE_SIZE[1], TEMPLATE_SIZE[0]), interpolation=cv2.INTER_AREA)
+    return glyphs, aspect_ratio
+
+def render_name(name):
+    """Draws a name in black on a white background, the way vizh.render draws it in a call"""
+    (width, height), baseline = cv2.getTextSize(name, vizh.render.CALL_FONT, vizh.render.CALL_SCALE, vizh.render.CALL_THICKNESS)
+    img = np.full((height + baseline + 8, width + 8), 255, dtype=np.uint8)
+    cv2.putText(img, name, (4, height + 4), vizh.render.CALL_FONT, vizh.render.CALL_SCALE, 0, vizh.render.CALL_THICKNESS, cv2.LINE_8)
+    return img
+
+class TemplateRecogniser(object):
+    """Recognises images of known function names by comparing them against templates.
+
+    Every name starts with a template rendered the way vizh.render draws it, and
+    gains templates from the image being parsed as the OCR confirms them through
+    learn. Those are forgotten before the next image, so that what's recognised
+    in an image never depends on which images were parsed before it.
+    """
+    def __init__(self, names=(), confidence=DEFAULT_CONFIDENCE):
+        self.confidence = confidence
+        # The names given up front, rather than added from the signatures of the images parsed
+        self.names = frozenset(names)
+        self.templates = {}
+        self.learned = {}
+        for name in sorted(self.names):
+            self.add_name(name)
+
+    def __contains__(self, name):
+        return name in self.templates
+
+    def config(self):
+        """The settings which determine how this recogniser behaves.
+
+        Names added later and learned templates aren't included, so callers
+        mustn't cache results which depend on added names. Learned templates
+        only last for one image, which is part of the key anyway.
+        """
+        names = hashlib.sha256('\0'.join(sorted(self.names)).encode('utf-8')).hexdigest()
+        return f'recogniser={RECOGNISER_VERSION};confidence={self.confidence};margin={MIN_MARGIN};names={names}'
+
+    def add_name(self, name):
+        if name in self.templates:
+            return
+        normalised = normalise_glyphs(render_name(name))
+        self.templates[name] = [normalised] if normalised else []
+
+    def learn(self, name, image):
+        """Use an image which is known to contain name as a template until forget is called"""
+        normalised = normalise_glyphs(image)
+        if not normalised:
+            return
+        self.add_name(name)
+        templates = self.learned.setdefault(name, [])
+        # Keep the most recently learned ones
+        if len(templates) >= MAX_TEMPLATES_PER_NAME:
+            del templates[0]
+        templates.append(normalised)
+
+    def forget(self):
+        """Forgets every learned template, before parsing another image"""
+        self.learned = {}
+
+    def match(self, image):
+        """Returns (name, score, runner up score) for the best matching template.
+
+        The runner up score is the best score for any other name.
+        """
+        normalised = normalise_glyphs(image)
+        if not normalised:
+            return None, 0, 0
+        glyphs, aspect_ratio = normalised
+
+        scores = {}
+        for name, templates in self.templates.items():
+            for template, template_aspect_ratio in templates + self.learned.get(name, []):
+                ratio = max(aspect_ratio, template_aspect_ratio) / min(aspect_ratio, template_aspect_ratio)
+                if ratio > MAX_ASPECT_RATIO_DIFFERENCE:
+                    continue
+                # The images are the same size, so this gives a single score
+                score = float(cv2.matchTemplate(glyphs, template, cv2.TM_CCOEFF_NORMED)[0][0])
+                scores[name] = max(score, scores.get(name, 0))
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if len(ranked) == 0:
+            return None, 0, 0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0
+        return ranked[0][0], ranked[0][1], runner_up
+
+    def recognise(self, image):
+        """Returns the name in the image if we're confident about it, otherwise None"""
+        name, score, runner_up = self.match(image)
+        if score >= self.confidence and score - runner_up >= MIN_MARGIN:
+            return name
+        return None
@@ -0,0 +1,211 @@
+"""Draws vizh functions as images which vizh.parser reads back as the same function.
+
+This is mostly for generating programs to test and benchmark the parser with.
+The signature goes across the top, with the name on the left and the number of
+arguments on the right, and the instructions are laid out in lines under it,
+wrapping at a maximum width. Every instruction is drawn as the shape
+Parser.parse_polygon expects:
+
+    LEFT, RIGHT, UP, DOWN   filled arrows, with heads at 45 degrees
+    READ, WRITE             filled triangles pointing up and down
+    INC                     a plus drawn with thin strokes
+    DEC                     a filled bar
+    LOOP_START, LOOP_END    [ and ] drawn with thin strokes
+    CALL                    the function name in an ellipse
+
+The instructions the optimizer produces don't have shapes, so they can't be drawn.
+"""
+import cv2
+import numpy as np
+from vizh.ir import InstructionType
+
+# The height of an arrow, and the size everything else is scaled from
+DEFAULT_SYMBOL_SIZE = 48
+# The parser can't tell which way smaller arrows point
+MIN_SYMBOL_SIZE = 40
+# Lines wrap before getting wider than this
+DEFAULT_MAX_WIDTH = 1600
+
+MARGIN = 40
+# Horizontal space between instructions, and vertical space between lines
+SYMBOL_GAP = 16
+LINE_GAP = 32
+# Space between the signature and the first line. The parser dilates the signature,
+# so this has to be well over its kernel size.
+SIGNATURE_GAP = 64
+STROKE = 2
+
+SIGNATURE_FONT = cv2.FONT_HERSHEY_SIMPLEX
+SIGNATURE_SCALE = 2
+SIGNATURE_THICKNESS = 4
+# Call names are drawn like vizh.recogniser renders its templates, so they're recognised without OCR.
+# Everything is drawn without antialiasing, so the shapes are the same once the parser thresholds them.
+CALL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+CALL_SCALE = 1
+CALL_THICKNESS = 2
+# Space between a call's name and its ellipse. The parser draws over the ellipse
+# with a 10 pixel pen before reading the name, so this must be more than 5.
+CALL_PADDING = 14
+MIN_ELLIPSE_RATIO = 0.5
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+
+class RenderError(Exception):
+    pass
+
+def right_arrow(size):
+    """The points of an arrow pointing right in a size by size box, with a head at 45 degrees"""
+    shaft, head = 0.18 * size, 0.45 * size
+    neck = size - head
+    middle = size / 2
+    return [(0, middle - shaft), (neck, middle - shaft), (neck, middle - head), (size, middle),
+            (neck, middle + head), (neck, middle + shaft), (0, middle + shaft)]
+
+def transpose(points):
+    return [(y, x) for x, y in points]
+
+def mirror(points, size):
+    return [(size - x, y) for x, y in points]
+
+def arrow(instruction_type, size):
+    points = right_arrow(size)
+    if instruction_type == InstructionType.LEFT:
+        return mirror(points, size)
+    if instruction_type == InstructionType.DOWN:
+        return transpose(points)
+    if instruction_type == InstructionType.UP:
+        return transpose(mirror(points, size))
+    return points
+
+def triangle(instruction_type, size):
+    """A triangle whose sides are 30 degrees from vertical, pointing up for READ and down for WRITE"""
+    half_width = size * np.tan(np.radians(30))
+    if instruction_type == InstructionType.READ:
+        return [(half_width, 0), (2 * half_width, size), (0, size)]
+    return [(0, 0), (2 * half_width, 0), (half_width, size)]
+
+ARROWS = (InstructionType.LEFT, InstructionType.RIGHT, InstructionType.UP, InstructionType.DOWN)
+TRIANGLES = (InstructionType.READ, InstructionType.WRITE)
+
+class Renderer(object):
+    """Lays out and draws functions. symbol_size scales every shape, and lines wrap at max_width."""
+    def __init__(self, symbol_size=DEFAULT_SYMBOL_SIZE, max_width=DEFAULT_MAX_WIDTH):
+        if symbol_size < MIN_SYMBOL_SIZE:
+            raise RenderError(f"Symbols smaller than {MIN_SYMBOL_SIZE} pixels can't be parsed")
+        self.size = symbol_size
+        self.max_width = max_width
+
+    def symbol_size(self, instruction):
+        """The (width, height) of an instruction's shape"""
+        if instruction.type in ARROWS:
+            return self.size, self.size
+        if instruction.type in TRIANGLES:
+            return int(np.ceil(2 * self.size * np.tan(np.radians(30)))), self.size
+        if instruction.type in (InstructionType.INC, InstructionType.DEC):
+            return self.size, self.size if instruction.type == InstructionType.INC else self.size // 3
+        if instruction.type in (InstructionType.LOOP_START, InstructionType.LOOP_END):
+            return self.size // 2, self.size * 3 // 2
+        if instruction.type == InstructionType.CALL:
+            (width, height), baseline = cv2.getTextSize(instruction.value, CALL_FONT, CALL_SCALE, CALL_THICKNESS)
+            # The smallest ellipse around the padded text is sqrt(2) times its size. Flat ellipses
+            # simplify to too few points to be told apart from other shapes, so they're kept fairly round.
+            width = int(np.ceil((width + 2 * CALL_PADDING) * 1.42))
+            height = int(np.ceil((height + baseline + 2 * CALL_PADDING) * 1.42))
+            return width, max(height, int(width * MIN_ELLIPSE_RATIO))
+        raise RenderError(f"{instruction.type.name} instructions can't be drawn")
+
+    def layout(self, instructions):
+        """Splits the instructions into lines which fit in max_width.
+
+        Returns a list of lines, each of which is a list of (instruction, width, height).
+        """
+        lines = [[]]
+        x = MARGIN
+        for instruction in instructions:
+            width, height = self.symbol_size(instruction)
+            if lines[-1] and x + width > self.max_width - MARGIN:
+                lines.append([])
+                x = MARGIN
+            lines[-1].append((instruction, width, height))
+            x += width + SYMBOL_GAP
+        return lines
+
+    def signature_text(self, function):
+        """The text of the name and number of arguments, with their sizes, and the baseline they share"""
+        texts = [function.signature.name, str(function.signature.n_args)]
+        sizes = [cv2.getTextSize(text, SIGNATURE_FONT, SIGNATURE_SCALE, SIGNATURE_THICKNESS) for text in texts]
+        baseline = MARGIN + max(height for (_, height), _ in sizes)
+        bottom = baseline + max(below for _, below in sizes)
+        return [(text, width) for text, ((width, _), _) in zip(texts, sizes)], baseline, bottom
+
+    def draw_signature(self, img, function):
+        ((name, _), (n_args, args_width)), baseline, _ = self.signature_text(function)
+        cv2.putText(img, name, (MARGIN, baseline), SIGNATURE_FONT, SIGNATURE_SCALE, BLACK, SIGNATURE_THICKNESS, cv2.LINE_8)
+        cv2.putText(img, n_args, (img.shape[1] - MARGIN - args_width, baseline), SIGNATURE_FONT, SIGNATURE_SCALE, BLACK, SIGNATURE_THICKNESS, cv2.LINE_8)
+
+    def draw_instruction(self, img, instruction, x, y, width, height):
+        """Draws an instruction's shape with its top left corner at (x, y)"""
+        def points(shape):
+            return np.array([(round(x + px), round(y + py)) for px, py in shape], dtype=np.int32)
+
+        if instruction.type in ARROWS:
+            cv2.fillPoly(img, [points(arrow(instruction.type, self.size))], BLACK, cv2.LINE_8)
+        elif instruction.type in TRIANGLES:
+            cv2.fillPoly(img, [points(triangle(instruction.type, self.size))], BLACK, cv2.LINE_8)
+        elif instruction.type == InstructionType.INC:
+            cv2.line(img, (x + width // 2, y), (x + width // 2, y + height), BLACK, STROKE, cv2.LINE_8)
+            cv2.line(img, (x, y + height // 2), (x + width, y + height // 2), BLACK, STROKE, cv2.LINE_8)
+        elif instruction.type == InstructionType.DEC:
+            cv2.rectangle(img, (x, y), (x + width, y + height), BLACK, cv2.FILLED, cv2.LINE_8)
+        elif instruction.type in (InstructionType.LOOP_START, InstructionType.LOOP_END):
+            bracket = [(width, 0), (0, 0), (0, height), (width, height)]
+            if instruction.type == InstructionType.LOOP_END:
+                bracket = mirror(bracket, width)
+            cv2.polylines(img, [points(bracket)], False, BLACK, STROKE, cv2.LINE_8)
+        elif instruction.type == InstructionType.CALL:
+            centre = (x + width // 2, y + height // 2)
+            cv2.ellipse(img, centre, (width // 2, height // 2), 0, 0, 360, BLACK, STROKE, cv2.LINE_8)
+            (text_width, text_height), baseline = cv2.getTextSize(instruction.value, CALL_FONT, CALL_SCALE, CALL_THICKNESS)
+            origin = (width // 2 - text_width // 2, height // 2 + (text_height - baseline) // 2)
+            self.draw_text(img[y:y + height, x:x + width], instruction.value, origin)
+
+    def draw_text(self, img, text, origin):
+        """Draws a call name in pure black. OpenCV smooths the edges of its fonts even without
+        antialiasing, and the parser thresholds more of that grey than the recogniser's templates do.
+        """
+        glyphs = np.full(img.shape[:2], 255, dtype=np.uint8)
+        cv2.putText(glyphs, text, origin, CALL_FONT, CALL_SCALE, 0, CALL_THICKNESS, cv2.LINE_8)
+        img[glyphs < 128] = BLACK
+
+    def render(self, function):
+        """Draws a function, returning a BGR image"""
+        lines = self.layout(function.instructions)
+        line_heights = [max([height for _, _, height in line], default=0) for line in lines]
+        line_widths = [sum(width + SYMBOL_GAP for _, width, _ in line) for line in lines]
+
+        texts, _, signature_bottom = self.signature_text(function)
+        # The name and number of arguments need to be far enough apart for the parser to tell them apart
+        signature_width = sum(text_width for _, text_width in texts) + SIGNATURE_GAP
+        width = max([self.max_width // 2, MARGIN * 2 + signature_width] + [MARGIN * 2 + line_width for line_width in line_widths])
+        height = signature_bottom + SIGNATURE_GAP + sum(line_heights) + LINE_GAP * len(lines) + MARGIN
+        img = np.full((height, width, 3), 255, dtype=np.uint8)
+
+        self.draw_signature(img, function)
+        y = signature_bottom + SIGNATURE_GAP
+        for line, line_height in zip(lines, line_heights):
+            x = MARGIN
+            # Everything on a line is centred on the same row, so the parser sees one line
+            for instruction, symbol_width, symbol_height in line:
+                self.draw_instruction(img, instruction, x, y + (line_height - symbol_height) // 2, symbol_width, symbol_height)
+                x += symbol_width + SYMBOL_GAP
+            y += line_height + LINE_GAP
+        return img
+
+def render(function, symbol_size=DEFAULT_SYMBOL_SIZE, max_width=DEFAULT_MAX_WIDTH):
+    return Renderer(symbol_size, max_width).render(function)
+
+def write(function, path, symbol_size=DEFAULT_SYMBOL_SIZE, max_width=DEFAULT_MAX_WIDTH):
+    """Draws a function into an image file"""
+    if not cv2.imwrite(path, render(function, symbol_size, max_width)):
+        raise RenderError(f"Couldn't write {path}")
@@ -0,0 +1,114 @@
+"""A compile server which keeps OpenCV, cffi and Tesseract loaded between builds.
+
+Start it with `vizh --server`. While it is running, the vizh command forwards
+builds to it over a Unix socket (see vizh.client).
+"""
+import contextlib
+import io
+import os
+import socketserver
+import sys
+import click
+import vizh.cache
+import vizh.client
+import vizh.compiler
+import vizh.linker
+import vizh.parser
+import vizh.recogniser
+
+class Toolchain(object):
+    """A parser, compiler and linker which are kept alive between builds"""
+    def __init__(self, preload=True):
+        self.compiler = vizh.compiler.Compiler()
+        self.linker = vizh.linker.Linker()
+        self.parse_cache = vizh.cache.ParseCache()
+        self.object_cache = vizh.cache.ObjectCache()
+        self.recogniser = vizh.recogniser.TemplateRecogniser(vizh.recogniser.libv_names())
+        # There's nowhere to show windows from a server
+        self.parser = vizh.parser.Parser(interactive=False)
+        if preload:
+            # Accessing the OCR loads Tesseract and its trained data
+            self.parser.ocr
+
+    def configure_parser(self, use_parse_cache, batch_ocr, use_templates):
+        """Returns the warm parser set up for a particular build"""
+        self.parser.cache = self.parse_cache if use_parse_cache else None
+        self.parser.batch_ocr = batch_ocr
+        self.parser.recogniser = self.recogniser if use_templates else None
+        return self.parser
+
+    def close(self):
+        self.parser.__exit__(None, None, None)
+
+def run_command_line(args, toolchain=None):
+    """Runs the vizh command line with the given arguments, returning its exit status as a process would see it"""
+    # Imported here because vizh.driver imports this module
+    import vizh.driver
+
+    try:
+        status = vizh.driver.entry.main(args, prog_name='vizh', standalone_mode=False, obj=toolchain)
+    except click.exceptions.ClickException as err:
+        err.show()
+        status = err.exit_code
+    except click.exceptions.Abort:
+        print('Aborted!', file=sys.stderr)
+        status = 1
+    # Commands return -1 on failure, which a process would see as 255
+    return (status or 0) & 0xFF
+
+def run_build(toolchain, args, cwd):
+    """Runs the vizh command line with the given arguments as if it were started in cwd.
+
+    Returns (exit status, stdout, stderr).
+    """
+    stdout, stderr = io.StringIO(), io.StringIO()
+    status = 0
+    old_cwd = os.getcwd()
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                status = run_command_line(args, toolchain)
+            except Exception as err:
+                # A broken build shouldn't bring the server down
+                print(f'Internal compiler error: {err!r}', file=sys.stderr)
+                status = 1
+    finally:
+        os.chdir(old_cwd)
+
+    return status, stdout.getvalue(), stderr.getvalue()
+
+class BuildRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = vizh.client.receive_message(self.rfile)
+        status, stdout, stderr = run_build(self.server.toolchain, request['args'], request['cwd'])
+        vizh.client.send_message(self.connection, {'status': status, 'stdout': stdout, 'stderr': stderr})
+
+class BuildServer(socketserver.UnixStreamServer):
+    """Handles one build at a time, since builds change the working directory"""
+    def __init__(self, socket_path, toolchain):
+        self.toolchain = toolchain
+        super().__init__(socket_path, BuildRequestHandler)
+
+def serve(socket_path=None, toolchain=None):
+    socket_path = socket_path or vizh.client.default_socket_path()
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    if os.path.exists(socket_path):
+        sock = vizh.client.connect(socket_path)
+        if sock:
+            sock.close()
+            raise RuntimeError(f'A vizh server is already listening on {socket_path}')
+        os.remove(socket_path)
+
+    toolchain = toolchain or Toolchain()
+    try:
+        with BuildServer(socket_path, toolchain) as server:
+            print(f'vizh server listening on {socket_path}', file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        toolchain.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
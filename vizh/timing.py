@@ -0,0 +1,213 @@
+"""Timing of the stages of a build, for vizh --time-passes.
+
+Stages time themselves with phase:
+
+    with vizh.timing.phase('parser.find_contours'):
+        ...
+
+Nothing is recorded unless timing has been started with start(). Until then, phase
+hands back the same do-nothing context manager every time, so it's cheap enough
+to leave in the parser's loops.
+
+Phases record their wall time, the CPU time of the thread they ran on, and how many
+times they ran. A phase given a file is also broken down by file, and so is
+every phase nested inside it on the same thread. Phases with each set, like OCR
+calls, also keep a record of every call. The C compiler and linker run in child
+processes, so their CPU time only shows up in the total for child processes.
+"""
+import json
+import os.path
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows doesn't have getrusage
+    resource = None
+
+# Bump this whenever the JSON written by Timings.to_json changes
+TIMING_VERSION = 1
+
+class Stats(object):
+    def __init__(self, calls=0, wall=0.0, cpu=0.0):
+        self.calls = calls
+        self.wall = wall
+        self.cpu = cpu
+
+    def add(self, calls, wall, cpu):
+        self.calls += calls
+        self.wall += wall
+        self.cpu += cpu
+
+    def to_json(self):
+        return {'calls': self.calls, 'wall': self.wall, 'cpu': self.cpu}
+
+def children_cpu():
+    """The CPU time used by child processes which have finished, or None if we can't tell"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Timings(object):
+    """The phases recorded since timing started. Phases can be recorded from any thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        # Maps phase names to {file: Stats}
+        self.files = {}
+        self.calls = []
+        self.start_wall = time.perf_counter()
+        self.start_children_cpu = children_cpu()
+        self.wall = None
+        self.children_cpu = None
+
+    def record(self, name, file, wall, cpu, each, info):
+        with self.lock:
+            self.phases.setdefault(name, Stats()).add(1, wall, cpu)
+            if file is not None:
+                self.files.setdefault(name, {}).setdefault(file, Stats()).add(1, wall, cpu)
+            if each:
+                self.calls.append(dict(info, phase=name, file=file, wall=wall, cpu=cpu))
+
+    def finish(self):
+        """Records how long the whole build took"""
+        self.wall = time.perf_counter() - self.start_wall
+        if self.start_children_cpu is not None:
+            self.children_cpu = children_cpu() - self.start_children_cpu
+        return self
+
+    def merge(self, data):
+        """Adds the phases from another process, as returned by its to_json"""
+        with self.lock:
+            for name, stats in data['phases'].items():
+                self.phases.setdefault(name, Stats()).add(stats['calls'], stats['wall'], stats['cpu'])
+            for name, files in data['files'].items():
+                for file, stats in files.items():
+                    self.files.setdefault(name, {}).setdefault(file, Stats()).add(stats['calls'], stats['wall'], stats['cpu'])
+            self.calls += data['calls']
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'version': TIMING_VERSION,
+                'wall': self.wall,
+                'children_cpu': self.children_cpu,
+                'phases': {name: stats.to_json() for name, stats in sorted(self.phases.items())},
+                'files': {name: {file: stats.to_json() for file, stats in sorted(files.items())}
+                          for name, files in sorted(self.files.items())},
+                'calls': list(self.calls),
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as json_file:
+            json.dump(self.to_json(), json_file, indent=1)
+
+class NoPhase(object):
+    """What phase hands out when timing is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NO_PHASE = NoPhase()
+
+# The file being worked on by each thread, for phases which don't say
+context = threading.local()
+
+class Phase(object):
+    def __init__(self, timings, name, file, each, info):
+        self.timings = timings
+        self.name = name
+        self.file = file
+        self.each = each
+        self.info = info
+
+    def __enter__(self):
+        self.outer_file = getattr(context, 'file', None)
+        if self.file is None:
+            self.file = self.outer_file
+        context.file = self.file
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        context.file = self.outer_file
+        self.timings.record(self.name, self.file, wall, cpu, self.each, self.info)
+        return False
+
+# The Timings being recorded, or None if timing is off
+current = None
+
+def phase(name, file=None, each=False, **info):
+    """A context manager which times a phase of the build called name.
+
+    file is what the phase is working on, like an image or a function, and each
+    asks for a record of this call on its own, along with any other keyword arguments.
+    """
+    if current is None:
+        return NO_PHASE
+    return Phase(current, name, file, each, info)
+
+def start():
+    """Starts recording phases, returning the Timings they're recorded in"""
+    global current
+    current = Timings()
+    return current
+
+def stop():
+    """Stops recording phases, returning what was recorded"""
+    global current
+    timings, current = current, None
+    return timings.finish() if timings else None
+
+def take():
+    """Hands over what has been recorded so far as JSON and starts again, or returns None if timing is off.
+    Worker processes use this to send their timings back with their results.
+    """
+    global current
+    if current is None:
+        return None
+    data = current.to_json()
+    current = Timings()
+    return data
+
+def merge(data):
+    """Adds timings from take in another process to the ones being recorded here"""
+    if current is not None and data is not None:
+        current.merge(data)
+
+def format_seconds(seconds):
+    return f'{seconds:.3f}'
+
+def format_table(timings, top_files=10):
+    """The summary printed by --time-passes"""
+    total = timings.wall or sum(stats.wall for stats in timings.phases.values()) or 1
+    lines = [f'{"Phase":<28} {"Calls":>8} {"Wall (s)":>10} {"CPU (s)":>10} {"Wall %":>7}']
+    for name, stats in sorted(timings.phases.items()):
+        lines.append(f'{name:<28} {stats.calls:>8} {format_seconds(stats.wall):>10} {format_seconds(stats.cpu):>10} '
+                     f'{100 * stats.wall / total:>6.1f}%')
+
+    footer = f'Build took {format_seconds(total)}s'
+    if timings.children_cpu is not None:
+        footer += f', and child processes like the C compiler used {format_seconds(timings.children_cpu)}s of CPU'
+    lines += ['', footer + '. Phases in parallel workers overlap, so they can add up to more than that.']
+
+    # The files which took longest in the phases they were broken down in
+    by_file = sorted(((stats.wall, name, file) for name, files in timings.files.items() for file, stats in files.items()),
+                     reverse=True)[:top_files]
+    if by_file:
+        lines += ['', f'{"Slowest files":<28} {"Phase":<24} {"Wall (s)":>10}']
+        lines += [f'{os.path.basename(file):<28} {name:<24} {format_seconds(wall):>10}' for wall, name, file in by_file]
+
+    if timings.calls:
+        lines += ['', f'{"Individual calls":<28} {"Calls":>8} {"Mean (ms)":>10} {"Max (ms)":>10}']
+        for name in sorted(set(call['phase'] for call in timings.calls)):
+            walls = [call['wall'] for call in timings.calls if call['phase'] == name]
+            lines.append(f'{name:<28} {len(walls):>8} {1000 * sum(walls) / len(walls):>10.2f} {1000 * max(walls):>10.2f}')
+    return '\n'.join(lines)
@@ -1,23 +1,48 @@
-
 import os
-import contextlib
+import re
+import subprocess
+import sys
+import distutils.errors
 
-@contextlib.contextmanager
-def stdchannel_redirected(stdchannel, dest_filename):
-    """
-    A context manager to temporarily redirect stdout or stderr
+def capture_output(c_compiler):
+    """Makes a distutils compiler capture the output of the commands it runs.
 
-    From https://stackoverflow.com/questions/7018879/disabling-output-when-compiling-with-distutils
+    distutils lets compilers and linkers write straight to our stdout and stderr.
+    This replaces the compiler's spawn so that each command's output is captured
+    through a pipe instead. If the command fails, its output becomes the message of
+    the CompileError or LinkError which distutils raises, otherwise it's passed on
+    to sys.stderr as one write. Nothing process-wide changes, so compiles can run
+    in parallel threads.
     """
+    def spawn(cmd, **kwargs):
+        env = kwargs.get('env')
+        # MSVC needs its own PATH, which its spawn normally sets up
+        if env is None and getattr(c_compiler, '_paths', None):
+            env = dict(os.environ, PATH=c_compiler._paths)
+        run_captured(cmd, env=env)
+
+    c_compiler.spawn = spawn
+    return c_compiler
 
+def run_captured(cmd, input=None, env=None):
+    """Runs a command, passing its output to sys.stderr if it succeeds.
+
+    If it fails, or can't be started at all, raises DistutilsExecError with the output.
+    """
     try:
-        oldstdchannel = os.dup(stdchannel.fileno())
-        dest_file = open(dest_filename, 'w+')
-        os.dup2(dest_file.fileno(), stdchannel.fileno())
+        result = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, universal_newlines=True)
+    except OSError as err:
+        raise distutils.errors.DistutilsExecError(f'{cmd[0]}: {err}')
+    if result.returncode != 0:
+        raise distutils.errors.DistutilsExecError(result.stdout or f'{cmd[0]} failed with exit status {result.returncode}')
+    if result.stdout:
+        sys.stderr.write(result.stdout)
+
+size_regex = re.compile(r'^([0-9]+)([kKmMgG]?)$')
 
-        yield dest_file
-    finally:
-        if oldstdchannel is not None:
-            os.dup2(oldstdchannel, stdchannel.fileno())
-        if dest_file is not None:
-            dest_file.close()
\ No newline at end of file
+def parse_size(text):
+    """Parses a size like 4096, 64K, 16M or 1G into bytes, like vizh_parse_size in libv. Returns None if it isn't one."""
+    match = size_regex.match(text.strip())
+    if not match or int(match[1]) == 0:
+        return None
+    return int(match[1]) << {'': 0, 'k': 10, 'm': 20, 'g': 30}[match[2].lower()]